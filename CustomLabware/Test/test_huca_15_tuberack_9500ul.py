@@ -1,5 +1,9 @@
+import csv
 import json
+import os
+import jsonschema
 from opentrons import protocol_api, types
+from opentrons_shared_data import load_shared_data
 
 CALIBRATION_CROSS_COORDS = {
     '1': {
@@ -30,8 +34,53 @@ PIPETTE_NAME = 'p1000_single_gen2'
 TIPRACK_SLOT = '5'
 TIPRACK_LOADNAME = 'opentrons_96_tiprack_1000ul'
 
+# 'batch': one continuous path over CHECK_WELLS, pausing only at the edges of DEVIATION_WELLS and once at
+# the end. The operator marks the positions where the tip was not centered in the check file.
+# 'edges': pause at every calibration cross and at every edge of A1 and the last well
+CHECK_MODE = 'batch'
+CHECK_WELLS = []  # Wells visited in batch mode, empty for the corners and the center of the labware
+DEVIATION_WELLS = []  # Wells flagged by the operator in a previous batch run
+CHECK_DWELL = 1  # Seconds over every position in batch mode
+BATCH_RATE = 0.5  # % of default speeds in batch mode
+CHECK_LOG_FOLDER = '/var/lib/jupyter/notebooks'
+
 LABWARE_DEF_JSON = """{"ordering":[["A1","B1","C1"],["A2","B2","C2"],["A3","B3","C3"],["A4","B4","C4"],["A5","B5","C5"]],"brand":{"brand":"HUCA","brandId":[]},"metadata":{"displayName":"HUCA 15 Tube Rack 9500 µL","displayCategory":"tubeRack","displayVolumeUnits":"µL","tags":[]},"dimensions":{"xDimension":127.76,"yDimension":85.48,"zDimension":109},"wells":{"A1":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":13.88,"y":67.74,"z":9},"B1":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":13.88,"y":42.74,"z":9},"C1":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":13.88,"y":17.74,"z":9},"A2":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":38.88,"y":67.74,"z":9},"B2":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":38.88,"y":42.74,"z":9},"C2":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":38.88,"y":17.74,"z":9},"A3":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":63.88,"y":67.74,"z":9},"B3":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":63.88,"y":42.74,"z":9},"C3":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":63.88,"y":17.74,"z":9},"A4":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":88.88,"y":67.74,"z":9},"B4":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":88.88,"y":42.74,"z":9},"C4":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":88.88,"y":17.74,"z":9},"A5":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":113.88,"y":67.74,"z":9},"B5":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":113.88,"y":42.74,"z":9},"C5":{"depth":100,"totalLiquidVolume":9500,"shape":"circular","diameter":16,"x":113.88,"y":17.74,"z":9}},"groups":[{"metadata":{"wellBottomShape":"u","displayCategory":"tubeRack"},"wells":["A1","B1","C1","A2","B2","C2","A3","B3","C3","A4","B4","C4","A5","B5","C5"]}],"parameters":{"format":"irregular","quirks":[],"isTiprack":false,"isMagneticModuleCompatible":false,"loadName":"huca_15_tuberack_9500ul"},"namespace":"custom_beta","version":1,"schemaVersion":2,"cornerOffsetFromSlot":{"x":0,"y":0,"z":0}}"""
-LABWARE_DEF = json.loads(LABWARE_DEF_JSON)
+LABWARE_LOADNAME = 'huca_15_tuberack_9500ul'
+
+# Folders where the definition of CustomLabware is looked for: in the repository and in the robot notebooks.
+# The app and opentrons_simulate only get this file, so the embedded LABWARE_DEF_JSON is used when it is not found
+labware_folders = ['/var/lib/jupyter/notebooks/CustomLabware']
+if '__file__' in globals():
+    labware_folders.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def validate_labware_definition(definition):
+    # Errors of the definition against the labware schema (version 2) of opentrons_shared_data
+    schema = json.loads(load_shared_data('labware/schemas/2.json'))
+    return [('/'.join(str(p) for p in error.path) + ': ' if error.path else '') + error.message
+            for error in jsonschema.Draft7Validator(schema).iter_errors(definition)]
+
+
+def load_labware_definition():
+    '''
+    Definition of the labware to test: the file of CustomLabware if it is found, the embedded one if not
+    '''
+    definition = None
+    for folder in labware_folders:
+        path = os.path.join(folder, LABWARE_LOADNAME + '.json')
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                definition = json.load(f)
+            break
+    if definition is None:
+        definition = json.loads(LABWARE_DEF_JSON)
+    errors = validate_labware_definition(definition)
+    if errors:
+        raise Exception('Invalid labware definition ' + LABWARE_LOADNAME + ': ' + '; '.join(errors))
+    return definition
+
+
+LABWARE_DEF = load_labware_definition()
 LABWARE_LABEL = LABWARE_DEF.get('metadata', {}).get(
     'displayName', 'test labware')
 
@@ -46,6 +95,14 @@ def uniq(l):
     return res
 
 
+def sample_wells(ordering):
+    # Corners and center of the labware, in a continuous path along the columns
+    cols = len(ordering)
+    rows = len(ordering[0])
+    picks = [(0, 0), (0, rows - 1), (cols // 2, rows // 2), (cols - 1, rows - 1), (cols - 1, 0)]
+    return uniq([ordering[c][r] for c, r in picks])
+
+
 def run(protocol: protocol_api.ProtocolContext):
     tiprack = protocol.load_labware(TIPRACK_LOADNAME, TIPRACK_SLOT)
     pipette = protocol.load_instrument(
@@ -78,21 +135,7 @@ def run(protocol: protocol_api.ProtocolContext):
         for instr in protocol.loaded_instruments.values():
             instr.default_speed = speed_max
 
-    set_speeds(RATE)
-
-    for slot in CALIBRATION_CROSS_SLOTS:
-        coordinate = CALIBRATION_CROSS_COORDS[slot]
-        location = types.Location(point=types.Point(**coordinate),
-                                  labware=None)
-        pipette.move_to(location)
-        protocol.pause(
-            f"Confirm {PIPETTE_MOUNT} pipette is at slot {slot} calibration cross")
-
-    pipette.home()
-    protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
-
-    for well_loc in well_locs:
-        well = test_labware.well(well_loc)
+    def check_edges(well):
         all_4_edges = [
             [well._from_center_cartesian(x=-1, y=0, z=1), 'left'],
             [well._from_center_cartesian(x=1, y=0, z=1), 'right'],
@@ -110,14 +153,69 @@ def run(protocol: protocol_api.ProtocolContext):
             pipette.move_to(edge_location)
             protocol.pause(f'Moved to {edge_name} edge')
 
-    # go to bottom last. (If there is more than one well, use the last well first
-    # because the pipette is already at the last well at this point)
-    for well_loc in reversed(well_locs):
+    records = []
+
+    def visit(name, location):
+        # Dwell over the position so the operator can see if the tip is centered
+        pipette.move_to(location)
+        protocol.comment(f'Position {name}')
+        protocol.delay(seconds=CHECK_DWELL)
+        # The centered column is left for the operator: 1 if the tip was centered, 0 if not
+        records.append([name] + [round(v, 2) for v in location.point] + [''])
+
+    if CHECK_MODE == 'edges':
         set_speeds(RATE)
-        pipette.move_to(well.bottom())
-        protocol.pause("Moved to the bottom of the well")
 
-        pipette.blow_out(well)
+        for slot in CALIBRATION_CROSS_SLOTS:
+            coordinate = CALIBRATION_CROSS_COORDS[slot]
+            location = types.Location(point=types.Point(**coordinate),
+                                      labware=None)
+            pipette.move_to(location)
+            protocol.pause(
+                f"Confirm {PIPETTE_MOUNT} pipette is at slot {slot} calibration cross")
+
+        pipette.home()
+        protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
+
+        for well_loc in well_locs:
+            well = test_labware.well(well_loc)
+            check_edges(well)
+
+        # go to bottom last. (If there is more than one well, use the last well first
+        # because the pipette is already at the last well at this point)
+        for well_loc in reversed(well_locs):
+            set_speeds(RATE)
+            pipette.move_to(well.bottom())
+            protocol.pause("Moved to the bottom of the well")
+
+            pipette.blow_out(well)
+
+    else:
+        set_speeds(BATCH_RATE)
+        for slot in CALIBRATION_CROSS_SLOTS:
+            location = types.Location(point=types.Point(**CALIBRATION_CROSS_COORDS[slot]), labware=None)
+            visit('cross ' + slot, location)
+
+        pipette.home()
+        protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
+
+        for well_loc in CHECK_WELLS or sample_wells(LABWARE_DEF['ordering']):
+            well = test_labware.wells_by_name()[well_loc]
+            set_speeds(BATCH_RATE)
+            for name, location in [('top', well.top()), ('bottom', well.bottom(1))]:
+                visit(well_loc + ' ' + name, location)
+            if well_loc in DEVIATION_WELLS:
+                check_edges(well)
+            pipette.move_to(well.top())
+
+        check_file = os.path.join(CHECK_LOG_FOLDER, 'labware_check_' + LABWARE_LOADNAME + '.csv')
+        if not protocol.is_simulating():
+            with open(check_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['position', 'expected_x', 'expected_y', 'expected_z', 'centered'])
+                writer.writerows(records)
+        protocol.pause(f"Write 1 (centered) or 0 (not centered) in the centered column of {check_file} "
+                       f"for every position: {', '.join(r[0] for r in records)}")
 
     set_speeds(1.0)
     pipette.return_tip()
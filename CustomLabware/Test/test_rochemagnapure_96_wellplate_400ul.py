@@ -1,5 +1,9 @@
+import csv
 import json
+import os
+import jsonschema
 from opentrons import protocol_api, types
+from opentrons_shared_data import load_shared_data
 
 CALIBRATION_CROSS_COORDS = {
     '1': {
@@ -30,8 +34,53 @@ PIPETTE_NAME = 'p20_single_gen2'
 TIPRACK_SLOT = '5'
 TIPRACK_LOADNAME = 'opentrons_96_tiprack_20ul'
 
+# 'batch': one continuous path over CHECK_WELLS, pausing only at the edges of DEVIATION_WELLS and once at
+# the end. The operator marks the positions where the tip was not centered in the check file.
+# 'edges': pause at every calibration cross and at every edge of A1 and the last well
+CHECK_MODE = 'batch'
+CHECK_WELLS = []  # Wells visited in batch mode, empty for the corners and the center of the labware
+DEVIATION_WELLS = []  # Wells flagged by the operator in a previous batch run
+CHECK_DWELL = 1  # Seconds over every position in batch mode
+BATCH_RATE = 0.5  # % of default speeds in batch mode
+CHECK_LOG_FOLDER = '/var/lib/jupyter/notebooks'
+
 LABWARE_DEF_JSON = """{"ordering":[["A1","B1","C1","D1","E1","F1","G1","H1"],["A2","B2","C2","D2","E2","F2","G2","H2"],["A3","B3","C3","D3","E3","F3","G3","H3"],["A4","B4","C4","D4","E4","F4","G4","H4"],["A5","B5","C5","D5","E5","F5","G5","H5"],["A6","B6","C6","D6","E6","F6","G6","H6"],["A7","B7","C7","D7","E7","F7","G7","H7"],["A8","B8","C8","D8","E8","F8","G8","H8"],["A9","B9","C9","D9","E9","F9","G9","H9"],["A10","B10","C10","D10","E10","F10","G10","H10"],["A11","B11","C11","D11","E11","F11","G11","H11"],["A12","B12","C12","D12","E12","F12","G12","H12"]],"brand":{"brand":"roche_magnapure","brandId":["magnapure/06 241 611 001"]},"metadata":{"displayName":"Roche_magnapure 96 Well Plate 400 µL","displayCategory":"wellPlate","displayVolumeUnits":"µL","tags":[]},"dimensions":{"xDimension":127.76,"yDimension":85.48,"zDimension":18},"wells":{"A1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":74.25,"z":3.5},"B1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":65.25,"z":3.5},"C1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":56.25,"z":3.5},"D1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":47.25,"z":3.5},"E1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":38.25,"z":3.5},"F1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":29.25,"z":3.5},"G1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":20.25,"z":3.5},"H1":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":14.38,"y":11.25,"z":3.5},"A2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":74.25,"z":3.5},"B2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":65.25,"z":3.5},"C2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":56.25,"z":3.5},"D2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":47.25,"z":3.5},"E2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":38.25,"z":3.5},"F2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":29.25,"z":3.5},"G2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":20.25,"z":3.5},"H2":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":23.38,"y":11.25,"z":3.5},"A3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":74.25,"z":3.5},"B3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":65.25,"z":3.5},"C3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":56.25,"z":3.5},"D3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":47.25,"z":3.5},"E3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":38.25,"z":3.5},"F3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":29.25,"z":3.5},"G3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":20.25,"z":3.5},"H3":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":32.38,"y":11.25,"z":3.5},"A4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":74.25,"z":3.5},"B4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":65.25,"z":3.5},"C4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":56.25,"z":3.5},"D4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":47.25,"z":3.5},"E4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":38.25,"z":3.5},"F4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":29.25,"z":3.5},"G4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":20.25,"z":3.5},"H4":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":41.38,"y":11.25,"z":3.5},"A5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":74.25,"z":3.5},"B5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":65.25,"z":3.5},"C5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":56.25,"z":3.5},"D5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":47.25,"z":3.5},"E5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":38.25,"z":3.5},"F5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":29.25,"z":3.5},"G5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":20.25,"z":3.5},"H5":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":50.38,"y":11.25,"z":3.5},"A6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":74.25,"z":3.5},"B6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":65.25,"z":3.5},"C6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":56.25,"z":3.5},"D6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":47.25,"z":3.5},"E6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":38.25,"z":3.5},"F6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":29.25,"z":3.5},"G6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":20.25,"z":3.5},"H6":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":59.38,"y":11.25,"z":3.5},"A7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":74.25,"z":3.5},"B7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":65.25,"z":3.5},"C7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":56.25,"z":3.5},"D7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":47.25,"z":3.5},"E7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":38.25,"z":3.5},"F7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":29.25,"z":3.5},"G7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":20.25,"z":3.5},"H7":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":68.38,"y":11.25,"z":3.5},"A8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":74.25,"z":3.5},"B8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":65.25,"z":3.5},"C8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":56.25,"z":3.5},"D8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":47.25,"z":3.5},"E8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":38.25,"z":3.5},"F8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":29.25,"z":3.5},"G8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":20.25,"z":3.5},"H8":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":77.38,"y":11.25,"z":3.5},"A9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":74.25,"z":3.5},"B9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":65.25,"z":3.5},"C9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":56.25,"z":3.5},"D9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":47.25,"z":3.5},"E9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":38.25,"z":3.5},"F9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":29.25,"z":3.5},"G9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":20.25,"z":3.5},"H9":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":86.38,"y":11.25,"z":3.5},"A10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":74.25,"z":3.5},"B10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":65.25,"z":3.5},"C10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":56.25,"z":3.5},"D10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":47.25,"z":3.5},"E10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":38.25,"z":3.5},"F10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":29.25,"z":3.5},"G10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":20.25,"z":3.5},"H10":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":95.38,"y":11.25,"z":3.5},"A11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":74.25,"z":3.5},"B11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":65.25,"z":3.5},"C11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":56.25,"z":3.5},"D11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":47.25,"z":3.5},"E11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":38.25,"z":3.5},"F11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":29.25,"z":3.5},"G11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":20.25,"z":3.5},"H11":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":104.38,"y":11.25,"z":3.5},"A12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":74.25,"z":3.5},"B12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":65.25,"z":3.5},"C12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":56.25,"z":3.5},"D12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":47.25,"z":3.5},"E12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":38.25,"z":3.5},"F12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":29.25,"z":3.5},"G12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":20.25,"z":3.5},"H12":{"depth":14.5,"totalLiquidVolume":400,"shape":"circular","diameter":7,"x":113.38,"y":11.25,"z":3.5}},"groups":[{"metadata":{"wellBottomShape":"v"},"wells":["A1","B1","C1","D1","E1","F1","G1","H1","A2","B2","C2","D2","E2","F2","G2","H2","A3","B3","C3","D3","E3","F3","G3","H3","A4","B4","C4","D4","E4","F4","G4","H4","A5","B5","C5","D5","E5","F5","G5","H5","A6","B6","C6","D6","E6","F6","G6","H6","A7","B7","C7","D7","E7","F7","G7","H7","A8","B8","C8","D8","E8","F8","G8","H8","A9","B9","C9","D9","E9","F9","G9","H9","A10","B10","C10","D10","E10","F10","G10","H10","A11","B11","C11","D11","E11","F11","G11","H11","A12","B12","C12","D12","E12","F12","G12","H12"]}],"parameters":{"format":"irregular","quirks":[],"isTiprack":false,"isMagneticModuleCompatible":false,"loadName":"rochemagnapure_96_wellplate_400ul"},"namespace":"custom_beta","version":1,"schemaVersion":2,"cornerOffsetFromSlot":{"x":0,"y":0,"z":0}}"""
-LABWARE_DEF = json.loads(LABWARE_DEF_JSON)
+LABWARE_LOADNAME = 'rochemagnapure_96_wellplate_400ul'
+
+# Folders where the definition of CustomLabware is looked for: in the repository and in the robot notebooks.
+# The app and opentrons_simulate only get this file, so the embedded LABWARE_DEF_JSON is used when it is not found
+labware_folders = ['/var/lib/jupyter/notebooks/CustomLabware']
+if '__file__' in globals():
+    labware_folders.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def validate_labware_definition(definition):
+    # Errors of the definition against the labware schema (version 2) of opentrons_shared_data
+    schema = json.loads(load_shared_data('labware/schemas/2.json'))
+    return [('/'.join(str(p) for p in error.path) + ': ' if error.path else '') + error.message
+            for error in jsonschema.Draft7Validator(schema).iter_errors(definition)]
+
+
+def load_labware_definition():
+    '''
+    Definition of the labware to test: the file of CustomLabware if it is found, the embedded one if not
+    '''
+    definition = None
+    for folder in labware_folders:
+        path = os.path.join(folder, LABWARE_LOADNAME + '.json')
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                definition = json.load(f)
+            break
+    if definition is None:
+        definition = json.loads(LABWARE_DEF_JSON)
+    errors = validate_labware_definition(definition)
+    if errors:
+        raise Exception('Invalid labware definition ' + LABWARE_LOADNAME + ': ' + '; '.join(errors))
+    return definition
+
+
+LABWARE_DEF = load_labware_definition()
 LABWARE_LABEL = LABWARE_DEF.get('metadata', {}).get(
     'displayName', 'test labware')
 
@@ -46,6 +95,14 @@ def uniq(l):
     return res
 
 
+def sample_wells(ordering):
+    # Corners and center of the labware, in a continuous path along the columns
+    cols = len(ordering)
+    rows = len(ordering[0])
+    picks = [(0, 0), (0, rows - 1), (cols // 2, rows // 2), (cols - 1, rows - 1), (cols - 1, 0)]
+    return uniq([ordering[c][r] for c, r in picks])
+
+
 def run(protocol: protocol_api.ProtocolContext):
     tiprack = protocol.load_labware(TIPRACK_LOADNAME, TIPRACK_SLOT)
     pipette = protocol.load_instrument(
@@ -78,21 +135,7 @@ def run(protocol: protocol_api.ProtocolContext):
         for instr in protocol.loaded_instruments.values():
             instr.default_speed = speed_max
 
-    set_speeds(RATE)
-
-    for slot in CALIBRATION_CROSS_SLOTS:
-        coordinate = CALIBRATION_CROSS_COORDS[slot]
-        location = types.Location(point=types.Point(**coordinate),
-                                  labware=None)
-        pipette.move_to(location)
-        protocol.pause(
-            f"Confirm {PIPETTE_MOUNT} pipette is at slot {slot} calibration cross")
-
-    pipette.home()
-    protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
-
-    for well_loc in well_locs:
-        well = test_labware.well(well_loc)
+    def check_edges(well):
         all_4_edges = [
             [well._from_center_cartesian(x=-1, y=0, z=1), 'left'],
             [well._from_center_cartesian(x=1, y=0, z=1), 'right'],
@@ -110,14 +153,69 @@ def run(protocol: protocol_api.ProtocolContext):
             pipette.move_to(edge_location)
             protocol.pause(f'Moved to {edge_name} edge')
 
-    # go to bottom last. (If there is more than one well, use the last well first
-    # because the pipette is already at the last well at this point)
-    for well_loc in reversed(well_locs):
+    records = []
+
+    def visit(name, location):
+        # Dwell over the position so the operator can see if the tip is centered
+        pipette.move_to(location)
+        protocol.comment(f'Position {name}')
+        protocol.delay(seconds=CHECK_DWELL)
+        # The centered column is left for the operator: 1 if the tip was centered, 0 if not
+        records.append([name] + [round(v, 2) for v in location.point] + [''])
+
+    if CHECK_MODE == 'edges':
         set_speeds(RATE)
-        pipette.move_to(well.bottom())
-        protocol.pause("Moved to the bottom of the well")
 
-        pipette.blow_out(well)
+        for slot in CALIBRATION_CROSS_SLOTS:
+            coordinate = CALIBRATION_CROSS_COORDS[slot]
+            location = types.Location(point=types.Point(**coordinate),
+                                      labware=None)
+            pipette.move_to(location)
+            protocol.pause(
+                f"Confirm {PIPETTE_MOUNT} pipette is at slot {slot} calibration cross")
+
+        pipette.home()
+        protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
+
+        for well_loc in well_locs:
+            well = test_labware.well(well_loc)
+            check_edges(well)
+
+        # go to bottom last. (If there is more than one well, use the last well first
+        # because the pipette is already at the last well at this point)
+        for well_loc in reversed(well_locs):
+            set_speeds(RATE)
+            pipette.move_to(well.bottom())
+            protocol.pause("Moved to the bottom of the well")
+
+            pipette.blow_out(well)
+
+    else:
+        set_speeds(BATCH_RATE)
+        for slot in CALIBRATION_CROSS_SLOTS:
+            location = types.Location(point=types.Point(**CALIBRATION_CROSS_COORDS[slot]), labware=None)
+            visit('cross ' + slot, location)
+
+        pipette.home()
+        protocol.pause(f"Place your labware in Slot {TEST_LABWARE_SLOT}")
+
+        for well_loc in CHECK_WELLS or sample_wells(LABWARE_DEF['ordering']):
+            well = test_labware.wells_by_name()[well_loc]
+            set_speeds(BATCH_RATE)
+            for name, location in [('top', well.top()), ('bottom', well.bottom(1))]:
+                visit(well_loc + ' ' + name, location)
+            if well_loc in DEVIATION_WELLS:
+                check_edges(well)
+            pipette.move_to(well.top())
+
+        check_file = os.path.join(CHECK_LOG_FOLDER, 'labware_check_' + LABWARE_LOADNAME + '.csv')
+        if not protocol.is_simulating():
+            with open(check_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['position', 'expected_x', 'expected_y', 'expected_z', 'centered'])
+                writer.writerows(records)
+        protocol.pause(f"Write 1 (centered) or 0 (not centered) in the centered column of {check_file} "
+                       f"for every position: {', '.join(r[0] for r in records)}")
 
     set_speeds(1.0)
     pipette.return_tip()
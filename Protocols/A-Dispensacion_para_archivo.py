@@ -29,7 +29,7 @@ PHOTOSENSITIVE          = False # True if it has photosensitive reagents
 ################################################
 
 
-run_id                      = 'dispensacion_y_lisado_muestras'
+run_id                      = 'dispensacion_para_archivo'
 recycle_tip                 = False # Do you want to recycle tips? It shoud only be set True for testing
 air_gap_vol_sample          = 25
 volume_mix                  = 500 # Volume used on mix
@@ -56,6 +56,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_A_time_log.txt'
+        map_path = folder_path + '/Station_A_well_map.txt'
 
     # Define Reagents as objects with their properties
     class Reagent:
@@ -272,6 +273,27 @@ def run(ctx: protocol_api.ProtocolContext):
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def rack_name(well, pool = 0):
+        # Racks are numbered as in their labels, pooled samples are told apart by their pool
+        name = 'rack ' + str(source_racks.index(well.parent) + 1)
+        return name + ' pool ' + str(pool + 1) if NUM_POOLS > 1 else name
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -358,6 +380,7 @@ def run(ctx: protocol_api.ProtocolContext):
                         vol = VOLUME_SAMPLE, air_gap_vol = air_gap_vol_sample, x_offset = x_offset,
                         pickup_height = 4, disp_height = -10, blow_out = True, touch_tip = False)
                 p1000.air_gap(air_gap_vol_sample)
+                record_well_map(rack_name(s, pool), s, 'archivo', d)
 
                 drop_tip(p1000)
 
@@ -368,6 +391,13 @@ def run(ctx: protocol_api.ProtocolContext):
         log_step_end(start)
     
 
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     # Export the time log to a tsv file
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
@@ -24,9 +24,16 @@ metadata = {
 ################################################
 NUM_SAMPLES             = 90    # Number of samples to be moved. (<= 90)
 NUM_POOLS               = 1     # Number of iterations over the samples
+POOLING                 = 'lineal' # lineal: every iteration goes to the same wells. matriz: every tube goes to its row and column pool
+POOL_ROWS               = 10    # matriz: rows of every block of tubes, tubes per column pool
+POOL_COLS               = 10    # matriz: columns of every block of tubes, tubes per row pool
 VOLUME_SAMPLE           = 200   # Sample volume to be moved
 LYSIS_VOLUME_PER_SAMPLE = 200   # Lysis volume to be moved
 NUM_MIXES_LYSIS         = 3     # Number of mixes on deepwell after lysis and sample moves
+LYSIS_MIX_IN_DISPENSE   = False # True: the p1000 dispenses the sample at the deepwell bottom to mix it, instead of STEP 4
+NUM_MIXES_DISPENSE      = 0     # Mixes of the p1000 in every deepwell well before dropping its tip, with LYSIS_MIX_IN_DISPENSE
+ARCHIVE_IN_SAME_PASS    = False # True: one aspiration per tube for the deepwell and the archive plate, instead of STEP 3
+ARCHIVE_PLATE           = 'pcr' # pcr: PCR strips on the aluminum block. deepwell: NEST deepwell, as in A-Dispensacion_para_archivo
 PHOTOSENSITIVE          = False # True if it has photosensitive reagents
 ################################################
 
@@ -37,7 +44,17 @@ air_gap_vol_sample          = 25
 volume_mix                  = 500 # Volume used on mix
 x_offset                    = [0,0]
 extra_dispensal             = 1
-num_cols                    = math.ceil(NUM_SAMPLES / 8) # Columns we are working on
+dispense_mix_height         = 2     # Height from the deepwell bottom of the sample dispense and the p1000 mixes
+dispense_mix_volume         = min(volume_mix, 0.75 * (LYSIS_VOLUME_PER_SAMPLE + VOLUME_SAMPLE)) # p1000 mix volume, under the liquid in the well
+tip_change_time             = 7     # Estimated seconds to pick up and drop a tip
+mix_round_time              = 4     # Estimated seconds of a mix round, aspirate and dispense
+num_tubes                   = NUM_SAMPLES * NUM_POOLS # Tubes of all the iterations
+if POOLING == 'matriz':
+    num_blocks              = math.ceil(num_tubes / (POOL_ROWS * POOL_COLS)) # Blocks of tubes, each with its row and column pools
+    num_wells               = num_blocks * (POOL_ROWS + POOL_COLS)
+else:
+    num_wells               = NUM_SAMPLES
+num_cols                    = math.ceil(num_wells / 8) # Columns we are working on
 
 pipette_allowed_capacity    = 900 # Volume allowed in the pipette of 1000µl
 size_transfer               = math.floor(pipette_allowed_capacity / LYSIS_VOLUME_PER_SAMPLE) # Number of wells the distribute function will fill
@@ -48,10 +65,15 @@ def run(ctx: protocol_api.ProtocolContext):
     STEPS = {  # Dictionary with STEP activation, description and times
         1: {'Execute': True,    'description': 'Transferir Lysis al deepwell ('+str(LYSIS_VOLUME_PER_SAMPLE)+' ul)'},
         2: {'Execute': True,    'description': 'Transferir muestras al deepwell ('+str(VOLUME_SAMPLE)+' ul)'},
-        3: {'Execute': False,   'description': 'Transferir muestras a la placa PCR ('+str(VOLUME_SAMPLE)+' ul)'},
+        3: {'Execute': False,   'description': 'Transferir muestras a la placa ' + ('PCR' if ARCHIVE_PLATE == 'pcr' else 'de archivo') + ' ('+str(VOLUME_SAMPLE)+' ul)'},
         4: {'Execute': True,    'description': 'Mezclar en el deepwell'}
     }
 
+    if ARCHIVE_IN_SAME_PASS: # STEP 2 already fills the archive plate
+        STEPS[3]['Execute'] = False
+    if LYSIS_MIX_IN_DISPENSE: # STEP 2 already mixes the sample with the lysis
+        STEPS[4]['Execute'] = False
+
     for s in STEPS:  # Create an empty wait_time
         if 'wait_time' not in STEPS[s]:
             STEPS[s]['wait_time'] = 0
@@ -62,6 +84,8 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_A_time_log.txt'
+        map_path = folder_path + '/Station_A_well_map.txt'
+        pool_map_path = folder_path + '/Station_A_pool_map.txt'
 
     # Define Reagents as objects with their properties
     class Reagent:
@@ -106,27 +130,35 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment(' ')
     ctx.comment('Número de muestras: ' + str(NUM_SAMPLES)) 
     ctx.comment('Número de ciclos de recogida (pools): ' + str(NUM_POOLS)) 
+    if POOLING == 'matriz':
+        ctx.comment('Pooling en matriz: ' + str(num_tubes) + ' tubos en ' + str(num_blocks) + ' bloque(s) de ' + str(POOL_ROWS) + 'x' + str(POOL_COLS) +
+            ', ' + str(num_wells) + ' pocillos del deepwell')
     ctx.comment('Volumen de muestra a mover: ' + str(VOLUME_SAMPLE) + ' ul') 
     ctx.comment('Volumen de lysis por muestra: ' + str(LYSIS_VOLUME_PER_SAMPLE) + ' ul') 
     ctx.comment('Número de mezclas en el lisado: ' + str(NUM_MIXES_LYSIS))
+    if LYSIS_MIX_IN_DISPENSE:
+        ctx.comment('Mezcla al dispensar la muestra en el fondo del deepwell, con ' + str(NUM_MIXES_DISPENSE) + ' mezclas de la p1000')
+    if ARCHIVE_IN_SAME_PASS:
+        ctx.comment('Muestras al deepwell y a la placa de archivo (' + ARCHIVE_PLATE + ') con una sola aspiración')
     ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE))  
     ctx.comment(' ')
     ctx.comment('###############################################')
     ctx.comment('VOLÚMENES PARA ' + str(NUM_SAMPLES) + ' MUESTRAS')
     ctx.comment(' ')
-    ctx.comment('Lysis: ' + str(LYSIS_VOLUME_PER_SAMPLE * NUM_SAMPLES) + ' ul')
+    ctx.comment('Lysis: ' + str(LYSIS_VOLUME_PER_SAMPLE * num_wells) + ' ul')
     ctx.comment('###############################################')
     ctx.comment(' ')
 
     ##################
     # Custom functions
     def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, disp_height, blow_out, touch_tip):
+                       pickup_height, disp_height, blow_out, touch_tip, disp_bottom = None):
         '''
         x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
         pickup_height: height from bottom where volume
         disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
         blow_out, touch_tip: if True they will be done after dispensing
+        disp_bottom: dispense height from the bottom instead of disp_height, to mix with the dispense
         '''
         # SOURCE
         s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
@@ -137,6 +169,8 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # GO TO DESTINATION
         drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
+        if disp_bottom is not None:
+            drop = dest.bottom(disp_bottom).move(Point(x = x_offset[1]))
         pipet.dispense(vol + air_gap_vol, drop,
                        rate = reagent.flow_rate_dispense)  # dispense all
 
@@ -147,6 +181,29 @@ def run(ctx: protocol_api.ProtocolContext):
         if touch_tip == True:
             pipet.touch_tip(speed = 20, v_offset = -10)
    
+    def move_vol_multidispense(pipet, reagent, source, dests, air_gap_vol, pickup_height, disp_height, blow_out, last_bottom = None):
+        '''
+        Aspirate once the volume of every destination and dispense it in each of them.
+        dests: list of (well, volume). The air gap is taken again over every destination but the last one
+        last_bottom: dispense height from the bottom in the last destination, to mix with the dispense
+        '''
+        s = source.bottom(pickup_height)
+        pipet.aspirate(sum([vol for d, vol in dests]), s, rate = reagent.flow_rate_aspirate)  # aspirate liquid
+        if air_gap_vol != 0:
+            pipet.aspirate(air_gap_vol, source.top(z = -2), rate = reagent.flow_rate_aspirate)  # air gap
+
+        for i, (d, vol) in enumerate(dests):
+            drop = d.top(z = disp_height)
+            if i == len(dests) - 1 and last_bottom is not None:
+                drop = d.bottom(last_bottom)
+            pipet.dispense(vol + air_gap_vol, drop, rate = reagent.flow_rate_dispense)
+            ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
+            if i < len(dests) - 1 and air_gap_vol != 0:
+                pipet.move_to(d.top(z = 5))
+                pipet.aspirate(air_gap_vol, rate = reagent.flow_rate_aspirate)  # air gap
+        if blow_out == True:
+            pipet.blow_out(dests[-1][0].top(z = -2))
+
     def divide_destinations(l, n):
         # Divide the list of destinations in size n lists.
         for i in range(0, len(l), n):
@@ -275,12 +332,65 @@ def run(ctx: protocol_api.ProtocolContext):
                 time.sleep(0.3)
         ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
 
+        if LYSIS_MIX_IN_DISPENSE:
+            # STEP 4 changes a tip and mixes once per column, the p1000 mixes once per tube
+            saved_tips = 8 * num_cols if NUM_MIXES_LYSIS > 0 else 0
+            saved_time = (num_cols * (tip_change_time + NUM_MIXES_LYSIS * mix_round_time) if NUM_MIXES_LYSIS > 0 else 0) - \
+                len(transfer_plan) * NUM_MIXES_DISPENSE * mix_round_time
+            ctx.comment('Paso 4 sustituido por la mezcla al dispensar: ' + str(saved_tips) + ' puntas de 200 ul ahorradas y unos ' +
+                (str(saved_time) + ' segundos menos' if saved_time >= 0 else str(-saved_time) + ' segundos más'))
         ctx.comment('Puntas de  200 ul utilizadas: ' + str(tip_track['counts'][m300]) + ' (' + str(round(tip_track['counts'][m300] / 96, 2)) + ' caja(s))')
         ctx.comment('Puntas de 1000 ul utilizadas: ' + str(tip_track['counts'][p1000]) + ' (' + str(round(tip_track['counts'][p1000] / 96, 2)) + ' caja(s))')
         ctx.comment('###############################################')
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def rack_name(well, pool = 0):
+        # Racks are numbered as in their labels, pooled samples are told apart by their pool or rack load
+        name = 'rack ' + str(source_racks.index(well.parent) + 1)
+        if POOLING == 'matriz':
+            return name + ' carga ' + str(pool + 1) if NUM_POOLS > 1 else name
+        return name + ' pool ' + str(pool + 1) if NUM_POOLS > 1 else name
+
+    def pooling_plan():
+        '''
+        Transfers of every tube as (rack load, tube, [(deepwell well, volume), ...]), ordered by rack load.
+        In matriz the tubes of every block of POOL_ROWS x POOL_COLS go to the pool of their row and
+        to the pool of their column, both in the same visit to the tube, so the racks are only swapped
+        once per load. Every pool receives VOLUME_SAMPLE in total when its block is full.
+        '''
+        plan = []
+        for load in range(NUM_POOLS):
+            for k, s in enumerate(sources_sample):
+                if POOLING == 'matriz':
+                    block, position = divmod(load * NUM_SAMPLES + k, POOL_ROWS * POOL_COLS)
+                    row, col = divmod(position, POOL_COLS)
+                    first = block * (POOL_ROWS + POOL_COLS) # Row pools of the block first, then its column pools
+                    dests = [(dests_deepwell[first + row], VOLUME_SAMPLE / POOL_COLS),
+                        (dests_deepwell[first + POOL_ROWS + col], VOLUME_SAMPLE / POOL_ROWS)]
+                else:
+                    dests = [(dests_deepwell[k], VOLUME_SAMPLE)]
+                if ARCHIVE_IN_SAME_PASS: # The archive plate first, before the tip goes over the lysis
+                    dests = [(dests_pcr[k], VOLUME_SAMPLE)] + dests
+                plan.append((load, s, dests))
+        return plan
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -301,6 +411,12 @@ def run(ctx: protocol_api.ProtocolContext):
     ####################################
     # load labware and modules
     ####################################
+    if num_wells > 96:
+        raise Exception('El pooling necesita ' + str(num_wells) + ' pocillos y el deepwell tiene 96')
+    if ARCHIVE_IN_SAME_PASS and NUM_POOLS > 1:
+        raise Exception('La placa de archivo en la misma pasada solo admite una carga de racks (NUM_POOLS = 1)')
+    if LYSIS_MIX_IN_DISPENSE and POOLING == 'matriz':
+        raise Exception('La mezcla al dispensar llevaría muestra de un pool a otro, no es compatible con el pooling en matriz')
     if NUM_SAMPLES <= 45:
         rack_num = 3
         ctx.comment('Los racks a utilizar son: ' + str(rack_num))
@@ -321,8 +437,12 @@ def run(ctx: protocol_api.ProtocolContext):
     # Destination plate
     dest_deepwell_plate = ctx.load_labware('nest_96_wellplate_2ml_deep', '6', 'NEST 96 Deepwell Plate 2mL')
 
-    dest_pcr_plate = ctx.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '3',
-        'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
+    if ARCHIVE_PLATE == 'pcr':
+        dest_pcr_plate = ctx.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '3',
+            'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
+    else:
+        dest_pcr_plate = ctx.load_labware('nest_96_wellplate_2ml_deep', '3', 'Archive NEST 96 Deepwell Plate 2mL')
+    archive_name = 'pcr' if ARCHIVE_PLATE == 'pcr' else 'archivo'
 
     ####################################
     # Load tip_racks
@@ -336,10 +456,11 @@ def run(ctx: protocol_api.ProtocolContext):
     # Setup sources and destinations
     sources_sample          = generate_source_table(source_racks,source_racks_extra)[0:NUM_SAMPLES]
     
-    dests_deepwell          = dest_deepwell_plate.wells()[0:NUM_SAMPLES]
+    dests_deepwell          = dest_deepwell_plate.wells()[0:num_wells]
     dests_lysis             = list(divide_destinations(dests_deepwell, size_transfer))
-    dests_deppwell_lisado   = dest_deepwell_plate.rows()[0][:NUM_SAMPLES]
+    dests_deppwell_lisado   = dest_deepwell_plate.rows()[0][:num_cols]
     dests_pcr               = dest_pcr_plate.wells()[0:NUM_SAMPLES]
+    transfer_plan           = pooling_plan()
 
 
     p1000 = ctx.load_instrument('p1000_single_gen2', 'right', tip_racks = tips1000) # load P1000 pipette
@@ -382,21 +503,37 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute'] == True:
         start = log_step_start()
 
-        for pool in range(NUM_POOLS):
-            for s, d in zip(sources_sample, dests_deepwell):
-                if not p1000.hw_pipette['has_tip']:
-                    pick_up_tip(p1000, tips1000)
+        if ARCHIVE_IN_SAME_PASS:
+            ctx.comment('Visitas a los tubos y puntas de 1000 ul ahorradas frente al paso 3: ' + str(len(transfer_plan)))
+        if POOLING == 'matriz':
+            # Going through the row pools and then through the column pools would load every rack twice
+            ctx.comment('Cambios de racks: ' + str(NUM_POOLS - 1) + ' en lugar de ' + str(2 * NUM_POOLS - 1) + ' dispensando los dos pools de cada tubo a la vez')
+
+        for pool, s, dests in transfer_plan:
+            if not p1000.hw_pipette['has_tip']:
+                pick_up_tip(p1000, tips1000)
 
-                move_vol_multichannel(p1000, reagent = Samples, source = s, dest = d,
-                        vol = VOLUME_SAMPLE, air_gap_vol = air_gap_vol_sample, x_offset = x_offset,
-                        pickup_height = 4, disp_height = -10, blow_out = True, touch_tip = False)
-                p1000.air_gap(air_gap_vol_sample)
+            disp_bottom = dispense_mix_height if LYSIS_MIX_IN_DISPENSE else None # Into the lysis, the deepwell is the last destination
+            if len(dests) == 1:
+                move_vol_multichannel(p1000, reagent = Samples, source = s, dest = dests[0][0],
+                        vol = dests[0][1], air_gap_vol = air_gap_vol_sample, x_offset = x_offset,
+                        pickup_height = 4, disp_height = -10, blow_out = True, touch_tip = False, disp_bottom = disp_bottom)
+            else:
+                move_vol_multidispense(p1000, reagent = Samples, source = s, dests = dests,
+                        air_gap_vol = air_gap_vol_sample, pickup_height = 4, disp_height = -10, blow_out = True, last_bottom = disp_bottom)
+            if LYSIS_MIX_IN_DISPENSE and NUM_MIXES_DISPENSE > 0:
+                custom_mix(p1000, Samples, location = dests[-1][0], vol = dispense_mix_volume,
+                        rounds = NUM_MIXES_DISPENSE, blow_out = True, mix_height = dispense_mix_height,
+                        x_offset = [0,0], source_height = dispense_mix_height)
+            p1000.air_gap(air_gap_vol_sample)
+            for d, vol in dests:
+                record_well_map(rack_name(s, pool), s, archive_name if d.parent == dest_pcr_plate else 'deepwell', d)
 
-                drop_tip(p1000)
+            drop_tip(p1000)
 
-                #pausar
-                if pool < NUM_POOLS - 1:
-                  ctx.pause('Cambiar las muestras para el pooling y cambiar el tipRacks de 1000 µl antes del pulsar Resume.')
+            #pausar
+            if pool < NUM_POOLS - 1 and s == sources_sample[-1]:
+                ctx.pause('Cambiar las muestras para el pooling y cambiar el tipRacks de 1000 µl antes del pulsar Resume.')
 
         log_step_end(start)
     
@@ -415,6 +552,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     vol = VOLUME_SAMPLE, air_gap_vol = air_gap_vol_sample, x_offset = x_offset,
                     pickup_height = 4, disp_height = -10, blow_out = True, touch_tip = False)
             p1000.air_gap(air_gap_vol_sample)
+            record_well_map(rack_name(s), s, archive_name, d)
 
             drop_tip(p1000)
 
@@ -444,6 +582,20 @@ def run(ctx: protocol_api.ProtocolContext):
         log_step_end(start)
 
 
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
+    # Export the decoding table of the matrix pooling: the pools of every tube
+    if not ctx.is_simulating() and POOLING == 'matriz':
+        with open(pool_map_path, 'w') as f:
+            f.write('source\tsource_well\trow_pool\tcolumn_pool\n')
+            for pool, s, dests in transfer_plan:
+                f.write('\t'.join([rack_name(s, pool), str(s).split(' ')[0]] + [str(d).split(' ')[0] for d, vol in dests]) + '\n')
+
     # Export the time log to a tsv file
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
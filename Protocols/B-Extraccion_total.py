@@ -0,0 +1,1264 @@
+import math
+import copy
+import os
+from opentrons.types import Point
+from opentrons import protocol_api
+import time
+import numpy as np
+from timeit import default_timer as timer
+import json
+import hashlib
+import jsonschema
+from opentrons_shared_data import load_shared_data
+from datetime import datetime
+import csv
+
+
+# metadata
+metadata = {
+    'protocolName': 'Station B - RNA extraction - Kit engine',
+    'author': 'Aitor Gastaminza & José Luis Villanueva & Alex Gasulla & Manuel Alba & Daniel Peñil & David Martínez',
+    'source': 'HU Central de Asturias',
+    'apiLevel': '2.5',
+    'description': 'Protocol for RNA extraction built from the operations of the selected kit'
+}
+
+################################################
+# CHANGE THESE VARIABLES ONLY
+################################################
+KIT                                 = 'Generico' # Generico, Bikop, Magmax, MagnaPure32 or Lisis_un_paso
+FINAL_PLATE                         = 'Placa' # Placa or Pitufos
+NUM_SAMPLES                         = 96    # Must be multiple of 8
+TIP_RECYCLING_IN_WASH               = True
+TIP_RECYCLING_IN_ELUTION            = True
+PHOTOSENSITIVE                      = False # True if it has photosensitive reagents
+TIP_DISPOSAL_SLOT                   = None  # Slot of an empty tip rack to drop the used tips near the plates, e.g. '2' with Placa. None for the fixed trash
+TEMPERATURE_MODULE_SLOT             = None  # Slot of a temperature module that heats the eluent during the drying, e.g. '3' instead of its tip rack. None for room temperature
+################################################
+
+run_id                      = 'B_Extraccion_total_' + KIT
+
+recycle_tip                 = False     # Do you want to recycle tips? It shoud only be set True for testing
+mag_height                  = 7         # Height needed for NEST deepwell in magnetic deck
+deepwell_labware            = 'nest_96_wellplate_2ml_deep' # Deepwell plate on the magnetic deck
+waste_drop_height           = 15        # Maximum dispense height over the waste reservoir top
+waste_drop_clearance        = 10        # Dispense height over the waste liquid level
+waste_min_drop_height       = 2         # Minimum dispense height over the waste reservoir top
+waste_max_volume            = 180000    # Usable volume of the 195 ml waste reservoir
+waste_area                  = 106.8 * 71.2 #Cross section of the waste reservoir
+waste_depth                 = 25        # Depth of the waste reservoir
+multi_well_rack_area        = 8 * 71    #Cross section of the 12 well reservoir
+deepwell_area               = 8.2 * 8.2 # Cross section of the NEST deepwell wells
+non_contact_drop_height     = -5        # Lowest dispense height from the deepwell top that never touches the sample
+temperature_range           = (4, 95)   # Temperatures reached by the temperature module Gen2
+heated_well_volume          = 200       # Capacity of the strip tubes of the aluminum block on the temperature module
+heated_dead_vol             = 10        # Eluent left in each strip tube of the aluminum block
+heated_pickup_height        = 1         # Pickup height in the strip tubes of the aluminum block
+heated_hold_time            = 120       # Seconds after the block reaches the temperature, for the eluent in the tubes to follow it
+home_at_end                 = False     # The gantry already rests over the trash or the tip bin after the last tip drop
+gantry_speed                = 400       # Default gantry speed in mm/s, to estimate the travel saved by the tip bin
+home_time                   = 15        # Estimated seconds of a robot home
+step_log_time               = 2         # Estimated seconds of the log comments of a step
+well_count                  = 0         # First reservoir well to use
+
+num_cols = math.ceil(NUM_SAMPLES / 8) # Columns we are working on
+
+################################################
+# Kit operations
+################################################
+class Operation:
+    magnet = None # Magnet state needed by the operation: True engaged, False disengaged, None any
+
+    def __init__(self, description, reagents = [], wait_time = 0):
+        self.description = description
+        self.reagents = reagents # The operation is disabled if these reagents have no volume
+        self.wait_time = wait_time
+
+class AddReagent(Operation):
+    magnet = False
+
+    def __init__(self, description, reagent, num_mixes, mix_height = 1.5, mix_volume = 180, mix_drop_height = -1,
+        mix_wait_time = 0, two_thirds_mix_bottom = True, x_offset_rs = 2.5, drop_height = -5, blow_out = False,
+        well_first_time_num_mixes = 0, well_num_mixes = 0, tip_recycling = 'none', single_tip = False):
+        Operation.__init__(self, description, reagents = [reagent])
+        self.reagent = reagent
+        self.num_mixes = num_mixes
+        self.mix_height = mix_height
+        self.mix_volume = mix_volume # None to mix with the reagent volume
+        self.mix_drop_height = mix_drop_height
+        self.mix_wait_time = mix_wait_time
+        self.two_thirds_mix_bottom = two_thirds_mix_bottom
+        self.x_offset_rs = x_offset_rs
+        self.drop_height = drop_height
+        self.blow_out = blow_out
+        self.well_first_time_num_mixes = well_first_time_num_mixes # Mixes of a new reservoir well before aspirating
+        self.well_num_mixes = well_num_mixes
+        self.tip_recycling = tip_recycling # none, wash or elution
+        self.single_tip = single_tip # One tip adds the reagent to every column from the top, then every column is mixed with its own tip
+
+class Elute(AddReagent):
+    def __init__(self, description, reagent, num_mixes, mix_height = 1, mix_volume = None, mix_drop_height = -35,
+        two_thirds_mix_bottom = False, drop_height = -35, tip_recycling = 'elution', temperature = None, **kwargs):
+        AddReagent.__init__(self, description, reagent, num_mixes, mix_height = mix_height, mix_volume = mix_volume,
+            mix_drop_height = mix_drop_height, two_thirds_mix_bottom = two_thirds_mix_bottom, drop_height = drop_height,
+            tip_recycling = tip_recycling, **kwargs)
+        # Eluent temperature with a temperature module (TEMPERATURE_MODULE_SLOT), reached during the drying.
+        # No kit sets it yet: it adds time until a shorter heated_wait_time is validated for the kit
+        self.temperature = temperature
+
+class Incubate(Operation):
+    magnet = True
+
+    def __init__(self, wait_time, description = 'Incubación con el imán ON', reagents = [], heated_wait_time = None):
+        Operation.__init__(self, description, reagents = reagents, wait_time = wait_time)
+        self.settling_time = wait_time # Part of wait_time for the beads to settle, kept when merged with other waits
+        self.heated_wait_time = heated_wait_time # Settling time instead of wait_time after a heated elution, only once validated for the kit
+
+class Dry(Operation):
+    def __init__(self, wait_time, description = 'Secado'):
+        Operation.__init__(self, description, wait_time = wait_time)
+
+class RemoveSupernatant(Operation):
+    magnet = True
+
+    def __init__(self, reagents, description = 'Desechar sobrenadante', tips_from = None, blow_out = False,
+        bulk_flow_rate = None, tail_volume = 60, tail_flow_rate = None, bulk_clearance = 2):
+        Operation.__init__(self, description, reagents = reagents)
+        self.tips_from = tips_from # Reagent whose recycled tips are reused
+        self.blow_out = blow_out
+        # Two-phase removal: with a bulk_flow_rate the trips that leave at least tail_volume in the well are
+        # aspirated at that rate, bulk_clearance mm under the tracked liquid level. Only the tail is aspirated
+        # next to the pellet, at tail_flow_rate (None for the Sample rate). None removes everything at the Sample rate
+        self.bulk_flow_rate = bulk_flow_rate
+        self.tail_volume = tail_volume
+        self.tail_flow_rate = tail_flow_rate
+        self.bulk_clearance = bulk_clearance
+
+class Transfer(Operation):
+    magnet = True
+
+    def __init__(self, volume, description = 'Transferir elución a la placa final', tips_from = 'Elution',
+        pickup_height = 1, drop_height = 3):
+        Operation.__init__(self, description)
+        self.volume = volume
+        self.tips_from = tips_from
+        self.pickup_height = pickup_height
+        self.drop_height = drop_height
+
+class MagnetChange(Operation):
+    # Inserted by compile_operations, kits do not need to declare it
+    def __init__(self, engage):
+        Operation.__init__(self, 'Imán ON' if engage else 'Imán OFF')
+        self.engage = engage
+
+def compile_operations(operations, reagent_volumes):
+    '''
+    Compile the kit operations into the steps to run. Disabled operations are dropped, the magnet
+    is only engaged or disengaged where its state changes, inside the step of the operation that
+    needs it, and consecutive waits are merged into a single one.
+    Every step is a list of operations run under the same STEPS entry.
+    '''
+    program = []
+    magnet = False # The magnet is disengaged at start
+    for op in operations:
+        if op.reagents and sum([reagent_volumes[r] for r in op.reagents]) <= 0:
+            continue
+        step = []
+        if op.magnet is not None and op.magnet != magnet:
+            magnet = op.magnet
+            step.append(MagnetChange(magnet))
+        last = program[-1][-1] if program else None
+        if (not step and isinstance(op, (Incubate, Dry)) and isinstance(last, (Incubate, Dry))):
+            merged = copy.copy(last)
+            merged.wait_time = last.wait_time + op.wait_time
+            merged.description = last.description + ' + ' + op.description
+            program[-1][-1] = merged
+            continue
+        step.append(op)
+        program.append(step)
+    return program
+
+################################################
+# Kit profiles
+################################################
+OPERATION_TYPES = {
+    'AddReagent': AddReagent,
+    'Elute': Elute,
+    'Incubate': Incubate,
+    'Dry': Dry,
+    'RemoveSupernatant': RemoveSupernatant,
+    'Transfer': Transfer
+    }
+SETTLING_COEFFICIENTS = ['intercept', 'log_time', 'log_height', 'mag_height']
+REAGENT_KEYS = ['flow_rate_aspirate', 'flow_rate_dispense', 'flow_rate_aspirate_mix', 'flow_rate_dispense_mix',
+    'air_gap_vol_bottom', 'air_gap_vol_top', 'disposal_volume', 'rinse', 'max_volume_allowed', 'reagent_volume',
+    'h_cono', 'v_fondo', 'tip_recycling', 'dead_vol', 'first_well']
+
+# Profile of KIT embedded in the protocol by Utils/Empaquetar_kit.py. The robot app and opentrons_simulate
+# only get this file, without the Kits folder next to it
+KIT_PROFILE = None
+
+# Folders where the kit profiles are looked for when none is embedded: next to this file and in the robot notebooks
+kit_folders = ['/var/lib/jupyter/notebooks/Kits']
+if '__file__' in globals():
+    kit_folders.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Kits'))
+
+def validate_kit(profile):
+    '''
+    Check a kit profile, returning the list of errors found
+    '''
+    errors = []
+    for key in ['VOLUME_SAMPLE', 'reagent_defaults', 'reagents', 'final_plates', 'operations']:
+        if key not in profile:
+            errors.append('Falta el campo ' + key)
+    if errors:
+        return errors
+    if profile['VOLUME_SAMPLE'] <= 0:
+        errors.append('El volumen de muestra debe ser positivo')
+    reagent_names = list(profile['reagents']) + ['Sample']
+    for key in profile['reagent_defaults']:
+        if key not in REAGENT_KEYS:
+            errors.append('Propiedad desconocida en reagent_defaults: ' + key)
+    for name, reagent in profile['reagents'].items():
+        for key in reagent:
+            if key not in REAGENT_KEYS:
+                errors.append('Propiedad desconocida en el reactivo ' + name + ': ' + key)
+        if reagent.get('reagent_volume', -1) < 0:
+            errors.append('El reactivo ' + name + ' necesita un reagent_volume no negativo')
+        if not 1 <= reagent.get('first_well', 1) <= 12:
+            errors.append('Canal inicial inválido para el reactivo ' + name + ': ' + str(reagent['first_well']))
+    if FINAL_PLATE not in profile['final_plates']:
+        errors.append('El kit no define la placa final ' + FINAL_PLATE)
+    for i, params in enumerate(profile['operations']):
+        params = dict(params)
+        op_type = params.pop('type', None)
+        if op_type not in OPERATION_TYPES:
+            errors.append('Operación ' + str(i + 1) + ': tipo desconocido ' + str(op_type))
+            continue
+        try:
+            op = OPERATION_TYPES[op_type](**params)
+        except TypeError as e:
+            errors.append('Operación ' + str(i + 1) + ' (' + op_type + '): ' + str(e))
+            continue
+        for name in op.reagents + [getattr(op, 'tips_from', None) or 'Sample']:
+            if name not in reagent_names:
+                errors.append('Operación ' + str(i + 1) + ' (' + op_type + '): reactivo desconocido ' + name)
+        if getattr(op, 'single_tip', False) and op.drop_height < non_contact_drop_height:
+            errors.append('Operación ' + str(i + 1) + ' (' + op_type + '): single_tip necesita dispensar sin tocar la muestra, con drop_height >= ' + str(non_contact_drop_height))
+        if getattr(op, 'temperature', None) is not None and not temperature_range[0] <= op.temperature <= temperature_range[1]:
+            errors.append('Operación ' + str(i + 1) + ' (' + op_type + '): temperatura fuera del rango del módulo ' + str(temperature_range))
+        if getattr(op, 'heated_wait_time', None) is not None and not 0 <= op.heated_wait_time <= op.wait_time:
+            errors.append('Operación ' + str(i + 1) + ' (' + op_type + '): heated_wait_time debe estar entre 0 y wait_time')
+    if 'settling' in profile:
+        model = profile['settling']
+        for key in ['bead', 'labware', 'coefficients']:
+            if key not in model:
+                errors.append('Falta el campo settling.' + key)
+        if model.get('labware', deepwell_labware) != deepwell_labware:
+            errors.append('El modelo de sedimentación está ajustado para ' + model['labware'] + ' y no para ' + deepwell_labware)
+        for key in SETTLING_COEFFICIENTS:
+            if key not in model.get('coefficients', {}):
+                errors.append('Falta el coeficiente settling.coefficients.' + key)
+        if model.get('coefficients', {}).get('log_time', 1) <= 0:
+            errors.append('El coeficiente log_time debe ser positivo: las bolas sedimentan con el tiempo')
+        if not 0 < model.get('confidence', 0.95) < 1:
+            errors.append('La confianza del modelo de sedimentación debe estar entre 0 y 1')
+    return errors
+
+def settling_time(model, volume, max_wait_time):
+    '''
+    Shortest magnet incubation that clears the wells with the confidence of the settling model of the kit,
+    for the liquid volume of every deepwell well. The model is a logistic regression fitted with
+    Utils/Ajustar_sedimentacion.py:
+        logit(P(clear)) = intercept + log_time * ln(seconds) + log_height * ln(liquid height) + mag_height * mag_height
+    The result is kept between min_wait_time and the fixed incubation time of the kit.
+    No kit ships a settling block: every kit uses its fixed times until the model is fitted with
+    the observations of the operators and its block is added to the profile.
+    '''
+    c = model['coefficients']
+    confidence = model.get('confidence', 0.95)
+    height = max(volume, 1) / deepwell_area
+    logit = math.log(confidence / (1 - confidence))
+    seconds = math.exp((logit - c['intercept'] - c['log_height'] * math.log(height) - c['mag_height'] * mag_height) / c['log_time'])
+    return min(max_wait_time, max(model.get('min_wait_time', 60), math.ceil(seconds)))
+
+def load_kit(name):
+    '''
+    Load, validate and parse the profile of the kit, the embedded one or the one in the kit folders
+    '''
+    if KIT_PROFILE is not None:
+        if KIT_PROFILE.get('kit') != name:
+            raise Exception('El perfil empaquetado es del kit ' + str(KIT_PROFILE.get('kit')) + ' y no de ' + name +
+                ': vuelve a empaquetarlo con python Utils/Empaquetar_kit.py ' + name)
+        profile = KIT_PROFILE
+    else:
+        for folder in kit_folders:
+            path = os.path.join(folder, name + '.json')
+            if os.path.isfile(path):
+                break
+        else:
+            raise Exception('No se encuentra el perfil del kit ' + name + ' en ' + ', '.join(kit_folders) +
+                '. Empaqueta el kit en el protocolo con python Utils/Empaquetar_kit.py ' + name +
+                ' o copia Protocols/Kits a /var/lib/jupyter/notebooks/Kits en el robot')
+        with open(path) as f:
+            profile = json.load(f)
+    errors = validate_kit(profile)
+    if errors:
+        return profile, errors
+    reagents = {}
+    for reagent, props in profile['reagents'].items():
+        reagents[reagent] = dict(profile['reagent_defaults'], **props)
+    operations = []
+    for params in profile['operations']:
+        params = dict(params)
+        operations.append(OPERATION_TYPES[params.pop('type')](**params))
+    kit = dict(profile, reagents = reagents, operations = operations, final_plate = profile['final_plates'][FINAL_PLATE])
+    return kit, []
+
+################################################
+# Custom labware
+################################################
+# Folders where the custom labware definitions are looked for: in the repository and in the robot notebooks
+labware_folders = ['/var/lib/jupyter/notebooks/CustomLabware']
+if '__file__' in globals():
+    labware_folders.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CustomLabware'))
+
+# Only this protocol loads its custom labware through the registry. The legacy B-Placa and B-Pitufos scripts and the
+# C protocols load it by name with ctx.load_labware, and the CustomLabware test protocols read their own definition
+labware_cache = {} # Parsed definitions by content hash
+labware_registry = {} # Content hash of the definition of every custom labware by load name
+
+def validate_labware_definition(definition):
+    '''
+    Check a labware definition against the labware schema (version 2) of opentrons_shared_data,
+    returning the list of errors found
+    '''
+    schema = json.loads(load_shared_data('labware/schemas/2.json'))
+    validator = jsonschema.Draft7Validator(schema)
+    return [('/'.join(str(p) for p in error.path) + ': ' if error.path else '') + error.message
+        for error in validator.iter_errors(definition)]
+
+def load_labware_definitions():
+    '''
+    Read every custom labware definition once. Definitions are parsed and validated only the first
+    time their content is seen; the first folder wins for every load name.
+    Returns the list of errors found.
+    '''
+    errors = []
+    if labware_registry:
+        return errors
+    for folder in labware_folders:
+        if not os.path.isdir(folder):
+            continue
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith('.json'):
+                continue
+            with open(os.path.join(folder, file_name), 'rb') as f:
+                content = f.read()
+            key = hashlib.sha256(content).hexdigest()
+            if key not in labware_cache:
+                definition = json.loads(content.decode('utf-8'))
+                definition_errors = validate_labware_definition(definition)
+                if definition_errors:
+                    errors += [file_name + ': ' + e for e in definition_errors]
+                    continue
+                labware_cache[key] = {'definition': definition}
+            labware_registry.setdefault(labware_cache[key]['definition']['parameters']['loadName'], key)
+    return errors
+
+def custom_labware(name):
+    '''
+    Cached definition of a custom labware, or None if it is not in the custom labware folders
+    '''
+    if not labware_registry:
+        errors = load_labware_definitions()
+        if errors:
+            raise Exception('Definiciones de labware inválidas: ' + '; '.join(errors))
+    if name in labware_registry:
+        return labware_cache[labware_registry[name]]
+    return None
+
+def load_labware(ctx, name, slot, label = None):
+    '''
+    Load custom labware from its cached definition, so it does not depend on the labware uploaded to the app.
+    Any other labware is loaded by name.
+    '''
+    labware = custom_labware(name)
+    if labware is not None:
+        return ctx.load_labware_from_definition(labware['definition'], slot, label)
+    return ctx.load_labware(name, slot, label)
+
+def run(ctx: protocol_api.ProtocolContext):
+    recycled_tips               = {} # Tip positions of every reagent added with tip recycling
+    settling                    = {'volume': 0}
+
+    ctx.comment('Columnas a utilizar: '+str(num_cols))
+
+    kit, errors = load_kit(KIT)
+    if errors:
+        for error in errors:
+            ctx.comment('ERROR: ' + error)
+        raise Exception('El perfil del kit ' + KIT + ' no es válido')
+    ctx.comment('Kit: ' + KIT + ' (' + kit.get('protocolName', KIT) + ')')
+    VOLUME_SAMPLE = kit['VOLUME_SAMPLE'] # Volume received from station A
+    settling['volume'] = VOLUME_SAMPLE # Liquid volume in every deepwell well, for the settling model
+
+    reagent_volumes = {'Sample': VOLUME_SAMPLE}
+    for name in kit['reagents']:
+        reagent_volumes[name] = kit['reagents'][name]['reagent_volume']
+    program = compile_operations(kit['operations'], reagent_volumes)
+
+    # Eluent heated in strip tubes on the aluminum block of the temperature module, when the kit heats it and the module is on the deck
+    heated_elutions = [op for step in program for op in step if isinstance(op, Elute) and op.temperature is not None]
+    heating = {'module': None, 'reservoir': None, 'reagent': None, 'temperature': None, 'started': False, 'heated': False, 'saved': 0, 'added': 0}
+    if TEMPERATURE_MODULE_SLOT is not None and heated_elutions:
+        heating['reagent'] = heated_elutions[0].reagent
+        heating['temperature'] = heated_elutions[0].temperature
+
+    STEP = 0
+    STEPS = {} #Dictionary with STEP activation, description, and times
+    for i, step in enumerate(program):
+        STEPS[i + 1] = {'Execute': True, 'description': step[-1].description}
+        if step[-1].wait_time > 0:
+            STEPS[i + 1]['wait_time'] = step[-1].wait_time
+
+    # Magnet changes run inside the step that needs them instead of in their own step
+    fused_steps = len([op for step in program for op in step if isinstance(op, MagnetChange) and not op.engage])
+    saved_time = fused_steps * step_log_time + (0 if home_at_end else home_time)
+    # Not measured: it assumes step_log_time seconds of log comments per step and home_time seconds for the final home
+    ctx.comment('Pasos Imán OFF fusionados: ' + str(fused_steps) + '. Tiempo ahorrado estimado, no medido: ' + str(saved_time) + ' segundos (' +
+        str(step_log_time) + ' s de registro por paso' + ('' if home_at_end else ' y ' + str(home_time) + ' s del home final') + ')')
+
+    #Folder and file_path for log time
+    folder_path = '/var/lib/jupyter/notebooks/' + run_id
+    if not ctx.is_simulating():
+        if not os.path.isdir(folder_path):
+            os.mkdir(folder_path)
+        file_path = folder_path + '/Station_B_Extraccion_total_time_log.txt'
+        map_path = folder_path + '/Station_B_Extraccion_total_well_map.txt'
+
+    #Define Reagents as objects with their properties
+    class Reagent:
+        def calc_vol_well(self):
+            if(self.name == 'Sample'):
+                self.num_wells = num_cols
+                return VOLUME_SAMPLE
+            else:
+                trips = math.ceil(self.reagent_volume / self.max_volume_allowed)
+                vol_trip = self.reagent_volume / trips * 8
+                max_trips_well = math.floor(11000 / vol_trip)
+                total_trips = num_cols * trips
+                self.num_wells = math.ceil(total_trips / max_trips_well)
+                return math.ceil(total_trips / self.num_wells) * vol_trip + self.dead_vol
+
+        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, flow_rate_aspirate_mix, flow_rate_dispense_mix,
+        air_gap_vol_bottom, air_gap_vol_top, disposal_volume, rinse, max_volume_allowed, reagent_volume, h_cono, v_fondo, tip_recycling = 'none', dead_vol = 700, first_well = None):
+            self.name = name
+            self.flow_rate_aspirate = flow_rate_aspirate
+            self.flow_rate_dispense = flow_rate_dispense
+            self.flow_rate_aspirate_mix = flow_rate_aspirate_mix
+            self.flow_rate_dispense_mix = flow_rate_dispense_mix
+            self.air_gap_vol_bottom = air_gap_vol_bottom
+            self.air_gap_vol_top = air_gap_vol_top
+            self.disposal_volume = disposal_volume
+            self.rinse = bool(rinse)
+            self.max_volume_allowed = max_volume_allowed
+            self.reagent_volume = reagent_volume
+            self.col = 0
+            self.vol_well = 0
+            self.h_cono = h_cono
+            self.v_cono = v_fondo
+            self.tip_recycling = tip_recycling
+            self.dead_vol = dead_vol
+            self.first_well = first_well
+            self.vol_well_original = self.calc_vol_well() if reagent_volume * NUM_SAMPLES > 0 else 0
+
+    #Reagents and their characteristics, as defined in the kit profile
+    reagents = {}
+    for name in kit['reagents']:
+        reagents[name] = Reagent(name = name, **kit['reagents'][name])
+        reagents[name].vol_well = reagents[name].vol_well_original
+
+    Sample = Reagent(name = 'Sample',
+                    flow_rate_aspirate = 5, # Original 0.5
+                    flow_rate_dispense = 100, # Original 1
+                    flow_rate_aspirate_mix = 1,
+                    flow_rate_dispense_mix = 1,
+                    air_gap_vol_bottom = 5,
+                    air_gap_vol_top = 0,
+                    disposal_volume = 1,
+                    rinse = False,
+                    max_volume_allowed = 180,
+                    reagent_volume = VOLUME_SAMPLE,
+                    h_cono = 4,
+                    v_fondo = 4 * math.pi * 4**3 / 3) #Sphere
+    reagents['Sample'] = Sample
+
+    Sample.vol_well     = 350 # Arbitrary value
+
+    # Liquid volume per sample sent to the waste in every supernatant removal step
+    waste_plan = {}
+    for s in STEPS:
+        if isinstance(program[s - 1][-1], RemoveSupernatant):
+            waste_plan[s] = sum([reagents[r].reagent_volume for r in program[s - 1][-1].reagents])
+
+    #Waste reservoir and its volume ledger
+    class WasteReservoir:
+        def __init__(self, max_volume, area, depth, max_drop_height, clearance, min_drop_height):
+            self.max_volume = max_volume
+            self.area = area
+            self.depth = depth
+            self.max_drop_height = max_drop_height
+            self.min_drop_height = min_drop_height
+            self.clearance = clearance
+            self.vol = 0
+            self.empty_before = [] # Supernatant removal steps that need an empty waste reservoir
+
+        def plan(self, waste_plan):
+            '''
+            Predict the waste volume of every supernatant removal step and schedule the
+            emptying of the reservoir before the step that would overflow it. A step that
+            overflows the empty reservoir on its own cannot be scheduled
+            '''
+            vol = self.vol
+            total = 0
+            errors = []
+            for step in sorted(waste_plan):
+                if STEPS[step]['Execute'] == True:
+                    step_vol = waste_plan[step] * 8 * num_cols
+                    if step_vol > self.max_volume:
+                        errors.append('los residuos del paso ' + str(step) + ' (' + str_rounded(step_vol) + ' uL) no caben en el reservorio de residuos (' +
+                            str_rounded(self.max_volume) + ' uL)')
+                    if vol + step_vol > self.max_volume and vol > 0:
+                        self.empty_before.append(step)
+                        vol = 0
+                    vol += step_vol
+                    total += step_vol
+            if errors:
+                raise Exception('Residuos inválidos: ' + '; '.join(errors))
+            return total
+
+        def add(self, vol):
+            self.vol += vol
+
+        def drop_height(self):
+            # Dispense height from the top, following the liquid level but never inside the reservoir
+            height = self.vol / self.area - self.depth + self.clearance
+            if height > self.max_drop_height:
+                height = self.max_drop_height
+            if height < self.min_drop_height:
+                height = self.min_drop_height
+            return height
+
+    ctx.comment(' ')
+    ctx.comment('###############################################')
+    ctx.comment('VALORES DE VARIABLES')
+    ctx.comment(' ')
+    ctx.comment('Número de muestras: ' + str(NUM_SAMPLES))
+    ctx.comment('Volumen de muestra en el deepwell: ' + str(VOLUME_SAMPLE) + ' ul')
+    for name in kit['reagents']:
+        ctx.comment('Volumen de ' + name + ' por muestra: ' + str(reagent_volumes[name]) + ' ul')
+    ctx.comment('Placa final: ' + FINAL_PLATE)
+    ctx.comment('Reciclado de puntas en los lavados activado: ' + str(TIP_RECYCLING_IN_WASH))
+    ctx.comment('Reciclado de puntas en la elución activado: ' + str(TIP_RECYCLING_IN_ELUTION))
+    ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE))
+    if 'settling' in kit:
+        ctx.comment('Incubaciones con el modelo de sedimentación de ' + kit['settling']['bead'])
+    else:
+        ctx.comment('Incubaciones con los tiempos fijos del kit: no tiene modelo de sedimentación')
+    if heating['reagent'] is not None:
+        ctx.comment(heating['reagent'] + ' calentada a ' + format(heating['temperature']) + ' ºC en el módulo de temperatura del slot ' + TEMPERATURE_MODULE_SLOT)
+    elif TEMPERATURE_MODULE_SLOT is not None:
+        ctx.comment('El kit no calienta la elución, no se usa el módulo de temperatura del slot ' + TEMPERATURE_MODULE_SLOT)
+    ctx.comment(' ')
+
+    #########
+    def str_rounded(num):
+        return str(int(num + 0.5))
+
+    ###################
+    #Custom functions
+    location_cache = {}
+
+    def well_location(well, end, z, x_offset = 0):
+        '''
+        Location at the top or bottom of a well, moved x_offset mm to the side. Each location is
+        computed once per run and reused by the mix and transfer loops. Wells live for the whole
+        run, so their id is a stable key
+        '''
+        key = (id(well), end, z, x_offset)
+        if key not in location_cache:
+            location = well.top(z = z) if end == 'top' else well.bottom(z = z)
+            if x_offset != 0:
+                location = location.move(Point(x = x_offset))
+            location_cache[key] = location
+        return location_cache[key]
+
+    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height, offset, wait_time = 0, drop_height = -1, two_thirds_mix_bottom = False):
+        '''
+        Function for mix in the same location a certain number of rounds. Blow out optional. Offset
+        can set to 0 or a higher/lower value which indicates the lateral movement
+        '''
+        if mix_height <= 0:
+            mix_height = 1
+        pipet.aspirate(1, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_aspirate_mix)
+        for i in range(rounds):
+            pipet.aspirate(vol, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_aspirate_mix)
+            if two_thirds_mix_bottom and i < ((rounds / 3) * 2):
+                pipet.dispense(vol, location = well_location(location, 'bottom', 5, offset), rate = reagent.flow_rate_dispense_mix)
+            else:
+                pipet.dispense(vol, location = well_location(location, 'top', drop_height, offset), rate = reagent.flow_rate_dispense_mix)
+        pipet.dispense(1, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_dispense_mix)
+        if blow_out == True:
+            pipet.blow_out(well_location(location, 'top', -2)) # Blow out
+        if wait_time != 0:
+            ctx.delay(seconds=wait_time, msg='Esperando durante ' + str(wait_time) + ' segundos.')
+
+    def calc_height(reagent, cross_section_area, aspirate_volume, min_height = 0.4):
+        nonlocal ctx
+        ctx.comment('Volumen útil restante ' + str(reagent.vol_well - reagent.dead_vol) +
+                    ' < volumen necesario ' + str(aspirate_volume - Sample.disposal_volume * 8) + '?')
+        if (reagent.vol_well - reagent.dead_vol + 1) < (aspirate_volume - Sample.disposal_volume * 8):
+            ctx.comment('Se debe utilizar el siguiente canal')
+            ctx.comment('Canal anterior: ' + str(reagent.col))
+            # column selector position; intialize to required number
+            reagent.col = reagent.col + 1
+            ctx.comment(str('Nuevo canal: ' + str(reagent.col)))
+            reagent.vol_well = reagent.vol_well_original
+            ctx.comment('Nuevo volumen:' + str(reagent.vol_well))
+            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+                    #- reagent.h_cono
+            reagent.vol_well = reagent.vol_well - (aspirate_volume - Sample.disposal_volume * 8)
+            ctx.comment('Volumen restante:' + str(reagent.vol_well))
+            if height < min_height:
+                height = min_height
+            col_change = True
+        else:
+            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+            reagent.vol_well = reagent.vol_well - (aspirate_volume - (Sample.disposal_volume * 8))
+            ctx.comment('La altura calculada es ' + str(height))
+            if height < min_height:
+                height = min_height
+            ctx.comment('La altura usada es ' + str(height))
+            col_change = False
+        return height, col_change
+
+    def move_vol_multi(pipet, reagent, source, dest, vol, x_offset_source, x_offset_dest, pickup_height, rinse,
+        avoid_droplet, wait_time, blow_out, touch_tip = False, touch_tip_v_offset = 0, drop_height = -5,
+        aspirate_with_x_scroll = False, dispense_bottom_air_gap_before = False, aspirate_rate = None):
+        # Rinse before aspirating
+        if rinse == True:
+            custom_mix(pipet, reagent, location = source, vol = vol, rounds = 20, blow_out = False, mix_height = 3, offset = 0)
+
+        # SOURCE
+        if dispense_bottom_air_gap_before and reagent.air_gap_vol_bottom:
+            pipet.dispense(reagent.air_gap_vol_bottom, well_location(source, 'top', -2), rate = reagent.flow_rate_dispense)
+
+        if reagent.air_gap_vol_top != 0: #If there is air_gap_vol, switch pipette to slow speed
+            pipet.move_to(well_location(source, 'top', 0))
+            pipet.air_gap(reagent.air_gap_vol_top) #air gap
+
+        if aspirate_with_x_scroll:
+            aspirate_with_x_scrolling(pip = pipet, volume = vol, src = source, pickup_height = pickup_height, rate = reagent.flow_rate_aspirate, start_x_offset_src = 0, stop_x_offset_src = x_offset_source)
+        else:
+            s = well_location(source, 'bottom', pickup_height, x_offset_source)
+            pipet.aspirate(vol, s, rate = aspirate_rate or reagent.flow_rate_aspirate) # aspirate liquid
+
+        if reagent.air_gap_vol_bottom != 0: #If there is air_gap_vol, switch pipette to slow speed
+            pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
+
+        if avoid_droplet == True: # Touch the liquid surface to avoid droplets
+            ctx.comment("Moviendo a: " + str(pickup_height))
+            pipet.move_to(well_location(source, 'bottom', pickup_height))
+
+        # GO TO DESTINATION
+        d = well_location(dest, 'top', drop_height, x_offset_dest)
+        pipet.dispense(vol - reagent.disposal_volume + reagent.air_gap_vol_bottom, d, rate = reagent.flow_rate_dispense)
+
+        if reagent.air_gap_vol_top != 0:
+            pipet.dispense(reagent.air_gap_vol_top, well_location(dest, 'top', 0), rate = reagent.flow_rate_dispense)
+
+        if blow_out == True:
+            pipet.blow_out(well_location(dest, 'top', drop_height))
+
+        if touch_tip == True:
+            pipet.touch_tip(speed = 20, v_offset = touch_tip_v_offset, radius=0.7)
+
+        if wait_time != 0:
+            ctx.delay(seconds=wait_time, msg='Esperando durante ' + str(wait_time) + ' segundos.')
+
+    def aspirate_with_x_scrolling(pip, volume, src, pickup_height = 0, rate = 1, start_x_offset_src = 0, stop_x_offset_src = 0):
+
+        max_asp = volume/pip.min_volume
+        inc_step = (start_x_offset_src - stop_x_offset_src) / max_asp
+
+        for x in reversed(np.arange(stop_x_offset_src, start_x_offset_src, inc_step)):
+            s = well_location(src, 'bottom', pickup_height, x)
+            pip.aspirate(volume = pip.min_volume, location = s, rate = rate)
+
+    ##########
+    # pick up tip and if there is none left, prompt user for a new rack
+    def pick_up(pip, position = None):
+        nonlocal tip_track
+        #if not ctx.is_simulating():
+        if recycle_tip:
+            pip.pick_up_tip(tips300[0].wells()[0])
+        else:
+            if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
+                for i in range(3):
+                    ctx._hw_manager.hardware.set_lights(rails=False)
+                    ctx._hw_manager.hardware.set_lights(button=(1, 0 ,0))
+                    time.sleep(0.3)
+                    ctx._hw_manager.hardware.set_lights(rails=True)
+                    ctx._hw_manager.hardware.set_lights(button=(0, 0 ,1))
+                    time.sleep(0.3)
+                ctx._hw_manager.hardware.set_lights(button=(0, 1 ,0))
+                ctx.pause('Reemplaza las cajas de puntas de ' + str(pip.max_volume) + 'µl antes \
+                de continuar.')
+                pip.reset_tipracks()
+                tip_track['counts'][pip] = 0
+                tip_track['num_refills'][pip] += 1
+            if position is None:
+                pip.pick_up_tip()
+            else:
+                pip.pick_up_tip(position)
+
+    def bin_position(pip):
+        # Next free position of the tip bin for all the channels of the pipette, None if it is full
+        rack = tip_bin['rack']
+        if pip.channels == 1:
+            # Single tips fill the bin from the end, leaving whole columns for the multichannel
+            candidates = [[well] for well in reversed(rack.wells())]
+        else:
+            candidates = rack.columns()
+        for wells in candidates:
+            if not any(well in tip_bin['used'] for well in wells):
+                return wells
+        return None
+
+    def drop_tip(pip):
+        '''
+        Drop the tip in the tip bin next to the plates, or in the fixed trash if there is no bin
+        or it is full. The travel saved is the round trip to the trash minus the one to the bin
+        '''
+        wells = bin_position(pip) if tip_bin['rack'] is not None else None
+        if wells is None:
+            if tip_bin['rack'] is not None and not tip_bin['full']:
+                tip_bin['full'] = True
+                ctx.comment('La papelera de puntas del slot ' + TIP_DISPOSAL_SLOT + ' está llena, se usa la papelera fija')
+            pip.drop_tip(home_after = False)
+            return
+        current = ctx.location_cache.point if ctx.location_cache else wells[0].top().point
+        trash = ctx.fixed_trash.wells()[0].top().point
+        target = wells[0].top().point
+        tip_bin['saved'] += 2 * (math.hypot(trash.x - current.x, trash.y - current.y) - math.hypot(target.x - current.x, target.y - current.y))
+        tip_bin['used'] += wells
+        pip.drop_tip(wells[0], home_after = False)
+
+    def start_run():
+        ctx.comment(' ')
+        ctx.comment('###############################################')
+        ctx.comment('Empezando protocolo')
+        if PHOTOSENSITIVE == False:
+            ctx._hw_manager.hardware.set_lights(button = True, rails =  True)
+        else:
+            ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
+        now = datetime.now()
+        # dd/mm/YY H:M:S
+        start_time = now.strftime("%Y/%m/%d %H:%M:%S")
+        return start_time
+
+    def finish_run():
+        ctx.comment('###############################################')
+        ctx.comment('Protocolo finalizado')
+        ctx.comment(' ')
+        #Set light color to blue
+        ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
+        now = datetime.now()
+        # dd/mm/YY H:M:S
+        finish_time = now.strftime("%Y/%m/%d %H:%M:%S")
+        if PHOTOSENSITIVE==False:
+            for i in range(10):
+                ctx._hw_manager.hardware.set_lights(button = False, rails =  False)
+                time.sleep(0.3)
+                ctx._hw_manager.hardware.set_lights(button = True, rails =  True)
+                time.sleep(0.3)
+        else:
+            for i in range(10):
+                ctx._hw_manager.hardware.set_lights(button = False, rails =  False)
+                time.sleep(0.3)
+                ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
+                time.sleep(0.3)
+        ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
+
+        if heating['heated']:
+            # Waits added for the temperature minus the incubation time saved, the ramp wait is not measured in a simulation
+            ctx.comment('Tiempo neto añadido por la elución en caliente: ' + str_rounded(heating['added'] - heating['saved']) + ' segundos (' +
+                str_rounded(heating['added']) + ' de espera de la temperatura, ' + str_rounded(heating['saved']) + ' de incubación ahorrados)')
+        if tip_bin['rack'] is not None:
+            ctx.comment('Recorrido ahorrado con la papelera de puntas: ' + str(round(tip_bin['saved'] / 1000, 1)) + ' m, unos ' + str_rounded(tip_bin['saved'] / gantry_speed) + ' segundos')
+        used_tips = tip_track['num_refills'][m300] * 96 * len(m300.tip_racks) + tip_track['counts'][m300]
+        ctx.comment('Puntas de 200 ul utilizadas: ' + str(used_tips) + ' (' + str(round(used_tips / 96, 2)) + ' caja(s))')
+        ctx.comment('###############################################')
+
+        return finish_time
+
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def elution_name(well):
+        # Elution plates are numbered when the kit uses more than one
+        if len(elution_plates) == 1:
+            return 'elution'
+        return 'elution ' + str(elution_plates.index(well.parent) + 1)
+
+    def log_step_start():
+        ctx.comment(' ')
+        ctx.comment('###############################################')
+        ctx.comment('PASO '+str(STEP)+': '+STEPS[STEP]['description'])
+        ctx.comment('###############################################')
+        ctx.comment(' ')
+        return datetime.now()
+
+    def log_step_end(start):
+        end = datetime.now()
+        time_taken = (end - start)
+        STEPS[STEP]['Time:'] = str(time_taken)
+
+        ctx.comment(' ')
+        ctx.comment('Paso ' + str(STEP) + ': ' +STEPS[STEP]['description'] + ' hizo un tiempo de ' + str(time_taken))
+        ctx.comment(' ')
+
+    def empty_waste_pause(removal_step, wait_time = 0):
+        '''
+        Pause to empty the waste reservoir if the waste plan requires it before removal_step.
+        Called during a magnet incubation, it only adds the time exceeding wait_time.
+        '''
+        if removal_step not in waste_ledger.empty_before:
+            return wait_time
+        waste_ledger.empty_before.remove(removal_step)
+        pause_start = datetime.now()
+        for i in range(3):
+            ctx._hw_manager.hardware.set_lights(rails=False)
+            ctx._hw_manager.hardware.set_lights(button=(1, 0 ,0))
+            time.sleep(0.3)
+            ctx._hw_manager.hardware.set_lights(rails=True)
+            ctx._hw_manager.hardware.set_lights(button=(0, 0 ,1))
+            time.sleep(0.3)
+        ctx._hw_manager.hardware.set_lights(button=(0, 1 ,0))
+        ctx.pause('Vacía el reservorio de residuos (' + str_rounded(waste_ledger.vol) + ' uL) antes de continuar.')
+        waste_ledger.vol = 0
+        elapsed = (datetime.now() - pause_start).total_seconds()
+        return max(0, round(wait_time - elapsed))
+
+    ##########
+    def find_side(col):
+        if col%2 == 0:
+            side = -1 # left
+        else:
+            side = 1 # right
+        return side
+
+    def assign_wells(reagent):
+        global well_count
+        if reagent.name == heating['reagent']: # One column of strip tubes on the aluminum block of the temperature module per sample column
+            well_volume = reagent.reagent_volume + reagent.disposal_volume + heated_dead_vol
+            if well_volume > heated_well_volume:
+                raise Exception(reagent.name + ': ' + str_rounded(well_volume) + ' uL por tubo no caben en los tubos del bloque del módulo de temperatura')
+            reagent.first_well = 1
+            reagent.num_wells = num_cols
+            reagent.vol_well_original = well_volume
+            reagent.reagent_reservoir = heating['reservoir'].rows()[0][:num_cols]
+            ctx.comment(reagent.name + ': ' + str(num_cols) + ' columnas de tiras desde la columna 1 en el bloque del módulo de temperatura con un volumen de ' + str_rounded(well_volume) + ' uL por tubo')
+            return
+        if reagent.first_well is not None: # Fixed reservoir layout of the kit
+            well_count = reagent.first_well - 1
+        reagent.first_well = well_count + 1
+        reagent.reagent_reservoir = reagent_res.rows()[0][well_count:well_count + reagent.num_wells]
+        well_count += reagent.num_wells
+        ctx.comment(reagent.name + ': ' + str(reagent.num_wells) + ' canales desde el canal '+ str(reagent.first_well) +' en el reservorio de 12 canales con un volumen de ' + str_rounded(reagent.vol_well_original) + ' uL cada uno')
+
+    ###################
+    # Kit operations
+    def magnet_change(op):
+        ctx.comment(op.description)
+        if op.engage:
+            magdeck.engage(height = mag_height)
+        else:
+            magdeck.disengage()
+
+    def heat_elution():
+        # Start the temperature ramp without waiting for it, it goes on while the beads dry
+        if heating['module'] is not None and not heating['started']:
+            heating['module'].start_set_temperature(heating['temperature'])
+            heating['started'] = True
+            ctx.comment('Calentando ' + heating['reagent'] + ' a ' + format(heating['temperature']) + ' ºC en el módulo de temperatura')
+
+    def incubate(op):
+        ctx.comment(' ')
+        if isinstance(op, Dry):
+            heat_elution()
+        wait_time = op.wait_time
+        if isinstance(op, Incubate):
+            # Only the settling part of the wait is shortened, other merged waits are kept
+            settling_max = op.settling_time
+            if heating['heated'] and op.heated_wait_time is not None:
+                settling_max = op.heated_wait_time
+                heating['saved'] += op.settling_time - op.heated_wait_time
+                ctx.comment('Elución a ' + format(heating['temperature']) + ' ºC: incubación de ' + format(settling_max) + ' segundos en lugar de ' + format(op.settling_time))
+            adapted = settling_max
+            if 'settling' in kit:
+                adapted = settling_time(kit['settling'], settling['volume'], settling_max)
+                ctx.comment('Sedimentación de ' + kit['settling']['bead'] + ' con ' + str_rounded(settling['volume']) + ' uL por pocillo: ' +
+                    str(adapted) + ' segundos en lugar de ' + format(settling_max))
+            wait_time = op.wait_time - op.settling_time + adapted
+            if wait_time != op.wait_time:
+                STEPS[STEP]['wait_time'] = wait_time
+        ctx.delay(seconds = empty_waste_pause(STEP + 1, wait_time), msg = op.description + ' durante ' + format(wait_time) + ' segundos.')
+        ctx.comment(' ')
+
+    def add_reagent(op):
+        reagent = reagents[op.reagent]
+        recycle = {'none': False, 'wash': TIP_RECYCLING_IN_WASH, 'elution': TIP_RECYCLING_IN_ELUTION}[op.tip_recycling]
+        if recycle:
+            recycled_tips[reagent.name] = []
+        trips = math.ceil(reagent.reagent_volume / reagent.max_volume_allowed)
+        volume = reagent.reagent_volume / trips
+        transfer_vols = []
+        for i in range(trips):
+            transfer_vols.append(volume + reagent.disposal_volume)
+        mix_volume = reagent.reagent_volume if op.mix_volume is None else op.mix_volume
+        first_mix_done = False
+        heated = reagent.name == heating['reagent']
+        if heated:
+            heat_elution()
+            heating_start = datetime.now()
+            heating['module'].await_temperature(heating['temperature'])
+            heating['added'] += (datetime.now() - heating_start).total_seconds() + heated_hold_time
+            # The module only reads the block temperature: the eluent in the tubes needs some more time to follow it
+            ctx.delay(seconds = heated_hold_time, msg = 'Esperando ' + str(heated_hold_time) + ' segundos a que ' + reagent.name + ' alcance la temperatura del bloque')
+            heating['heated'] = True
+
+        def pick_up_column_tip():
+            pick_up(m300)
+            if recycle:
+                recycled_tips[reagent.name] += [tip_track['tips'][m300][int(tip_track['counts'][m300] / 8)]]
+
+        def mix_column(i):
+            x_offset_dest = -1 * find_side(i) * op.x_offset_rs
+            if op.num_mixes > 0:
+                ctx.comment(' ')
+                ctx.comment('Mezclando muestra con ' + reagent.name)
+                custom_mix(m300, reagent, location = work_destinations[i], vol = mix_volume, two_thirds_mix_bottom = op.two_thirds_mix_bottom,
+                        rounds = op.num_mixes, blow_out = False, mix_height = op.mix_height, offset = x_offset_dest,
+                        wait_time = op.mix_wait_time, drop_height = op.mix_drop_height)
+
+        def release_tip(i):
+            m300.air_gap(reagent.air_gap_vol_bottom) #air gap
+
+            if recycle_tip == True or recycle:
+                m300.return_tip()
+            else:
+                drop_tip(m300)
+            tip_track['counts'][m300] += 8
+
+        for i in range(num_cols):
+            x_offset_source = 0
+            x_offset_dest   = -1 * find_side(i) * op.x_offset_rs
+            if not m300.hw_pipette['has_tip']:
+                pick_up_column_tip()
+            for transfer_vol in transfer_vols:
+                if heated: # Own column of strip tubes for each sample column, aspirated from the bottom
+                    reagent.col = i
+                    [pickup_height, change_col] = [heated_pickup_height, False]
+                else:
+                    #Calculate pickup_height based on remaining volume and shape of container
+                    [pickup_height, change_col] = calc_height(reagent, multi_well_rack_area, transfer_vol * 8)
+                if heated: # The strip tubes hold only the volume of one column, too little to mix
+                    pass
+                elif change_col == True or not first_mix_done: #If we switch column because there is not enough volume left in current reservoir column we mix new column
+                    if op.well_first_time_num_mixes > 0:
+                        ctx.comment('Mezclando nuevo canal del reservorio: ' + str(reagent.col + 1))
+                        custom_mix(m300, reagent, reagent.reagent_reservoir[reagent.col],
+                            vol = reagent.max_volume_allowed, rounds = op.well_first_time_num_mixes,
+                            blow_out = False, mix_height = 1.5, offset = 0)
+                    first_mix_done = True
+                elif op.well_num_mixes > 0:
+                    ctx.comment('Mezclando canal del reservorio: ' + str(reagent.col + 1))
+                    mix_height = 1.5 if pickup_height > 1.5 else pickup_height
+                    custom_mix(m300, reagent, reagent.reagent_reservoir[reagent.col],
+                        vol = reagent.max_volume_allowed, rounds = op.well_num_mixes,
+                        blow_out = False, mix_height = mix_height, offset = 0)
+
+                ctx.comment('Aspirando desde la columna del reservorio: ' + str(reagent.col + 1))
+                ctx.comment('La altura de recogida es ' + str(pickup_height))
+                move_vol_multi(m300, reagent = reagent, source = reagent.reagent_reservoir[reagent.col],
+                        dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                        pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 0, blow_out = op.blow_out,
+                        drop_height = op.drop_height)
+
+            if not op.single_tip:
+                mix_column(i)
+                release_tip(i)
+
+        if op.single_tip:
+            # The addition tip has not touched any sample: it mixes the first column and every other column gets its own tip
+            for i in range(num_cols):
+                if op.num_mixes > 0 and not m300.hw_pipette['has_tip']:
+                    pick_up_column_tip()
+                mix_column(i)
+                if op.num_mixes > 0 or i == num_cols - 1:
+                    release_tip(i)
+        if heated: # The eluent left in the reservoir is not needed anymore
+            heating['module'].deactivate()
+        settling['volume'] += reagent.reagent_volume
+
+    def has_recycled_tip(op, i):
+        # A single tip addition without mixing keeps one tip only, for the first column
+        return op.tips_from in recycled_tips and i < len(recycled_tips[op.tips_from])
+
+    def pick_up_recycled(op, i):
+        # Reuse the tip that added the reagent to this column, if it was kept
+        if has_recycled_tip(op, i):
+            pick_up(m300, recycled_tips[op.tips_from][i])
+            if reagents[op.tips_from].air_gap_vol_top != 0:
+                m300.dispense(reagents[op.tips_from].air_gap_vol_top, work_destinations[i].top(z = 0), rate = reagents[op.tips_from].flow_rate_dispense)
+        else:
+            pick_up(m300)
+
+    def remove_supernatant(op):
+        empty_waste_pause(STEP)
+
+        supernatant = sum([reagents[r].reagent_volume for r in op.reagents])
+        supernatant_trips = math.ceil(supernatant / Sample.max_volume_allowed)
+        supernatant_volume = supernatant_trips * Sample.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
+        tail_rate = op.tail_flow_rate or Sample.flow_rate_aspirate
+
+        # Volume and aspiration rate of every trip. The trips are the same as removing everything at the Sample rate,
+        # the ones that leave at least tail_volume in the well go at the bulk rate
+        supernatant_transfer_vol = []
+        for t in range(supernatant_trips):
+            trip_volume = supernatant_volume / supernatant_trips
+            bulk = op.bulk_flow_rate is not None and (t + 1) * trip_volume <= supernatant - op.tail_volume
+            supernatant_transfer_vol.append((trip_volume + Sample.disposal_volume, op.bulk_flow_rate if bulk else tail_rate, bulk))
+
+        x_offset_rs = 2
+        pickup_height = 0.5 # Original 0.5
+
+        # Plunger time of every column compared with removing the whole supernatant at the Sample rate
+        current_time = sum([vol for vol, rate, bulk in supernatant_transfer_vol]) / (m300.flow_rate.aspirate * Sample.flow_rate_aspirate)
+        plunger_time = sum([vol / (m300.flow_rate.aspirate * rate) for vol, rate, bulk in supernatant_transfer_vol])
+
+        for i in range(num_cols):
+            x_offset_source = find_side(i) * x_offset_rs
+            x_offset_dest   = 0
+            not_first_transfer = False
+            supernatant_left = supernatant
+
+            if not m300.hw_pipette['has_tip']:
+                pick_up_recycled(op, i)
+            for transfer_vol, rate, bulk in supernatant_transfer_vol:
+                if bulk:
+                    # Bulk: centered and under the liquid level left after the trip
+                    trip_pickup_height = max(pickup_height, (supernatant_left - transfer_vol) / deepwell_area - op.bulk_clearance)
+                    trip_x_offset = 0
+                else:
+                    trip_pickup_height = pickup_height
+                    trip_x_offset = x_offset_source
+                ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
+                ctx.comment('La altura de recogida es ' + str(trip_pickup_height) )
+                waste_height = waste_ledger.drop_height()
+                move_vol_multi(m300, reagent = Sample, source = work_destinations[i],
+                    dest = waste, vol = transfer_vol, x_offset_source = trip_x_offset, x_offset_dest = x_offset_dest,
+                    pickup_height = trip_pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = op.blow_out,
+                    dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_height, aspirate_rate = rate)
+                m300.air_gap(Sample.air_gap_vol_bottom)
+                waste_ledger.add(min(transfer_vol, supernatant_left) * 8)
+                supernatant_left = max(0, supernatant_left - transfer_vol)
+                not_first_transfer = True
+
+            if recycle_tip == True:
+                m300.return_tip()
+            else:
+                drop_tip(m300)
+            if not has_recycled_tip(op, i):
+                tip_track['counts'][m300] += 8
+
+        settling['volume'] = max(0, settling['volume'] - supernatant)
+        if op.bulk_flow_rate is not None:
+            ctx.comment('Tiempo de aspiración ahorrado con la retirada en dos fases: ' + str_rounded((current_time - plunger_time) * num_cols) + ' segundos')
+
+    def transfer(op):
+        elution_trips = math.ceil(op.volume / Sample.max_volume_allowed)
+        elution_volume = op.volume / elution_trips
+        elution_vol = []
+        for i in range(elution_trips):
+            elution_vol.append(elution_volume + Sample.disposal_volume)
+        x_offset_rs = 2
+        for i in range(num_cols):
+            x_offset_source = find_side(i) * x_offset_rs
+            x_offset_dest   = 0
+            if not m300.hw_pipette['has_tip']:
+                pick_up_recycled(op, i)
+            for transfer_vol in elution_vol:
+                #Pickup_height is fixed here
+                ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
+                ctx.comment('La altura de recogida es ' + str(op.pickup_height) )
+
+                move_vol_multi(m300, reagent = Sample, source = work_destinations[i],
+                        dest = final_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                        pickup_height = op.pickup_height, rinse = False, avoid_droplet = False, wait_time = 0, blow_out = True, touch_tip = False,
+                        drop_height = op.drop_height)
+
+            record_well_map('deepwell', work_destinations[i], elution_name(final_destinations[i]), final_destinations[i], 8)
+            m300.air_gap(Sample.air_gap_vol_bottom) #air gap
+
+            if recycle_tip == True:
+                m300.return_tip()
+            else:
+                drop_tip(m300)
+            if not has_recycled_tip(op, i):
+                tip_track['counts'][m300] += 8
+        settling['volume'] = max(0, settling['volume'] - op.volume)
+
+    executors = {
+        MagnetChange: magnet_change,
+        Incubate: incubate,
+        Dry: incubate,
+        AddReagent: add_reagent,
+        Elute: add_reagent,
+        RemoveSupernatant: remove_supernatant,
+        Transfer: transfer
+        }
+
+####################################
+    # load labware and modules
+    ######## 12 well rack
+    reagent_res = ctx.load_labware('nest_12_reservoir_15ml', '5','reagent deepwell plate')
+
+##################################
+    ####### Elution plate - final plate, goes to C
+    elution_plates = [load_labware(ctx, kit['final_plate']['labware'], slot, kit['final_plate']['name'])
+        for slot in kit['final_plate']['slots']]
+
+############################################
+    ######## Deepwell - comes from A
+    magdeck = ctx.load_module('Magnetic Module Gen2', '4')
+    deepwell_plate = magdeck.load_labware(deepwell_labware, 'NEST 96 Deepwell Plate 2mL') # Change to NEST deepwell plate.
+
+####################################
+    ######## Waste reservoir
+    waste_reservoir = ctx.load_labware('nest_1_reservoir_195ml', '7', 'waste reservoir') # Change to our waste reservoir
+    waste = waste_reservoir.wells()[0] # referenced as reservoir
+
+####################################
+    ######## Temperature module with the eluent reservoir
+    if heating['reagent'] is not None:
+        heating['module'] = ctx.load_module('Temperature Module Gen2', TEMPERATURE_MODULE_SLOT)
+        heating['reservoir'] = heating['module'].load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', 'heated elution strips')
+
+####################################
+    ######### Load tip_racks, but in the temperature module slot
+    tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
+        for slot in ['3', '6', '8', '9', '10', '11'] if slot != TEMPERATURE_MODULE_SLOT]
+
+####################################
+    ######### Tip bin near the plates, an empty tip rack
+    tip_bin = {'rack': None, 'used': [], 'full': False, 'saved': 0}
+    if TIP_DISPOSAL_SLOT is not None:
+        tip_bin['rack'] = ctx.load_labware('opentrons_96_tiprack_300ul', TIP_DISPOSAL_SLOT, 'tip bin')
+
+###############################################################################
+    #Declare which reagents are in each reservoir as well as deepwell and elution plate
+    ctx.comment(' ')
+    ctx.comment('###############################################')
+    ctx.comment('VOLÚMENES PARA ' + str(NUM_SAMPLES) + ' MUESTRAS')
+    ctx.comment(' ')
+    for name in kit['reagents']:
+        if reagent_volumes[name] > 0:
+            assign_wells(reagents[name])
+    ctx.comment('###############################################')
+    ctx.comment(' ')
+
+    work_destinations           = deepwell_plate.rows()[0][:Sample.num_wells]
+    final_destinations          = [well for plate in elution_plates
+        for well in plate.rows()[0][::kit['final_plate']['column_step']]][:Sample.num_wells]
+
+    # pipettes.
+    m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks = tips300) # Load multi pipette
+
+    waste_ledger = WasteReservoir(max_volume = waste_max_volume, area = waste_area, depth = waste_depth,
+                    max_drop_height = waste_drop_height, clearance = waste_drop_clearance,
+                    min_drop_height = waste_min_drop_height)
+    waste_total = waste_ledger.plan(waste_plan)
+    ctx.comment('Residuos: ' + str_rounded(waste_total) + ' uL previstos en el reservorio de residuos')
+    for step in waste_ledger.empty_before:
+        ctx.comment('Se pausará para vaciar los residuos durante la incubación previa al paso ' + str(step))
+
+    #### used tip counter and set maximum tips available
+    tip_track = {
+        'counts': {m300: 0},
+        'maxes': {m300: 96 * len(m300.tip_racks)}, #96 tips per tiprack * number or tipracks in the layout
+        'num_refills' : {m300 : 0},
+        'tips': { m300: [tip for rack in tips300 for tip in rack.rows()[0]]}
+        }
+
+###############################################################################
+    start_run()
+    magdeck.disengage()
+
+    ###############################################################################
+    # Run the compiled kit operations, one STEPS entry per step
+    ########
+    for STEP in STEPS:
+        if STEPS[STEP]['Execute']==True:
+            start = log_step_start()
+
+            for op in program[STEP - 1]:
+                executors[type(op)](op)
+
+            log_step_end(start)
+
+    magdeck.disengage()
+    if home_at_end:
+        ctx.comment(' ')
+        ctx.comment('###############################################')
+        ctx.comment('Homing robot')
+        ctx.comment('###############################################')
+        ctx.comment(' ')
+        ctx.home()
+###############################################################################
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
+    # Export the time log to a tsv file
+    if not ctx.is_simulating():
+        with open(file_path, 'w') as f:
+            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
+            for key in STEPS.keys():
+                row = str(key)
+                for key2 in STEPS[key].keys():
+                    row += '\t' + format(STEPS[key][key2])
+                f.write(row + '\n')
+        f.close()
+
+    ############################################################################
+
+    finish_run()
@@ -39,7 +39,12 @@ run_id                      = 'B_Extraccion_total_Magmax'
 
 recycle_tip                 = False # Do you want to recycle tips? It shoud only be set True for testing
 mag_height                  = 7 # Height needed for NEST deepwell in magnetic deck
-waste_drop_height           = 15
+waste_drop_height           = 15        # Maximum dispense height over the waste reservoir top
+waste_drop_clearance        = 10        # Dispense height over the waste liquid level
+waste_min_drop_height       = 2         # Minimum dispense height over the waste reservoir top
+waste_max_volume            = 180000    # Usable volume of the 195 ml waste reservoir
+waste_area                  = 106.8 * 71.2 #Cross section of the waste reservoir
+waste_depth                 = 25        # Depth of the waste reservoir
 multi_well_rack_area        = 8 * 71 #Cross section of the 12 well reservoir
 
 num_cols = math.ceil(NUM_SAMPLES / 8) # Columns we are working on
@@ -77,6 +82,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_B_Extraccion_total_time_log.txt'
+        map_path = folder_path + '/Station_B_Extraccion_total_well_map.txt'
 
     #Define Reagents as objects with their properties
     class Reagent:
@@ -177,6 +183,52 @@ def run(ctx: protocol_api.ProtocolContext):
     Elution.vol_well    = Elution.vol_well_original
     Sample.vol_well     = 350 # Arbitrary value
 
+    # Liquid volume per sample sent to the waste in every supernatant removal step, in STEPS order
+    removal_volumes = [Sample.reagent_volume, Wash_1.reagent_volume, Wash_2.reagent_volume]
+    removal_steps = [s for s in STEPS if STEPS[s]['description'] == 'Desechar sobrenadante']
+    waste_plan = dict(zip(removal_steps, removal_volumes))
+
+    #Waste reservoir and its volume ledger
+    class WasteReservoir:
+        def __init__(self, max_volume, area, depth, max_drop_height, clearance, min_drop_height):
+            self.max_volume = max_volume
+            self.area = area
+            self.depth = depth
+            self.max_drop_height = max_drop_height
+            self.min_drop_height = min_drop_height
+            self.clearance = clearance
+            self.vol = 0
+            self.empty_before = [] # Supernatant removal steps that need an empty waste reservoir
+
+        def plan(self, waste_plan):
+            '''
+            Predict the waste volume of every supernatant removal step and schedule the
+            emptying of the reservoir before the step that would overflow it
+            '''
+            vol = self.vol
+            total = 0
+            for step in sorted(waste_plan):
+                if STEPS[step]['Execute'] == True:
+                    step_vol = waste_plan[step] * 8 * num_cols
+                    if vol + step_vol > self.max_volume and vol > 0:
+                        self.empty_before.append(step)
+                        vol = 0
+                    vol += step_vol
+                    total += step_vol
+            return total
+
+        def add(self, vol):
+            self.vol += vol
+
+        def drop_height(self):
+            # Dispense height from the top, following the liquid level but never inside the reservoir
+            height = self.vol / self.area - self.depth + self.clearance
+            if height > self.max_drop_height:
+                height = self.max_drop_height
+            if height < self.min_drop_height:
+                height = self.min_drop_height
+            return height
+
     #########
     def str_rounded(num):
         return str(int(num + 0.5))
@@ -210,6 +262,22 @@ def run(ctx: protocol_api.ProtocolContext):
 
     ###################
     #Custom functions
+    location_cache = {}
+
+    def well_location(well, end, z, x_offset = 0):
+        '''
+        Location at the top or bottom of a well, moved x_offset mm to the side. Each location is
+        computed once per run and reused by the mix and transfer loops. Wells live for the whole
+        run, so their id is a stable key
+        '''
+        key = (id(well), end, z, x_offset)
+        if key not in location_cache:
+            location = well.top(z = z) if end == 'top' else well.bottom(z = z)
+            if x_offset != 0:
+                location = location.move(Point(x = x_offset))
+            location_cache[key] = location
+        return location_cache[key]
+
     def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height, offset, wait_time = 0, drop_height = -1, two_thirds_mix_bottom = False):
         '''
         Function for mix in the same location a certain number of rounds. Blow out optional. Offset
@@ -217,16 +285,16 @@ def run(ctx: protocol_api.ProtocolContext):
         '''
         if mix_height <= 0:
             mix_height = 1
-        pipet.aspirate(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
+        pipet.aspirate(1, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_aspirate_mix)
         for i in range(rounds):
-            pipet.aspirate(vol, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
+            pipet.aspirate(vol, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_aspirate_mix)
             if two_thirds_mix_bottom and i < ((rounds / 3) * 2):
-                pipet.dispense(vol, location = location.bottom(z = 5).move(Point(x = offset)), rate = reagent.flow_rate_dispense_mix)
+                pipet.dispense(vol, location = well_location(location, 'bottom', 5, offset), rate = reagent.flow_rate_dispense_mix)
             else:
-                pipet.dispense(vol, location = location.top(z = drop_height).move(Point(x = offset)), rate = reagent.flow_rate_dispense_mix)
-        pipet.dispense(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_dispense_mix)
+                pipet.dispense(vol, location = well_location(location, 'top', drop_height, offset), rate = reagent.flow_rate_dispense_mix)
+        pipet.dispense(1, location = well_location(location, 'bottom', mix_height), rate = reagent.flow_rate_dispense_mix)
         if blow_out == True:
-            pipet.blow_out(location.top(z = -2)) # Blow out
+            pipet.blow_out(well_location(location, 'top', -2)) # Blow out
         if wait_time != 0:
             ctx.delay(seconds=wait_time, msg='Esperando durante ' + str(wait_time) + ' segundos.')
 
@@ -268,20 +336,19 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # SOURCE
         if dispense_bottom_air_gap_before and reagent.air_gap_vol_bottom:
-            pipet.dispense(reagent.air_gap_vol_bottom, source.top(z = -2), rate = reagent.flow_rate_dispense)
+            pipet.dispense(reagent.air_gap_vol_bottom, well_location(source, 'top', -2), rate = reagent.flow_rate_dispense)
 
         if reagent.air_gap_vol_top != 0: #If there is air_gap_vol, switch pipette to slow speed
-            pipet.move_to(source.top(z = 0))
+            pipet.move_to(well_location(source, 'top', 0))
             pipet.air_gap(reagent.air_gap_vol_top) #air gap
 
         if aspirate_with_x_scroll:
             aspirate_with_x_scrolling(pip = pipet, volume = vol, src = source, pickup_height = pickup_height, rate = reagent.flow_rate_aspirate, start_x_offset_src = 0, stop_x_offset_src = x_offset_source)
         else:    
-            s = source.bottom(pickup_height).move(Point(x = x_offset_source))
+            s = well_location(source, 'bottom', pickup_height, x_offset_source)
             pipet.aspirate(vol, s, rate = reagent.flow_rate_aspirate) # aspirate liquid
 
         if reagent.air_gap_vol_bottom != 0: #If there is air_gap_vol, switch pipette to slow speed
-            pipet.move_to(source.top(z = 0))
             pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
 
         # if wait_time != 0:
@@ -289,17 +356,17 @@ def run(ctx: protocol_api.ProtocolContext):
 
         if avoid_droplet == True: # Touch the liquid surface to avoid droplets
             ctx.comment("Moviendo a: " + str(pickup_height))
-            pipet.move_to(source.bottom(pickup_height))
+            pipet.move_to(well_location(source, 'bottom', pickup_height))
 
         # GO TO DESTINATION
-        d = dest.top(z = drop_height).move(Point(x = x_offset_dest))
+        d = well_location(dest, 'top', drop_height, x_offset_dest)
         pipet.dispense(vol - reagent.disposal_volume + reagent.air_gap_vol_bottom, d, rate = reagent.flow_rate_dispense)
 
         if reagent.air_gap_vol_top != 0:
-            pipet.dispense(reagent.air_gap_vol_top, dest.top(z = 0), rate = reagent.flow_rate_dispense)
+            pipet.dispense(reagent.air_gap_vol_top, well_location(dest, 'top', 0), rate = reagent.flow_rate_dispense)
 
         if blow_out == True:
-            pipet.blow_out(dest.top(z = drop_height))
+            pipet.blow_out(well_location(dest, 'top', drop_height))
 
         if touch_tip == True:
             pipet.touch_tip(speed = 20, v_offset = touch_tip_v_offset, radius=0.7)
@@ -318,7 +385,7 @@ def run(ctx: protocol_api.ProtocolContext):
         inc_step = (start_x_offset_src - stop_x_offset_src) / max_asp
 
         for x in reversed(np.arange(stop_x_offset_src, start_x_offset_src, inc_step)):
-            s = src.bottom(pickup_height).move(Point(x = x))
+            s = well_location(src, 'bottom', pickup_height, x)
             pip.aspirate(volume = pip.min_volume, location = s, rate = rate)
 
     ##########
@@ -390,6 +457,22 @@ def run(ctx: protocol_api.ProtocolContext):
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -407,6 +490,28 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Paso ' + str(STEP) + ': ' +STEPS[STEP]['description'] + ' hizo un tiempo de ' + str(time_taken))
         ctx.comment(' ')
 
+    def empty_waste_pause(removal_step, wait_time = 0):
+        '''
+        Pause to empty the waste reservoir if the waste plan requires it before removal_step.
+        Called during a magnet incubation, it only adds the time exceeding wait_time.
+        '''
+        if removal_step not in waste_ledger.empty_before:
+            return wait_time
+        waste_ledger.empty_before.remove(removal_step)
+        pause_start = datetime.now()
+        for i in range(3):
+            ctx._hw_manager.hardware.set_lights(rails=False)
+            ctx._hw_manager.hardware.set_lights(button=(1, 0 ,0))
+            time.sleep(0.3)
+            ctx._hw_manager.hardware.set_lights(rails=True)
+            ctx._hw_manager.hardware.set_lights(button=(0, 0 ,1))
+            time.sleep(0.3)
+        ctx._hw_manager.hardware.set_lights(button=(0, 1 ,0))
+        ctx.pause('Vacía el reservorio de residuos (' + str_rounded(waste_ledger.vol) + ' uL) antes de continuar.')
+        waste_ledger.vol = 0
+        elapsed = (datetime.now() - pause_start).total_seconds()
+        return max(0, round(wait_time - elapsed))
+
     ##########
     def find_side(col):
         if col%2 == 0:
@@ -455,6 +560,14 @@ def run(ctx: protocol_api.ProtocolContext):
     # pipettes.
     m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks = tips300) # Load multi pipette
 
+    waste_ledger = WasteReservoir(max_volume = waste_max_volume, area = waste_area, depth = waste_depth,
+                    max_drop_height = waste_drop_height, clearance = waste_drop_clearance,
+                    min_drop_height = waste_min_drop_height)
+    waste_total = waste_ledger.plan(waste_plan)
+    ctx.comment('Residuos: ' + str_rounded(waste_total) + ' uL previstos en el reservorio de residuos')
+    for step in waste_ledger.empty_before:
+        ctx.comment('Se pausará para vaciar los residuos durante la incubación previa al paso ' + str(step))
+
     #### used tip counter and set maximum tips available
     tip_track = {
         'counts': {m300: 0},
@@ -476,7 +589,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
         ctx.comment(' ')
         magdeck.engage(height = mag_height)
-        ctx.delay(seconds = STEPS[STEP]['wait_time'], msg = 'Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
+        ctx.delay(seconds = empty_waste_pause(STEP + 1, STEPS[STEP]['wait_time']), msg = 'Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
         ctx.comment(' ')
 
         log_step_end(start)
@@ -490,6 +603,7 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute']==True:
         start = log_step_start()
+        empty_waste_pause(STEP)
 
         supernatant_trips = math.ceil(Sample.reagent_volume / Sample.max_volume_allowed)
         supernatant_volume = Sample.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
@@ -504,6 +618,7 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = find_side(i) * x_offset_rs
             x_offset_dest   = 0
             not_first_transfer = False
+            supernatant_left = Sample.reagent_volume
 
             if not m300.hw_pipette['has_tip']:
                 pick_up(m300)
@@ -511,12 +626,14 @@ def run(ctx: protocol_api.ProtocolContext):
                 ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
                 ctx.comment('La altura de recogida es ' + str(pickup_height) )
 
+                waste_height = waste_ledger.drop_height()
                 move_vol_multi(m300, reagent = Sample, source = work_destinations[i],
                         dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                         pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = True,
-                        dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_drop_height)
-                m300.move_to(waste.top(z = waste_drop_height))
+                        dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_height)
                 m300.air_gap(Sample.air_gap_vol_bottom)
+                waste_ledger.add(min(transfer_vol, supernatant_left) * 8)
+                supernatant_left = max(0, supernatant_left - transfer_vol)
                 not_first_transfer = True
 
             if recycle_tip:
@@ -581,7 +698,6 @@ def run(ctx: protocol_api.ProtocolContext):
                 custom_mix(m300, Wash_1, location = work_destinations[i], vol = 180, two_thirds_mix_bottom = True,
                         rounds = WASH_1_NUM_MIXES, blow_out = False, mix_height = 3, offset = x_offset_dest)
             
-            m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Wash_1.air_gap_vol_bottom) #air gap
 
             if recycle_tip or TIP_RECYCLING_IN_WASH:
@@ -604,7 +720,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # switch on magnet
         magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
+        ctx.delay(seconds=empty_waste_pause(STEP + 1, STEPS[STEP]['wait_time']), msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
 
         log_step_end(start)
         ####################################################################
@@ -617,6 +733,7 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute']==True:
         start = log_step_start()
+        empty_waste_pause(STEP)
 
         supernatant_trips = math.ceil(Wash_1.reagent_volume / Wash_1.max_volume_allowed)
         supernatant_volume = Wash_1.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
@@ -631,23 +748,27 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = find_side(i) * x_offset_rs
             x_offset_dest   = 0
             not_first_transfer = False
+            supernatant_left = Wash_1.reagent_volume
 
             if not m300.hw_pipette['has_tip']:
                 if TIP_RECYCLING_IN_WASH:
                     pick_up(m300, w1_tip_pos_list[i])
-                    m300.dispense(Wash_1.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Wash_1.flow_rate_dispense)
+                    if Wash_1.air_gap_vol_top != 0:
+                        m300.dispense(Wash_1.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Wash_1.flow_rate_dispense)
                 else:
                     pick_up(m300)
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
                 ctx.comment('La altura de recogida es ' + str(pickup_height) )
+                waste_height = waste_ledger.drop_height()
                 move_vol_multi(m300, reagent = Sample, source = work_destinations[i],
                     dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                     pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False,
-                    dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_drop_height)
-                m300.move_to(waste.top(z = waste_drop_height))
+                    dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_height)
                 m300.air_gap(Sample.air_gap_vol_bottom)
+                waste_ledger.add(min(transfer_vol, supernatant_left) * 8)
+                supernatant_left = max(0, supernatant_left - transfer_vol)
                 not_first_transfer = True
 
             if recycle_tip:
@@ -713,7 +834,6 @@ def run(ctx: protocol_api.ProtocolContext):
                 custom_mix(m300, Wash_2, location = work_destinations[i], vol = 180, two_thirds_mix_bottom = True,
                     rounds = WASH_2_NUM_MIXES, blow_out = False, mix_height = 3, offset = x_offset_dest)
             
-            m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Wash_2.air_gap_vol_bottom) #air gap
 
             if recycle_tip or TIP_RECYCLING_IN_WASH:
@@ -736,7 +856,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # switch on magnet
         magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
+        ctx.delay(seconds=empty_waste_pause(STEP + 1, STEPS[STEP]['wait_time']), msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
         
         log_step_end(start)
         ####################################################################
@@ -749,6 +869,7 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute']==True:
         start = log_step_start()
+        empty_waste_pause(STEP)
 
         supernatant_trips = math.ceil(Wash_2.reagent_volume / Wash_2.max_volume_allowed)
         supernatant_volume = Wash_2.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
@@ -762,23 +883,27 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = find_side(i) * x_offset_rs
             x_offset_dest   = 0
             not_first_transfer = False
+            supernatant_left = Wash_2.reagent_volume
 
             if not m300.hw_pipette['has_tip']:
                 if TIP_RECYCLING_IN_WASH:
                     pick_up(m300, w2_tip_pos_list[i])
-                    m300.dispense(Wash_2.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Wash_2.flow_rate_dispense)
+                    if Wash_2.air_gap_vol_top != 0:
+                        m300.dispense(Wash_2.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Wash_2.flow_rate_dispense)
                 else:
                     pick_up(m300)
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
                 ctx.comment('La altura de recogida es ' + str(pickup_height) )
+                waste_height = waste_ledger.drop_height()
                 move_vol_multi(m300, reagent = Sample, source = work_destinations[i],
                     dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                     pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False,
-                    dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_drop_height)
-                m300.move_to(waste.top(z = waste_drop_height))
+                    dispense_bottom_air_gap_before = not_first_transfer, drop_height = waste_height)
                 m300.air_gap(Sample.air_gap_vol_bottom)
+                waste_ledger.add(min(transfer_vol, supernatant_left) * 8)
+                supernatant_left = max(0, supernatant_left - transfer_vol)
                 not_first_transfer = True
 
             if recycle_tip:
@@ -864,7 +989,6 @@ def run(ctx: protocol_api.ProtocolContext):
                 custom_mix(m300, Elution, work_destinations[i], vol = Elution.reagent_volume, rounds = ELUTION_NUM_MIXES,
                     blow_out = False, mix_height = 1, offset = x_offset_dest, drop_height = -35)
             
-            m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Elution.air_gap_vol_bottom) #air gap
             
             if recycle_tip or TIP_RECYCLING_IN_ELUTION:
@@ -887,7 +1011,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # switch on magnet
         magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
+        ctx.delay(seconds=empty_waste_pause(STEP + 1, STEPS[STEP]['wait_time']), msg='Incubación con el imán ON durante ' + format(STEPS[STEP]['wait_time']) + ' segundos.')
 
         log_step_end(start)
         ####################################################################
@@ -913,7 +1037,8 @@ def run(ctx: protocol_api.ProtocolContext):
             if not m300.hw_pipette['has_tip']:
                 if TIP_RECYCLING_IN_ELUTION:
                     pick_up(m300, elution_tip_pos_list[i])
-                    m300.dispense(Elution.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Elution.flow_rate_dispense)
+                    if Elution.air_gap_vol_top != 0:
+                        m300.dispense(Elution.air_gap_vol_top, work_destinations[i].top(z = 0), rate = Elution.flow_rate_dispense)
                 else:
                     pick_up(m300)
             for transfer_vol in elution_vol:
@@ -927,7 +1052,7 @@ def run(ctx: protocol_api.ProtocolContext):
                         pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 0, blow_out = True, touch_tip = False,
                         drop_height = 3)
             
-            m300.move_to(final_destinations[i].top(0))
+            record_well_map('deepwell', work_destinations[i], 'elution 1' if final_destinations[i].parent is elution_plate else 'elution 2', final_destinations[i], 8)
             m300.air_gap(Sample.air_gap_vol_bottom) #air gap
 
             if recycle_tip:
@@ -955,6 +1080,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment(' ')
     ctx.home()
 ###############################################################################
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     # Export the time log to a tsv file
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
@@ -26,6 +26,10 @@ NUM_SAMPLES                 = 96    # Number of samples to be moved
 VOLUME_PCR_SAMPLE           = 5     # Sample volume to be moved to PCR plate
 PCR_PLATE_COL_OFFSET        = 0     # Number of columns to skip on output PCR plate
 PHOTOSENSITIVE              = False # True if it has photosensitive reagents
+TIP_DISPOSAL_SLOT           = None  # Slot of an empty tip rack to drop the used tips near the plates, e.g. '3'. None for the fixed trash
+MASTER_MIX                  = False # Dispense the master mix into the PCR plate before the samples
+VOLUME_MASTER_MIX           = 15    # Master mix volume per PCR well. The m20 multi-dispenses only up to 8 ul,
+                                    # from 9 ul every trip carries a single column (no multi-dispense at 15 ul)
 ################################################
 
 run_id                      = 'Station_C_FROM_Archive_TO_PCR_&_Archive'
@@ -39,9 +43,25 @@ sample_dispense_rate        = 100
 pcr_disp_height             = -10
 dispense_touch_tip          = True
 recycle_tip                 = False
+gantry_speed                = 400   # Default gantry speed in mm/s, to estimate the travel saved by the tip bin
+pipette_allowed_capacity    = 18 # Volume allowed in the pipette of 20µl
+master_mix_disposal_vol     = 2     # Extra volume aspirated in every master mix trip, returned to the reservoir
+master_mix_dead_vol         = 700   # Dead volume of the master mix channel in the 12 well reservoir
+master_mix_disp_height      = -2    # Master mix dispense height from the top of the PCR wells
+multi_well_rack_area        = 8 * 71 # Cross section of the 12 well reservoir
+master_mix_channel_volume   = 15000 # Capacity of the master mix channel in the 12 well reservoir
+master_mix_tips_slot        = '9'   # Slot of the extra tip rack when the master mix tips do not fit with the samples
 
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
+# Layout of the transfers, by labware slot
+PCR_LAYOUT = {
+    'name': 'Placa PCR',
+    'unit': 'columns',
+    'source': {'slots': ['1', '2'], 'stride': 2}, # Odd columns of the archive plates
+    'dest': {'slots': ['4'], 'offset': PCR_PLATE_COL_OFFSET, 'controls': []}
+    }
+
 # Constants
 CANCEL = False
 
@@ -62,15 +82,86 @@ def validate_parameters():
         ctx.comment ("ERROR: No hay espacio suficiente en la placa PCR para " + NUM_SAMPLES + " muestras ignorando las " + PCR_PLATE_COL_OFFSET + " primeras columnas.")
         result = False
 
+    if MASTER_MIX and VOLUME_MASTER_MIX <= 0:
+        ctx.comment ("ERROR: Volumen de master mix inválido: " + str(VOLUME_MASTER_MIX))
+        result = False
+    if MASTER_MIX and VOLUME_MASTER_MIX + master_mix_disposal_vol > pipette_allowed_capacity:
+        ctx.comment ("ERROR: El volumen de master mix " + str(VOLUME_MASTER_MIX) + " ul no cabe en las puntas de 20 ul.")
+        result = False
+    if MASTER_MIX and VOLUME_MASTER_MIX * 8 * num_cols + master_mix_dead_vol > master_mix_channel_volume:
+        ctx.comment ("ERROR: El master mix de " + str(num_cols) + " columnas más el volumen muerto no cabe en un canal del reservorio.")
+        result = False
+    if MASTER_MIX and TIP_DISPOSAL_SLOT == master_mix_tips_slot:
+        ctx.comment ("ERROR: El slot " + master_mix_tips_slot + " es para las puntas del master mix, usa otro slot para la papelera de puntas.")
+        result = False
+
     return result
 
+################################################
+# Plate to plate layouts
+################################################
+def layout_positions(labware, side, unit):
+    '''
+    Positions (columns or wells, by unit) of one side of a layout, in filling order. side is a dict
+    with the slots of the labware in filling order and optionally the stride (take one column every
+    stride), the offset (positions skipped at the beginning) and the controls (names of the wells
+    reserved for controls in every labware, their positions are never used).
+    '''
+    positions = []
+    controls = []
+    for slot in side['slots']:
+        columns = labware[slot].columns()[::side.get('stride', 1)]
+        positions += columns if unit == 'columns' else [[well] for column in columns for well in column]
+        controls += [str(labware[slot].wells_by_name()[name]) for name in side.get('controls', [])]
+    positions = positions[side.get('offset', 0):]
+    return [p for p in positions if not [well for well in p if str(well) in controls]]
+
+def compile_layout(labware, layout, count, pipette):
+    '''
+    Compile a layout into an immutable index of (source well, destination well, pipette) tuples
+    for the first count positions. With the unit 'columns' the wells are the tops of the columns.
+    Returns the index, the wells it uses and a list of errors if there are not enough positions.
+    '''
+    unit = layout.get('unit', 'wells')
+    sources = layout_positions(labware, layout['source'], unit)
+    dests = layout_positions(labware, layout['dest'], unit)
+    errors = []
+    for side, positions in (('origen', sources), ('destino', dests)):
+        if count > len(positions):
+            errors.append(layout['name'] + ': ' + str(count) + ' posiciones necesarias y solo hay ' + str(len(positions)) + ' en el ' + side)
+    index = tuple((s[0], d[0], pipette) for s, d in zip(sources[:count], dests[:count]))
+    wells = {
+        'source': [well for s in sources[:count] for well in s],
+        'dest': [well for d in dests[:count] for well in d]
+        }
+    return index, wells, errors
+
+def check_layouts(compiled):
+    '''
+    Check that no well is filled twice and that no destination well is the source of another layout.
+    compiled is a list of (name, wells) with the wells returned by compile_layout.
+    '''
+    errors = []
+    filled = {}
+    for name, wells in compiled:
+        for well in wells['dest']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo ' + str(well) + ' ya se llena en ' + filled[str(well)])
+            filled[str(well)] = name
+    for name, wells in compiled:
+        for well in wells['source']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo de origen ' + str(well) + ' se llena en ' + filled[str(well)])
+    return errors
+
 def run(ctx: protocol_api.ProtocolContext):
     ctx.comment('Columnas a utilizar: ' + str(num_cols))
 
     # Define the STEPS of the protocol
     STEP = 0
     STEPS = {  # Dictionary with STEP activation, description, and times
-        1: {'Execute': True, 'description': 'Transferir muestras a la placa PCR'}
+        1: {'Execute': MASTER_MIX, 'description': 'Dispensar master mix en la placa PCR'},
+        2: {'Execute': True, 'description': 'Transferir muestras a la placa PCR'}
     }
 
     for s in STEPS:  # Create an empty wait_time
@@ -83,6 +174,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_C_time_log.txt'
+        map_path = folder_path + '/Station_C_well_map.txt'
 
     # Define Reagents as objects with their properties
     class Reagent:
@@ -118,6 +210,19 @@ def run(ctx: protocol_api.ProtocolContext):
 
     Samples.vol_well = Samples.vol_well_original
 
+    MasterMix = Reagent(name='Master mix',
+                      rinse=False,
+                      flow_rate_aspirate = 1,
+                      flow_rate_dispense = 1,
+                      reagent_reservoir_volume = VOLUME_MASTER_MIX * 8 * num_cols + master_mix_dead_vol,
+                      delay=0,
+                      num_wells=1,
+                      h_cono = 1.95,
+                      v_fondo = 695 #1.95 * multi_well_rack_area / 2, #Prismatic
+                      )
+
+    MasterMix.vol_well = MasterMix.vol_well_original
+
     ##################
     # Custom functions
         
@@ -130,6 +235,9 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Volumen a transferir a la placa PCR: ' + str(VOLUME_PCR_SAMPLE) + ' ul')
         ctx.comment('Columnas a ser ignoradas en la placa PCR: ' + str(PCR_PLATE_COL_OFFSET)) 
         ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE)) 
+        ctx.comment('Dispensar master mix: ' + str(MASTER_MIX))
+        if MASTER_MIX:
+            ctx.comment('Volumen de master mix por pocillo: ' + str(VOLUME_MASTER_MIX) + ' ul')
         ctx.comment('###############################################')
         ctx.comment(' ')
 
@@ -169,11 +277,35 @@ def run(ctx: protocol_api.ProtocolContext):
                 time.sleep(0.3)
         ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
 
+        if tip_bin['rack'] is not None:
+            ctx.comment('Recorrido ahorrado con la papelera de puntas: ' + str(round(tip_bin['saved'] / 1000, 1)) + ' m, unos ' + str(round(tip_bin['saved'] / gantry_speed)) + ' segundos')
         ctx.comment('Puntas de 20 ul utilizadas: ' + str(tip_track['counts'][m20]) + ' (' + str(round(tip_track['counts'][m20] / 96, 2)) + ' caja(s))')
         ctx.comment('###############################################')
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def record_transfer(source, dest, pip):
+        # Plates are named by their slot in the layouts
+        slots = {id(lw): slot for slot, lw in labware.items()}
+        record_well_map(lineage_names[slots[id(source.parent)]], source,
+            lineage_names[slots[id(dest.parent)]], dest, pip.channels)
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -191,6 +323,21 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Paso ' + str(STEP) + ': ' +STEPS[STEP]['description'] + ' hizo un tiempo de ' + str(time_taken))
         ctx.comment(' ')
 
+    def divide_destinations(l, n):
+        # Divide the list of destinations in size n lists.
+        for i in range(0, len(l), n):
+            yield l[i:i + n]
+
+    def distribute_master_mix(pipet, reagent, source, dest, vol, disposal_vol, pickup_height, disp_height):
+        '''
+        Multi-dispense vol in every column of dest from a single aspiration, without touching the liquid.
+        The disposal volume is returned to the source with the blow out.
+        '''
+        pipet.aspirate(len(dest) * vol + disposal_vol, source.bottom(pickup_height), rate = reagent.flow_rate_aspirate)
+        for d in dest:
+            pipet.dispense(vol, d.top(z = disp_height), rate = reagent.flow_rate_dispense)
+        pipet.blow_out(source.top(z = -2))
+
     def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
                        pickup_height, rinse, disp_height, blow_out, touch_tip, v_offset = -5, radius = 0.5):
         '''
@@ -245,6 +392,36 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z=-2))  # Blow out
 
+    def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
+        nonlocal ctx
+        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
+                    '< volumen necesario ' + str(aspirate_volume) + '?')
+        if reagent.vol_well < aspirate_volume:
+            reagent.unused.append(reagent.vol_well)
+            ctx.comment('Se debe utilizar el siguiente canal')
+            ctx.comment('Canal anterior: ' + str(reagent.col))
+            # column selector position; intialize to required number
+            reagent.col = reagent.col + 1
+            ctx.comment(str('Nuevo canal: ' + str(reagent.col)))
+            reagent.vol_well = reagent.vol_well_original
+            ctx.comment('Nuevo volumen:' + str(reagent.vol_well))
+            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+                    #- reagent.h_cono
+            reagent.vol_well = reagent.vol_well - aspirate_volume
+            ctx.comment('Volumen restante:' + str(reagent.vol_well))
+            if height < min_height:
+                height = min_height
+            col_change = True
+        else:
+            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
+            reagent.vol_well = reagent.vol_well - aspirate_volume
+            ctx.comment('La altura calculada es ' + str(height))
+            if height < min_height:
+                height = min_height
+            ctx.comment('La altura usada es ' + str(height))
+            col_change = False
+        return height, col_change
+
     ####################################
     # load labware and modules
 
@@ -260,12 +437,6 @@ def run(ctx: protocol_api.ProtocolContext):
     source_plate2 = ctx.load_labware(
         'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2',
         'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
-    
-    samples_source1 = source_plate1.columns()[0::2] # Select odd columns from source plate
-    samples_source2 = source_plate2.columns()[0::2] # Select odd columns from source plate
-
-    sample_cols =samples_source1 + samples_source2 
-    sample_cols = sample_cols[:num_cols]
 
     ##################################
     # qPCR plate - final plate, goes to PCR
@@ -273,6 +444,12 @@ def run(ctx: protocol_api.ProtocolContext):
         'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '4',
         'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
 
+    ##################################
+    # Master mix reservoir
+    if MASTER_MIX:
+        master_mix_res = ctx.load_labware('nest_12_reservoir_15ml', '6', 'master mix reservoir')
+        MasterMix.reagent_reservoir = master_mix_res.rows()[0]
+
     ##################################
     # Load Tipracks
     tips20 = [
@@ -280,14 +457,27 @@ def run(ctx: protocol_api.ProtocolContext):
         for slot in ['7']
     ]
 
+    ##################################
+    # Tip bin near the plates, an empty tip rack
+    tip_bin = {'rack': None, 'used': [], 'full': False, 'saved': 0}
+    if TIP_DISPOSAL_SLOT is not None:
+        tip_bin['rack'] = ctx.load_labware('opentrons_96_tiprack_300ul', TIP_DISPOSAL_SLOT, 'tip bin')
+
     ################################################################################
-    
-    # setup up sample sources and destinations
-    pcr_cols = qpcr_plate.columns()[PCR_PLATE_COL_OFFSET:num_cols+PCR_PLATE_COL_OFFSET]
 
     # pipettes
     m20 = ctx.load_instrument('p20_multi_gen2', mount='right', tip_racks=tips20)
 
+    # The master mix takes one more tip column than the samples, in an extra rack if the pipette runs out of tips
+    if MASTER_MIX and num_cols + 1 > 12 * len(m20.tip_racks):
+        m20.tip_racks = m20.tip_racks + [ctx.load_labware('opentrons_96_filtertiprack_20ul', master_mix_tips_slot, 'master mix tiprack')]
+
+    # setup up sample sources and destinations
+    labware = {'1': source_plate1, '2': source_plate2, '4': qpcr_plate}
+    lineage_names = {'1': 'elution 1', '2': 'elution 2', '4': 'pcr'} # Names of the plates in the well map
+    pcr_index, pcr_layout_wells, layout_errors = compile_layout(labware, PCR_LAYOUT, num_cols, m20)
+    layout_errors += check_layouts([(PCR_LAYOUT['name'], pcr_layout_wells)])
+
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': { 
@@ -313,36 +503,106 @@ def run(ctx: protocol_api.ProtocolContext):
             pip.pick_up_tip()
     ##########
 
+    def bin_position(pip):
+        # Next free position of the tip bin for all the channels of the pipette, None if it is full
+        rack = tip_bin['rack']
+        if pip.channels == 1:
+            # Single tips fill the bin from the end, leaving whole columns for the multichannel
+            candidates = [[well] for well in reversed(rack.wells())]
+        else:
+            candidates = rack.columns()
+        for wells in candidates:
+            if not any(well in tip_bin['used'] for well in wells):
+                return wells
+        return None
+
+    def drop_tip(pip):
+        '''
+        Drop the tip in the tip bin next to the plates, or in the fixed trash if there is no bin
+        or it is full. The travel saved is the round trip to the trash minus the one to the bin
+        '''
+        wells = bin_position(pip) if tip_bin['rack'] is not None else None
+        if wells is None:
+            if tip_bin['rack'] is not None and not tip_bin['full']:
+                tip_bin['full'] = True
+                ctx.comment('La papelera de puntas del slot ' + TIP_DISPOSAL_SLOT + ' está llena, se usa la papelera fija')
+            pip.drop_tip(home_after = False)
+            return
+        current = ctx.location_cache.point if ctx.location_cache else wells[0].top().point
+        trash = ctx.fixed_trash.wells()[0].top().point
+        target = wells[0].top().point
+        tip_bin['saved'] += 2 * (math.hypot(trash.x - current.x, trash.y - current.y) - math.hypot(target.x - current.x, target.y - current.y))
+        tip_bin['used'] += wells
+        pip.drop_tip(wells[0], home_after = False)
+
     log_parameters()
     start_run()
     CANCEL = not validate_parameters() # If there are errors in constant parameters, cancel protocol execution.
+    for error in layout_errors:
+        ctx.comment('ERROR: ' + error)
+        CANCEL = True
 
     ############################################################################
-    # STEP 1: TRANSFER SAMPLES
+    # STEP 1: DISPENSE MASTER MIX
     ############################################################################
     STEP += 1
     if STEPS[STEP]['Execute'] == True and not CANCEL:
         start = log_step_start()
 
-        for source, dest in zip(sample_cols, pcr_cols):
-            pick_up(m20)
-            move_vol_multichannel(m20, reagent = Samples, source = source[0], dest = dest[0],
+        cols_per_trip = int((pipette_allowed_capacity - master_mix_disposal_vol) // VOLUME_MASTER_MIX)
+        ctx.comment('Master mix: ' + str(round(MasterMix.vol_well_original)) + ' ul en el canal 1 del reservorio del slot 6')
+        ctx.comment('Columnas de la placa PCR por viaje: ' + str(cols_per_trip))
+
+        # Only the sample columns get master mix, the columns skipped with PCR_PLATE_COL_OFFSET are left untouched
+        pick_up(m20)
+        for dest_cols in divide_destinations([dest for source, dest, pip in pcr_index], cols_per_trip):
+            [pickup_height, change_col] = calc_height(MasterMix, multi_well_rack_area, VOLUME_MASTER_MIX * 8 * len(dest_cols))
+            distribute_master_mix(m20, MasterMix, source = MasterMix.reagent_reservoir[MasterMix.col],
+                    dest = dest_cols, vol = VOLUME_MASTER_MIX, disposal_vol = master_mix_disposal_vol, pickup_height = pickup_height,
+                    disp_height = master_mix_disp_height)
+
+        if recycle_tip :
+            m20.return_tip()
+        else:
+            drop_tip(m20)
+            tip_track['counts'][m20] += 8
+
+        log_step_end(start)
+
+    ############################################################################
+    # STEP 2: TRANSFER SAMPLES
+    ############################################################################
+    STEP += 1
+    if STEPS[STEP]['Execute'] == True and not CANCEL:
+        start = log_step_start()
+
+        for source, dest, pip in pcr_index:
+            pick_up(pip)
+            move_vol_multichannel(pip, reagent = Samples, source = source, dest = dest,
                     vol = VOLUME_PCR_SAMPLE + 5, air_gap_vol = air_gap_pcr_sample, x_offset = x_offset,
                     pickup_height = 0.1, disp_height = pcr_disp_height, v_offset = pcr_disp_height, rinse = False,
                     blow_out=True, touch_tip=dispense_touch_tip, radius = 1)
+            record_transfer(source, dest, pip)
             
             if dispense_touch_tip == False :
-                m20.aspirate(air_gap_vol)
+                pip.aspirate(air_gap_vol)
 
             if recycle_tip :
-                m20.return_tip()
+                pip.return_tip()
             else: 
-                m20.drop_tip(home_after = False)                
-                tip_track['counts'][m20]+=8
+                drop_tip(pip)                
+                tip_track['counts'][pip]+=8
 
         log_step_end(start)
 
 
     ############################################################################
     
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     finish_run()
@@ -31,7 +31,12 @@ VOLUME_PCR_SAMPLE           = 5     # Volume of the sample for PCR plate
 VOLUME_ARCHIVE_SAMPLE       = 95    # Volume of the sample to file
 PCR_PLATE_COL_OFFSET        = 0     # Number of PCR plate columns to skip dispensing samples
 PAUSE_ON_PCR_READY          = True  # Pause when PCR plate is ready to go
+INTERLEAVED_ALIQUOTING      = False # Aliquot every column to the PCR plate and to the archive in a single pass
 PHOTOSENSITIVE              = False # True if it has photosensitive reagents
+TIP_DISPOSAL_SLOT           = None  # Slot of an empty tip rack to drop the used tips near the plates, e.g. '3'. None for the fixed trash
+MASTER_MIX                  = False # Dispense the master mix into the PCR plate before the samples
+VOLUME_MASTER_MIX           = 15    # Master mix volume per PCR well. From 20 ul the m300 multi-dispenses several columns per trip,
+                                    # below it the m20 can only carry one column per trip (no multi-dispense at 15 ul)
 ################################################
 
 run_id                      = 'Station_C_FROM_Archive_TO_PCR_&_Archive'
@@ -46,11 +51,33 @@ sample_dispense_rate        = 100
 pcr_disp_height             = -10
 dispense_touch_tip          = True
 recycle_tip                 = False # Do you want to recycle tips? It shoud only be set True for testing
+gantry_speed                = 400   # Default gantry speed in mm/s, to estimate the travel saved by the tip bin
+master_mix_disposal_vol     = 2     # Extra volume aspirated in every master mix trip, returned to the reservoir
+master_mix_dead_vol         = 700   # Dead volume of the master mix channel in the 12 well reservoir
+master_mix_disp_height      = -2    # Master mix dispense height from the top of the PCR wells
+multi_well_rack_area        = 8 * 71 # Cross section of the 12 well reservoir
+master_mix_channel_volume   = 15000 # Capacity of the master mix channel in the 12 well reservoir
+master_mix_tips_slot        = '9'   # Slot of the extra tip rack when the master mix tips do not fit with the samples
 
 PAUSE_ON_PCR_READY_MESSAGE = "Se ha finalizado la dispensación en la placa PCR, presiona RESUME para comenzar la dispensación en los pitufos del archivo"
+PAUSE_ON_PCR_READY_INTERLEAVED_MESSAGE = "Se ha finalizado la dispensación en la placa PCR, retírala y presiona RESUME para terminar la dispensación en los pitufos del archivo"
 
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
+# Layouts of the transfers, by labware slot
+PCR_LAYOUT = {
+    'name': 'Placa PCR',
+    'unit': 'columns',
+    'source': {'slots': ['5']},
+    'dest': {'slots': ['4'], 'offset': PCR_PLATE_COL_OFFSET, 'controls': []}
+    }
+ARCHIVE_LAYOUT = {
+    'name': 'Archivo',
+    'unit': 'columns',
+    'source': {'slots': ['5']},
+    'dest': {'slots': ['1', '2'], 'stride': 2} # Odd columns of the archive plates
+    }
+
 
 def validate_constants():
     result = True
@@ -67,19 +94,93 @@ def validate_constants():
     if PCR_PLATE_COL_OFFSET * 8 + NUM_SAMPLES > 96:
         ctx.comment ("ERROR: No hay espacio suficiente en la placa PCR para " + NUM_SAMPLES + " muestras ignorando las " + PCR_PLATE_COL_OFFSET + " primeras columnas.")
         result = False
+    if MASTER_MIX and VOLUME_MASTER_MIX <= 0:
+        ctx.comment ("ERROR: Volumen de master mix inválido: " + str(VOLUME_MASTER_MIX))
+        result = False
+    if MASTER_MIX and VOLUME_MASTER_MIX < 20 and VOLUME_MASTER_MIX + master_mix_disposal_vol > pipette_allowed_capacity:
+        ctx.comment ("ERROR: El volumen de master mix " + str(VOLUME_MASTER_MIX) + " ul no cabe en las puntas de 20 ul.")
+        result = False
+    if MASTER_MIX and VOLUME_MASTER_MIX * 8 * num_cols + master_mix_dead_vol > master_mix_channel_volume:
+        ctx.comment ("ERROR: El master mix de " + str(num_cols) + " columnas más el volumen muerto no cabe en un canal del reservorio.")
+        result = False
+    if MASTER_MIX and TIP_DISPOSAL_SLOT == master_mix_tips_slot:
+        ctx.comment ("ERROR: El slot " + master_mix_tips_slot + " es para las puntas del master mix, usa otro slot para la papelera de puntas.")
+        result = False
 
     return result
 
+################################################
+# Plate to plate layouts
+################################################
+def layout_positions(labware, side, unit):
+    '''
+    Positions (columns or wells, by unit) of one side of a layout, in filling order. side is a dict
+    with the slots of the labware in filling order and optionally the stride (take one column every
+    stride), the offset (positions skipped at the beginning) and the controls (names of the wells
+    reserved for controls in every labware, their positions are never used).
+    '''
+    positions = []
+    controls = []
+    for slot in side['slots']:
+        columns = labware[slot].columns()[::side.get('stride', 1)]
+        positions += columns if unit == 'columns' else [[well] for column in columns for well in column]
+        controls += [str(labware[slot].wells_by_name()[name]) for name in side.get('controls', [])]
+    positions = positions[side.get('offset', 0):]
+    return [p for p in positions if not [well for well in p if str(well) in controls]]
+
+def compile_layout(labware, layout, count, pipette):
+    '''
+    Compile a layout into an immutable index of (source well, destination well, pipette) tuples
+    for the first count positions. With the unit 'columns' the wells are the tops of the columns.
+    Returns the index, the wells it uses and a list of errors if there are not enough positions.
+    '''
+    unit = layout.get('unit', 'wells')
+    sources = layout_positions(labware, layout['source'], unit)
+    dests = layout_positions(labware, layout['dest'], unit)
+    errors = []
+    for side, positions in (('origen', sources), ('destino', dests)):
+        if count > len(positions):
+            errors.append(layout['name'] + ': ' + str(count) + ' posiciones necesarias y solo hay ' + str(len(positions)) + ' en el ' + side)
+    index = tuple((s[0], d[0], pipette) for s, d in zip(sources[:count], dests[:count]))
+    wells = {
+        'source': [well for s in sources[:count] for well in s],
+        'dest': [well for d in dests[:count] for well in d]
+        }
+    return index, wells, errors
+
+def check_layouts(compiled):
+    '''
+    Check that no well is filled twice and that no destination well is the source of another layout.
+    compiled is a list of (name, wells) with the wells returned by compile_layout.
+    '''
+    errors = []
+    filled = {}
+    for name, wells in compiled:
+        for well in wells['dest']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo ' + str(well) + ' ya se llena en ' + filled[str(well)])
+            filled[str(well)] = name
+    for name, wells in compiled:
+        for well in wells['source']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo de origen ' + str(well) + ' se llena en ' + filled[str(well)])
+    return errors
+
 def run(ctx: protocol_api.ProtocolContext):
     ctx.comment('Columnas a utilizar: ' + str(num_cols))
 
     # Define the STEPS of the protocol
     STEP = 0
     STEPS = {  # Dictionary with STEP activation, description, and times
-        1: {'Execute': True, 'description': 'Transferir muestras a la placa PCR'},
-        2: {'Execute': True, 'description': 'Transferir muestras a los pitufos'}
+        1: {'Execute': MASTER_MIX, 'description': 'Dispensar master mix en la placa PCR'},
+        2: {'Execute': True, 'description': 'Transferir muestras a la placa PCR'},
+        3: {'Execute': True, 'description': 'Transferir muestras a los pitufos'}
     }
 
+    if INTERLEAVED_ALIQUOTING: # PCR and archive aliquots of every column are done in STEP 2
+        STEPS[2]['description'] = 'Transferir muestras a la placa PCR y a los pitufos'
+        STEPS[3]['Execute'] = False
+
     for s in STEPS:  # Create an empty wait_time
         if 'wait_time' not in STEPS[s]:
             STEPS[s]['wait_time'] = 0
@@ -90,6 +191,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_C_time_log.txt'
+        map_path = folder_path + '/Station_C_well_map.txt'
 
 
     #Define Reagents as objects with their properties
@@ -125,6 +227,21 @@ def run(ctx: protocol_api.ProtocolContext):
                       v_fondo=0
                       )
 
+    MasterMix = Reagent(name='Master mix',
+                      rinse=False,
+                      flow_rate_aspirate = 1,
+                      flow_rate_dispense = 1,
+                      max_volume_allowed = 180,
+                      disposal_volume = master_mix_disposal_vol,
+                      dead_vol = master_mix_dead_vol,
+                      h_cono = 1.95,
+                      v_fondo = 695 #1.95 * multi_well_rack_area / 2, #Prismatic
+                      )
+
+    MasterMix.vol_well_original = VOLUME_MASTER_MIX * 8 * num_cols + MasterMix.dead_vol
+    MasterMix.vol_well = MasterMix.vol_well_original
+    MasterMix.unused = []
+
     ##################
     # Custom functions
     
@@ -138,7 +255,11 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Volumen a transferir a los pitufos: ' + str(VOLUME_ARCHIVE_SAMPLE)+ ' ul') 
         ctx.comment('Columnas a ser ignoradas en la placa PCR: ' + str(PCR_PLATE_COL_OFFSET))
         ctx.comment('Pausar tras terminar la dispensación de la placa PCR: ' + str(PAUSE_ON_PCR_READY))
+        ctx.comment('Dispensación intercalada PCR y archivo: ' + str(INTERLEAVED_ALIQUOTING))
         ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE)) 
+        ctx.comment('Dispensar master mix: ' + str(MASTER_MIX))
+        if MASTER_MIX:
+            ctx.comment('Volumen de master mix por pocillo: ' + str(VOLUME_MASTER_MIX) + ' ul')
         ctx.comment('###############################################')
         ctx.comment(' ')
 
@@ -203,12 +324,36 @@ def run(ctx: protocol_api.ProtocolContext):
                 time.sleep(0.3)
         ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
 
+        if tip_bin['rack'] is not None:
+            ctx.comment('Recorrido ahorrado con la papelera de puntas: ' + str(round(tip_bin['saved'] / 1000, 1)) + ' m, unos ' + str(round(tip_bin['saved'] / gantry_speed)) + ' segundos')
         ctx.comment('Puntas de  20 ul utilizadas: ' + str(tip_track['counts'][m20]) + ' (' + str(round(tip_track['counts'][m20] / 96, 2)) + ' caja(s))')
         ctx.comment('Puntas de 200 ul utilizadas: ' + str(tip_track['counts'][m300]) + ' (' + str(round(tip_track['counts'][m300] / 96, 2)) + ' caja(s))')
         ctx.comment('###############################################')
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def record_transfer(source, dest, pip):
+        # Plates are named by their slot in the layouts
+        slots = {id(lw): slot for slot, lw in labware.items()}
+        record_well_map(lineage_names[slots[id(source.parent)]], source,
+            lineage_names[slots[id(dest.parent)]], dest, pip.channels)
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -258,6 +403,16 @@ def run(ctx: protocol_api.ProtocolContext):
             pipette.blow_out(waste_pool.bottom(pickup_height + 3))
         return (len(dest) * volume)
     
+    def distribute_master_mix(pipet, reagent, source, dest, vol, disposal_vol, pickup_height, disp_height):
+        '''
+        Multi-dispense vol in every column of dest from a single aspiration, without touching the liquid.
+        The disposal volume is returned to the source with the blow out.
+        '''
+        pipet.aspirate(len(dest) * vol + disposal_vol, source.bottom(pickup_height), rate = reagent.flow_rate_aspirate)
+        for d in dest:
+            pipet.dispense(vol, d.top(z = disp_height), rate = reagent.flow_rate_dispense)
+        pipet.blow_out(source.top(z = -2))
+
     def move_vol_multi(pipet, reagent, source, dest, vol, pickup_height, rinse, 
         avoid_droplet, wait_time, blow_out, touch_tip = False, touch_tip_v_offset = 0, drop_height = -5, 
         aspirate_with_x_scroll = False, dispense_bottom_air_gap_before = False, x_offset_source = 0, x_offset_dest = 0):
@@ -415,13 +570,6 @@ def run(ctx: protocol_api.ProtocolContext):
     archive_plate2 = ctx.load_labware(
         'nest_96_wellplate_100ul_pcr_full_skirt', '2',
         'NEST 96 Well Plate 100 uL PCR Full Skirt')
-    
-    source_sample_cols = source_plate.columns()[:num_cols]
-
-    samples_archive1_cols = archive_plate1.columns()[0::2] # Select odd columns from source plate
-    samples_archive2_cols = archive_plate2.columns()[0::2] # Select odd columns from source plate
-
-    sample_archive_cols = samples_archive1_cols + samples_archive2_cols 
 
     ##################################
     # qPCR plate - final plate, goes to PCR
@@ -429,6 +577,12 @@ def run(ctx: protocol_api.ProtocolContext):
         'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '4',
         'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
 
+    ##################################
+    # Master mix reservoir
+    if MASTER_MIX:
+        master_mix_res = ctx.load_labware('nest_12_reservoir_15ml', '6', 'master mix reservoir')
+        MasterMix.reagent_reservoir = master_mix_res.rows()[0]
+
     ##################################
     # Load Tipracks
     tips20 = [
@@ -441,15 +595,33 @@ def run(ctx: protocol_api.ProtocolContext):
         for slot in ['10']
     ]
 
+    ##################################
+    # Tip bin near the plates, an empty tip rack
+    tip_bin = {'rack': None, 'used': [], 'full': False, 'saved': 0}
+    if TIP_DISPOSAL_SLOT is not None:
+        tip_bin['rack'] = ctx.load_labware('opentrons_96_tiprack_300ul', TIP_DISPOSAL_SLOT, 'tip bin')
+
     ################################################################################
-    
-    # setup up sample sources and destinationssample_cols
-    pcr_cols = qpcr_plate.columns()[PCR_PLATE_COL_OFFSET:num_cols+PCR_PLATE_COL_OFFSET]
 
     # pipettes
     m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks = tips300) # Load multi pipette
     m20  = ctx.load_instrument('p20_multi_gen2', mount='right', tip_racks=tips20)
 
+    if MASTER_MIX:
+        # The m300 multi-dispenses the whole plate in a few trips, volumes under its minimum go with the m20
+        mm_pip = m300 if VOLUME_MASTER_MIX >= m300.min_volume else m20
+        # The master mix takes one more tip column than the samples, in an extra rack if the pipette runs out of tips
+        if num_cols + 1 > 12 * len(mm_pip.tip_racks):
+            mm_pip.tip_racks = mm_pip.tip_racks + [ctx.load_labware(mm_pip.tip_racks[0].load_name, master_mix_tips_slot, 'master mix tiprack')]
+
+    # setup up sample sources and destinations
+    labware = {'5': source_plate, '1': archive_plate1, '2': archive_plate2, '4': qpcr_plate}
+    lineage_names = {'5': 'elution', '1': 'archive 1', '2': 'archive 2', '4': 'pcr'} # Names of the plates in the well map
+    pcr_index, pcr_layout_wells, layout_errors = compile_layout(labware, PCR_LAYOUT, num_cols, m20)
+    archive_index, archive_layout_wells, archive_layout_errors = compile_layout(labware, ARCHIVE_LAYOUT, num_cols, m300)
+    layout_errors += archive_layout_errors + check_layouts([(PCR_LAYOUT['name'], pcr_layout_wells),
+        (ARCHIVE_LAYOUT['name'], archive_layout_wells)])
+
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': { m20: 0 , m300: 0},
@@ -475,45 +647,153 @@ def run(ctx: protocol_api.ProtocolContext):
             pip.pick_up_tip()
     ##########
 
+    def bin_position(pip):
+        # Next free position of the tip bin for all the channels of the pipette, None if it is full
+        rack = tip_bin['rack']
+        if pip.channels == 1:
+            # Single tips fill the bin from the end, leaving whole columns for the multichannel
+            candidates = [[well] for well in reversed(rack.wells())]
+        else:
+            candidates = rack.columns()
+        for wells in candidates:
+            if not any(well in tip_bin['used'] for well in wells):
+                return wells
+        return None
+
+    def drop_tip(pip):
+        '''
+        Drop the tip in the tip bin next to the plates, or in the fixed trash if there is no bin
+        or it is full. The travel saved is the round trip to the trash minus the one to the bin
+        '''
+        wells = bin_position(pip) if tip_bin['rack'] is not None else None
+        if wells is None:
+            if tip_bin['rack'] is not None and not tip_bin['full']:
+                tip_bin['full'] = True
+                ctx.comment('La papelera de puntas del slot ' + TIP_DISPOSAL_SLOT + ' está llena, se usa la papelera fija')
+            pip.drop_tip(home_after = False)
+            return
+        current = ctx.location_cache.point if ctx.location_cache else wells[0].top().point
+        trash = ctx.fixed_trash.wells()[0].top().point
+        target = wells[0].top().point
+        tip_bin['saved'] += 2 * (math.hypot(trash.x - current.x, trash.y - current.y) - math.hypot(target.x - current.x, target.y - current.y))
+        tip_bin['used'] += wells
+        pip.drop_tip(wells[0], home_after = False)
+
+    def transfer_pcr_column(i):
+        source, dest, pip = pcr_index[i]
+        pick_up(pip)
+        move_vol_multichannel(pip, reagent = Samples, source = source, dest = dest,
+                vol = VOLUME_PCR_SAMPLE, air_gap_vol = air_gap_pcr_sample, x_offset = x_offset,
+                pickup_height = 0.1, disp_height = pcr_disp_height, v_offset = pcr_disp_height, rinse = False,
+                blow_out=True, touch_tip=dispense_touch_tip, radius = 1)
+        record_transfer(source, dest, pip)
+
+        if dispense_touch_tip == False :
+            pip.aspirate(air_gap_vol)
+
+        if recycle_tip :
+            pip.return_tip()
+        else: 
+            drop_tip(pip)                
+            tip_track['counts'][pip]+=8
+
+    archive_trips = math.ceil(VOLUME_ARCHIVE_SAMPLE / Samples.max_volume_allowed)
+    archive_vol = [VOLUME_ARCHIVE_SAMPLE / archive_trips + Samples.disposal_volume for i in range(archive_trips)]
+
+    def transfer_archive_column(i):
+        source, dest, pip = archive_index[i]
+        if not pip.hw_pipette['has_tip']:
+            pick_up(pip)
+        for transfer_vol in archive_vol:
+            #Pickup_height is fixed here
+            pickup_height = 1
+            ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
+            ctx.comment('La altura de recogida es ' + str(pickup_height) )
+
+            move_vol_multi(
+                    pip, reagent = Samples, source = source,
+                    dest = dest, vol = transfer_vol, pickup_height = pickup_height, rinse = False, avoid_droplet = False, 
+                    wait_time = 0, blow_out = True, touch_tip = dispense_touch_tip,
+                    drop_height = 3)
+
+            if dispense_touch_tip == False :
+                pip.aspirate(air_gap_vol)
+
+        record_transfer(source, dest, pip)
+
+        if recycle_tip == True:
+            pip.return_tip()
+        else:
+            drop_tip(pip)
+            tip_track['counts'][pip] += 8
+
     log_parameters()
     start_run()
     CANCEL = not validate_constants() # If there are errors in constant parameters, cancel protocol execution.
+    for error in layout_errors:
+        ctx.comment('ERROR: ' + error)
+        CANCEL = True
 
     ############################################################################
-    # STEP 1: TRANSFER SAMPLES
+    # STEP 1: DISPENSE MASTER MIX
     ############################################################################
     STEP += 1
     if STEPS[STEP]['Execute'] == True and not CANCEL:
         start = log_step_start()
 
-        for source, dest in zip(source_sample_cols, pcr_cols):
-            pick_up(m20)
-            move_vol_multichannel(m20, reagent = Samples, source = source[0], dest = dest[0],
-                    vol = VOLUME_PCR_SAMPLE, air_gap_vol = air_gap_pcr_sample, x_offset = x_offset,
-                    pickup_height = 0.1, disp_height = pcr_disp_height, v_offset = pcr_disp_height, rinse = False,
-                    blow_out=True, touch_tip=dispense_touch_tip, radius = 1)
+        mm_capacity = MasterMix.max_volume_allowed if mm_pip == m300 else pipette_allowed_capacity
+        cols_per_trip = int((mm_capacity - MasterMix.disposal_volume) // VOLUME_MASTER_MIX)
+        ctx.comment('Master mix: ' + str(round(MasterMix.vol_well_original)) + ' ul en el canal 1 del reservorio del slot 6')
+        ctx.comment('Columnas de la placa PCR por viaje: ' + str(cols_per_trip))
+
+        # Only the sample columns get master mix, the columns skipped with PCR_PLATE_COL_OFFSET are left untouched
+        pick_up(mm_pip)
+        for dest_cols in divide_destinations([dest for source, dest, pip in pcr_index], cols_per_trip):
+            [pickup_height, change_col] = calc_height(MasterMix, multi_well_rack_area, VOLUME_MASTER_MIX * 8 * len(dest_cols))
+            distribute_master_mix(mm_pip, MasterMix, source = MasterMix.reagent_reservoir[MasterMix.col],
+                    dest = dest_cols, vol = VOLUME_MASTER_MIX, disposal_vol = MasterMix.disposal_volume, pickup_height = pickup_height,
+                    disp_height = master_mix_disp_height)
+
+        if recycle_tip :
+            mm_pip.return_tip()
+        else:
+            drop_tip(mm_pip)
+            tip_track['counts'][mm_pip] += 8
 
-            if dispense_touch_tip == False :
-                m20.aspirate(air_gap_vol)
+        log_step_end(start)
+
+    ############################################################################
+    # STEP 2: TRANSFER SAMPLES
+    ############################################################################
+    STEP += 1
+    if STEPS[STEP]['Execute'] == True and not CANCEL:
+        start = log_step_start()
 
-            if recycle_tip :
-                m20.return_tip()
-            else: 
-                m20.drop_tip(home_after = False)                
-                tip_track['counts'][m20]+=8
+        if INTERLEAVED_ALIQUOTING:
+            for i in range(num_cols):
+                transfer_pcr_column(i)
+                if i == num_cols - 1:
+                    # Release the PCR plate before the last archive aliquot
+                    ctx.comment('Placa PCR lista')
+                    if PAUSE_ON_PCR_READY:
+                        pause_protocol(PAUSE_ON_PCR_READY_INTERLEAVED_MESSAGE)
+                transfer_archive_column(i)
+        else:
+            for i in range(num_cols):
+                transfer_pcr_column(i)
 
         log_step_end(start)
 
-        if PAUSE_ON_PCR_READY:
+        if PAUSE_ON_PCR_READY and not INTERLEAVED_ALIQUOTING:
             pause_protocol(PAUSE_ON_PCR_READY_MESSAGE)
     
     ############################################################################
-    # STEP 1: TRANSFER SAMPLES
+    # STEP 2: TRANSFER SAMPLES
     ############################################################################
 
     
     ###############################################################################
-    # STEP 2 TRANSFER TO FINAL PLATES
+    # STEP 3 TRANSFER TO FINAL PLATES
     ###############################################################################
     
     ctx._hw_manager.hardware.set_lights(button = True, rails =  not PHOTOSENSITIVE)
@@ -521,42 +801,22 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute']==True and not CANCEL:
         start = log_step_start()
 
-        elution_trips = math.ceil(VOLUME_ARCHIVE_SAMPLE / Samples.max_volume_allowed)
-        elution_volume = VOLUME_ARCHIVE_SAMPLE / elution_trips
-        elution_vol = []
-        for i in range(elution_trips):
-            elution_vol.append(elution_volume + Samples.disposal_volume)
-        x_offset_rs = 2
         for i in range(num_cols):
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in elution_vol:
-                #Pickup_height is fixed here
-                pickup_height = 1
-                ctx.comment('Aspirando de la columna del deepwell: ' + str(i+1))
-                ctx.comment('La altura de recogida es ' + str(pickup_height) )
-
-                move_vol_multi(
-                        m300, reagent = Samples, source = source_sample_cols[i][0],
-                        dest = sample_archive_cols[i][0], vol = transfer_vol, pickup_height = pickup_height, rinse = False, avoid_droplet = False, 
-                        wait_time = 0, blow_out = True, touch_tip = dispense_touch_tip,
-                        drop_height = 3)
-
-                if dispense_touch_tip == False :
-                    m300.aspirate(air_gap_vol)
-
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-                tip_track['counts'][m300] += 8
+            transfer_archive_column(i)
 
         log_step_end(start)
 
         ###############################################################################
-        # STEP 2 TRANSFER TO FINAL PLATES
+        # STEP 3 TRANSFER TO FINAL PLATES
         ########
 
     ############################################################################
         
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     finish_run()
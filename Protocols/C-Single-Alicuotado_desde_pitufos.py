@@ -25,6 +25,8 @@ metadata = {
 NUM_SAMPLES                 = 96    # Number of samples to be moved.
 VOLUME_PCR_SAMPLE           = 5     # Sample volume to be moved to PCR plate
 PHOTOSENSITIVE              = False # True if it has photosensitive reagents
+TIP_DISPOSAL_SLOT           = None  # Slot of an empty tip rack to drop the used tips near the plates, e.g. '3'. None for the fixed trash
+HYBRID_MODE                 = False # Use a p20 multi (left mount) for complete columns and the p20 single for the rest
 ################################################
 
 run_id                      = 'Station_C_FROM_Archive_TO_PCR_&_Archive'
@@ -39,9 +41,75 @@ pcr_disp_height             = -10
 dispense_touch_tip          = True # Touch well sides to avoid tip drops
 pcr_plate_well_offset       = 0 # Number of pcr plate wells to skip
 recycle_tip                 = False # Recycle tips for testing purposes
+gantry_speed                = 400   # Default gantry speed in mm/s, to estimate the travel saved by the tip bin
 
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
+# Layout of the transfers, by labware slot
+PCR_LAYOUT = {
+    'name': 'Placa PCR',
+    'unit': 'wells',
+    'source': {'slots': ['1', '2'], 'stride': 2}, # Odd columns of the archive plates
+    'dest': {'slots': ['4'], 'offset': pcr_plate_well_offset, 'controls': []}
+    }
+
+################################################
+# Plate to plate layouts
+################################################
+def layout_positions(labware, side, unit):
+    '''
+    Positions (columns or wells, by unit) of one side of a layout, in filling order. side is a dict
+    with the slots of the labware in filling order and optionally the stride (take one column every
+    stride), the offset (positions skipped at the beginning) and the controls (names of the wells
+    reserved for controls in every labware, their positions are never used).
+    '''
+    positions = []
+    controls = []
+    for slot in side['slots']:
+        columns = labware[slot].columns()[::side.get('stride', 1)]
+        positions += columns if unit == 'columns' else [[well] for column in columns for well in column]
+        controls += [str(labware[slot].wells_by_name()[name]) for name in side.get('controls', [])]
+    positions = positions[side.get('offset', 0):]
+    return [p for p in positions if not [well for well in p if str(well) in controls]]
+
+def compile_layout(labware, layout, count, pipette):
+    '''
+    Compile a layout into an immutable index of (source well, destination well, pipette) tuples
+    for the first count positions. With the unit 'columns' the wells are the tops of the columns.
+    Returns the index, the wells it uses and a list of errors if there are not enough positions.
+    '''
+    unit = layout.get('unit', 'wells')
+    sources = layout_positions(labware, layout['source'], unit)
+    dests = layout_positions(labware, layout['dest'], unit)
+    errors = []
+    for side, positions in (('origen', sources), ('destino', dests)):
+        if count > len(positions):
+            errors.append(layout['name'] + ': ' + str(count) + ' posiciones necesarias y solo hay ' + str(len(positions)) + ' en el ' + side)
+    index = tuple((s[0], d[0], pipette) for s, d in zip(sources[:count], dests[:count]))
+    wells = {
+        'source': [well for s in sources[:count] for well in s],
+        'dest': [well for d in dests[:count] for well in d]
+        }
+    return index, wells, errors
+
+def check_layouts(compiled):
+    '''
+    Check that no well is filled twice and that no destination well is the source of another layout.
+    compiled is a list of (name, wells) with the wells returned by compile_layout.
+    '''
+    errors = []
+    filled = {}
+    for name, wells in compiled:
+        for well in wells['dest']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo ' + str(well) + ' ya se llena en ' + filled[str(well)])
+            filled[str(well)] = name
+    for name, wells in compiled:
+        for well in wells['source']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo de origen ' + str(well) + ' se llena en ' + filled[str(well)])
+    return errors
+
 def run(ctx: protocol_api.ProtocolContext):
     ctx.comment('Columnas a utilizar: ' + str(num_cols))
 
@@ -61,6 +129,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_C_time_log.txt'
+        map_path = folder_path + '/Station_C_well_map.txt'
 
     # Define Reagents as objects with their properties
     class Reagent:
@@ -107,6 +176,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Número de muestras: ' + str(NUM_SAMPLES)) 
         ctx.comment('Volumen a transferir a la placa PCR: ' + str(VOLUME_PCR_SAMPLE)+ ' ul') 
         ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE)) 
+        ctx.comment('Modo híbrido multicanal/monocanal: ' + str(HYBRID_MODE))
         ctx.comment('###############################################')
         ctx.comment(' ')
 
@@ -146,11 +216,37 @@ def run(ctx: protocol_api.ProtocolContext):
                 time.sleep(0.3)
         ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
 
+        if tip_bin['rack'] is not None:
+            ctx.comment('Recorrido ahorrado con la papelera de puntas: ' + str(round(tip_bin['saved'] / 1000, 1)) + ' m, unos ' + str(round(tip_bin['saved'] / gantry_speed)) + ' segundos')
         ctx.comment('Puntas de 20 ul utilizadas: ' + str(tip_track['counts'][p20]) + ' (' + str(round(tip_track['counts'][p20] / 96, 2)) + ' caja(s))')
+        if HYBRID_MODE:
+            ctx.comment('Puntas de 20 ul multicanal utilizadas: ' + str(tip_track['counts'][m20]) + ' (' + str(round(tip_track['counts'][m20] / 96, 2)) + ' caja(s))')
         ctx.comment('###############################################')
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def record_transfer(source, dest, pip):
+        # Plates are named by their slot in the layouts
+        slots = {id(lw): slot for slot, lw in labware.items()}
+        record_well_map(lineage_names[slots[id(source.parent)]], source,
+            lineage_names[slots[id(dest.parent)]], dest, pip.channels)
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -199,6 +295,23 @@ def run(ctx: protocol_api.ProtocolContext):
             pipet.touch_tip(speed = 20, v_offset = v_offset, radius = radius)
 
 
+    def plan_transfers(sources, dests, columns, multi = None):
+        '''
+        Pair every source well with its destination well. Every group of 8 wells that fills a whole
+        column in both the source and the destination is moved at once with the multichannel pipette,
+        the rest of the wells (partial or non-contiguous columns) with the single channel one.
+        '''
+        plan = []
+        i = 0
+        while i < len(sources):
+            if multi is not None and sources[i:i + 8] in columns and dests[i:i + 8] in columns:
+                plan.append((multi, sources[i], dests[i]))
+                i += 8
+            else:
+                plan.append((p20, sources[i], dests[i]))
+                i += 1
+        return plan
+
     def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
     x_offset, source_height = 3):
         '''
@@ -237,15 +350,6 @@ def run(ctx: protocol_api.ProtocolContext):
     source_plate2 = ctx.load_labware(
         'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2',
         'Opentrons 96 Well Aluminum Block with Generic PCR Strip 200 µL')
-    
-    samples_source1 = source_plate1.columns()[0::2] # Select odd columns from source plate
-    samples_source2 = source_plate2.columns()[0::2] # Select odd columns from source plate
-
-    samples_source1 = [well for columns in samples_source1 for well in columns] # list of lists to list
-    samples_source2 = [well for columns in samples_source2 for well in columns]
-
-    samples =samples_source1 + samples_source2 
-    samples = samples[:NUM_SAMPLES]
 
     ##################################
     # qPCR plate - final plate, goes to PCR
@@ -260,10 +364,19 @@ def run(ctx: protocol_api.ProtocolContext):
         for slot in ['7']
     ]
 
+    if HYBRID_MODE:
+        tips20_multi = [
+            ctx.load_labware('opentrons_96_filtertiprack_20ul', slot)
+            for slot in ['8']
+        ]
+
+    ##################################
+    # Tip bin near the plates, an empty tip rack
+    tip_bin = {'rack': None, 'used': [], 'full': False, 'saved': 0}
+    if TIP_DISPOSAL_SLOT is not None:
+        tip_bin['rack'] = ctx.load_labware('opentrons_96_tiprack_300ul', TIP_DISPOSAL_SLOT, 'tip bin')
+
     ################################################################################
-    
-    # setup up sample sources and destinations
-    pcr_wells = qpcr_plate.wells()[pcr_plate_well_offset:NUM_SAMPLES+pcr_plate_well_offset]
 
     # pipettes
     p20 = ctx.load_instrument(
@@ -275,6 +388,24 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': { p20: 96 * len(p20.tip_racks)}
     }
 
+    if HYBRID_MODE:
+        m20 = ctx.load_instrument('p20_multi_gen2', mount='left', tip_racks=tips20_multi) # Complete columns
+        tip_track['counts'][m20] = 0
+        tip_track['maxes'][m20] = 96 * len(m20.tip_racks)
+
+    # setup up sample sources and destinations
+    labware = {'1': source_plate1, '2': source_plate2, '4': qpcr_plate}
+    lineage_names = {'1': 'elution 1', '2': 'elution 2', '4': 'pcr'} # Names of the plates in the well map
+    pcr_index, pcr_layout_wells, layout_errors = compile_layout(labware, PCR_LAYOUT, NUM_SAMPLES, p20)
+    layout_errors += check_layouts([(PCR_LAYOUT['name'], pcr_layout_wells)])
+    if layout_errors:
+        for error in layout_errors:
+            ctx.comment('ERROR: ' + error)
+        raise Exception('La distribución de las placas no es válida')
+
+    pcr_plan = plan_transfers([source for source, dest, pip in pcr_index], [dest for source, dest, pip in pcr_index],
+        source_plate1.columns() + source_plate2.columns() + qpcr_plate.columns(), multi = m20 if HYBRID_MODE else None)
+
     ##########
     # pick up tip and if there is none left, prompt user for a new rack
     def pick_up(pip):
@@ -290,6 +421,38 @@ def run(ctx: protocol_api.ProtocolContext):
             pip.pick_up_tip()
     ##########
 
+    def bin_position(pip):
+        # Next free position of the tip bin for all the channels of the pipette, None if it is full
+        rack = tip_bin['rack']
+        if pip.channels == 1:
+            # Single tips fill the bin from the end, leaving whole columns for the multichannel
+            candidates = [[well] for well in reversed(rack.wells())]
+        else:
+            candidates = rack.columns()
+        for wells in candidates:
+            if not any(well in tip_bin['used'] for well in wells):
+                return wells
+        return None
+
+    def drop_tip(pip):
+        '''
+        Drop the tip in the tip bin next to the plates, or in the fixed trash if there is no bin
+        or it is full. The travel saved is the round trip to the trash minus the one to the bin
+        '''
+        wells = bin_position(pip) if tip_bin['rack'] is not None else None
+        if wells is None:
+            if tip_bin['rack'] is not None and not tip_bin['full']:
+                tip_bin['full'] = True
+                ctx.comment('La papelera de puntas del slot ' + TIP_DISPOSAL_SLOT + ' está llena, se usa la papelera fija')
+            pip.drop_tip(home_after = False)
+            return
+        current = ctx.location_cache.point if ctx.location_cache else wells[0].top().point
+        trash = ctx.fixed_trash.wells()[0].top().point
+        target = wells[0].top().point
+        tip_bin['saved'] += 2 * (math.hypot(trash.x - current.x, trash.y - current.y) - math.hypot(target.x - current.x, target.y - current.y))
+        tip_bin['used'] += wells
+        pip.drop_tip(wells[0], home_after = False)
+
     log_parameters()
     start_run()
     ############################################################################
@@ -299,25 +462,33 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute'] == True:
         start = log_step_start()
 
-        for source, dest in zip(samples, pcr_wells):
-            pick_up(p20)
-            move_vol_multichannel(p20, reagent = Samples, source = source, dest = dest,
+        for pip, source, dest in pcr_plan:
+            pick_up(pip)
+            move_vol_multichannel(pip, reagent = Samples, source = source, dest = dest,
                     vol = VOLUME_PCR_SAMPLE + 5, air_gap_vol = air_gap_pcr_sample, x_offset = x_offset,
                     pickup_height = 0.1, disp_height = pcr_disp_height, v_offset = pcr_disp_height, rinse = False,
                     blow_out=True, touch_tip=dispense_touch_tip, radius = 1)
+            record_transfer(source, dest, pip)
             
             if dispense_touch_tip == False :
-                p20.aspirate(air_gap_vol)
+                pip.aspirate(air_gap_vol)
 
             if recycle_tip :
-                p20.return_tip()
+                pip.return_tip()
             else: 
-                p20.drop_tip(home_after = False)                
-                tip_track['counts'][p20]+=1
+                drop_tip(pip)                
+                tip_track['counts'][pip] += pip.channels
 
         log_step_end(start)
 
 
     ############################################################################
     
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     finish_run()
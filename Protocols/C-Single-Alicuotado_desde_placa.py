@@ -30,6 +30,10 @@ VOLUME_PCR_SAMPLE           = 5     # Volume of the sample for PCR plate
 VOLUME_ARCHIVE_SAMPLE       = 95    # Volume of the sample to file
 PAUSE_ON_PCR_READY          = True  # Pause when PCR plate is ready to go
 PHOTOSENSITIVE              = False # True if it has photosensitive reagents
+TIP_DISPOSAL_SLOT           = None  # Slot of an empty tip rack to drop the used tips near the plates, e.g. '3'. None for the fixed trash
+HYBRID_MODE                 = False # Use a p20 multi (left mount, instead of the p300 multi) for complete columns and the p20 single for the rest
+                                    # The p20 multi also fills the archive: 95 ul take 7 trips per column instead of 1 (84 dispenses
+                                    # instead of 12), so a full plate needs 96 trips instead of 108, not 12 instead of 96
 ##################
 
 run_id                      = 'Station_C_FROM_Archive_TO_PCR_&_Archive'
@@ -45,11 +49,83 @@ pcr_disp_height             = -10
 dispense_touch_tip          = True
 pcr_plate_well_offset       = 0
 recycle_tip                 = False # Do you want to recycle tips? It shoud only be set True for testing
+gantry_speed                = 400   # Default gantry speed in mm/s, to estimate the travel saved by the tip bin
 
 PAUSE_ON_PCR_READY_MESSAGE = "Se ha finalizado la dispensación en la placa PCR, presiona RESUME para comenzar la dispensación en los pitufos del archivo"
 
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
 
+# Layouts of the transfers, by labware slot
+PCR_LAYOUT = {
+    'name': 'Placa PCR',
+    'unit': 'wells',
+    'source': {'slots': ['5']},
+    'dest': {'slots': ['4'], 'offset': pcr_plate_well_offset, 'controls': []}
+    }
+ARCHIVE_LAYOUT = {
+    'name': 'Archivo',
+    'unit': 'columns',
+    'source': {'slots': ['5']},
+    'dest': {'slots': ['1', '2'], 'stride': 2} # Odd columns of the archive plates
+    }
+
+
+################################################
+# Plate to plate layouts
+################################################
+def layout_positions(labware, side, unit):
+    '''
+    Positions (columns or wells, by unit) of one side of a layout, in filling order. side is a dict
+    with the slots of the labware in filling order and optionally the stride (take one column every
+    stride), the offset (positions skipped at the beginning) and the controls (names of the wells
+    reserved for controls in every labware, their positions are never used).
+    '''
+    positions = []
+    controls = []
+    for slot in side['slots']:
+        columns = labware[slot].columns()[::side.get('stride', 1)]
+        positions += columns if unit == 'columns' else [[well] for column in columns for well in column]
+        controls += [str(labware[slot].wells_by_name()[name]) for name in side.get('controls', [])]
+    positions = positions[side.get('offset', 0):]
+    return [p for p in positions if not [well for well in p if str(well) in controls]]
+
+def compile_layout(labware, layout, count, pipette):
+    '''
+    Compile a layout into an immutable index of (source well, destination well, pipette) tuples
+    for the first count positions. With the unit 'columns' the wells are the tops of the columns.
+    Returns the index, the wells it uses and a list of errors if there are not enough positions.
+    '''
+    unit = layout.get('unit', 'wells')
+    sources = layout_positions(labware, layout['source'], unit)
+    dests = layout_positions(labware, layout['dest'], unit)
+    errors = []
+    for side, positions in (('origen', sources), ('destino', dests)):
+        if count > len(positions):
+            errors.append(layout['name'] + ': ' + str(count) + ' posiciones necesarias y solo hay ' + str(len(positions)) + ' en el ' + side)
+    index = tuple((s[0], d[0], pipette) for s, d in zip(sources[:count], dests[:count]))
+    wells = {
+        'source': [well for s in sources[:count] for well in s],
+        'dest': [well for d in dests[:count] for well in d]
+        }
+    return index, wells, errors
+
+def check_layouts(compiled):
+    '''
+    Check that no well is filled twice and that no destination well is the source of another layout.
+    compiled is a list of (name, wells) with the wells returned by compile_layout.
+    '''
+    errors = []
+    filled = {}
+    for name, wells in compiled:
+        for well in wells['dest']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo ' + str(well) + ' ya se llena en ' + filled[str(well)])
+            filled[str(well)] = name
+    for name, wells in compiled:
+        for well in wells['source']:
+            if str(well) in filled:
+                errors.append(name + ': el pocillo de origen ' + str(well) + ' se llena en ' + filled[str(well)])
+    return errors
 
 def run(ctx: protocol_api.ProtocolContext):
     ctx.comment('Columnas a utilizar: ' + str(num_cols))
@@ -71,6 +147,7 @@ def run(ctx: protocol_api.ProtocolContext):
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_C_PCR_time_log.txt'
+        map_path = folder_path + '/Station_C_PCR_well_map.txt'
 
 
     #Define Reagents as objects with their properties
@@ -118,6 +195,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Volumen a transferir a los pitufos: ' + str(VOLUME_ARCHIVE_SAMPLE)+ ' ul') 
         ctx.comment('Pausar tras terminar la dispensación de la placa PCR: ' + str(PAUSE_ON_PCR_READY))
         ctx.comment('Foto-sensible: ' + str(PHOTOSENSITIVE)) 
+        ctx.comment('Modo híbrido multicanal/monocanal: ' + str(HYBRID_MODE))
         ctx.comment('###############################################')
         ctx.comment(' ')
 
@@ -183,12 +261,39 @@ def run(ctx: protocol_api.ProtocolContext):
                 time.sleep(0.3)
         ctx._hw_manager.hardware.set_lights(button = True, rails =  False)
 
+        if tip_bin['rack'] is not None:
+            ctx.comment('Recorrido ahorrado con la papelera de puntas: ' + str(round(tip_bin['saved'] / 1000, 1)) + ' m, unos ' + str(round(tip_bin['saved'] / gantry_speed)) + ' segundos')
         ctx.comment('Puntas de  20 ul utilizadas: ' + str(tip_track['counts'][p20]) + ' (' + str(round(tip_track['counts'][p20] / 96, 2)) + ' caja(s))')
-        ctx.comment('Puntas de 200 ul utilizadas: ' + str(tip_track['counts'][m300]) + ' (' + str(round(tip_track['counts'][m300] / 96, 2)) + ' caja(s))')
+        if HYBRID_MODE:
+            ctx.comment('Puntas de  20 ul multicanal utilizadas: ' + str(tip_track['counts'][m20]) + ' (' + str(round(tip_track['counts'][m20] / 96, 2)) + ' caja(s))')
+        else:
+            ctx.comment('Puntas de 200 ul utilizadas: ' + str(tip_track['counts'][m300]) + ' (' + str(round(tip_track['counts'][m300] / 96, 2)) + ' caja(s))')
         ctx.comment('###############################################')
 
         return finish_time
 
+    # Sample lineage: source and destination well of every sample, exported to the well map file
+    well_map = []
+
+    def channel_wells(well, channels):
+        # Wells under every channel of the pipette when its first channel is at well
+        if channels == 1:
+            return [well]
+        for column in well.parent.columns():
+            names = [str(w) for w in column]
+            if str(well) in names:
+                return column[names.index(str(well)):][:channels]
+
+    def record_well_map(source_name, source, dest_name, dest, channels = 1):
+        for s, d in zip(channel_wells(source, channels), channel_wells(dest, channels)):
+            well_map.append([source_name, str(s).split(' ')[0], dest_name, str(d).split(' ')[0]])
+
+    def record_transfer(source, dest, pip):
+        # Plates are named by their slot in the layouts
+        slots = {id(lw): slot for slot, lw in labware.items()}
+        record_well_map(lineage_names[slots[id(source.parent)]], source,
+            lineage_names[slots[id(dest.parent)]], dest, pip.channels)
+
     def log_step_start():
         ctx.comment(' ')
         ctx.comment('###############################################')
@@ -206,6 +311,23 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Paso ' + str(STEP) + ': ' +STEPS[STEP]['description'] + ' hizo un tiempo de ' + str(time_taken))
         ctx.comment(' ')
 
+    def plan_transfers(sources, dests, columns, multi = None):
+        '''
+        Pair every source well with its destination well. Every group of 8 wells that fills a whole
+        column in both the source and the destination is moved at once with the multichannel pipette,
+        the rest of the wells (partial or non-contiguous columns) with the single channel one.
+        '''
+        plan = []
+        i = 0
+        while i < len(sources):
+            if multi is not None and sources[i:i + 8] in columns and dests[i:i + 8] in columns:
+                plan.append((multi, sources[i], dests[i]))
+                i += 8
+            else:
+                plan.append((p20, sources[i], dests[i]))
+                i += 1
+        return plan
+
     def divide_volume(volume,max_vol):
         num_transfers=math.ceil(volume/max_vol)
         vol_roundup=math.ceil(volume/num_transfers)
@@ -395,16 +517,6 @@ def run(ctx: protocol_api.ProtocolContext):
     archive_plate2 = ctx.load_labware(
         'nest_96_wellplate_100ul_pcr_full_skirt', '2',
         'NEST 96 Well Plate 100 uL PCR Full Skirt')
-    
-    source_samples = source_plate.columns()[:num_cols]
-
-    source_sample_wells = [well for columns in source_samples for well in columns] # list of lists to list
-    source_sample_wells = source_sample_wells[:NUM_SAMPLES]
-
-    samples_archive1_cols = archive_plate1.columns()[0::2] # Select odd columns from source plate
-    samples_archive2_cols = archive_plate2.columns()[0::2] # Select odd columns from source plate
-
-    sample_archive_cols = samples_archive1_cols + samples_archive2_cols 
 
     ##################################
     # qPCR plate - final plate, goes to PCR
@@ -419,28 +531,59 @@ def run(ctx: protocol_api.ProtocolContext):
         for slot in ['7']
     ]
     
-    tips300 = [
-        ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
-        for slot in ['10']
-    ]
+    if HYBRID_MODE:
+        tips20_multi = [
+            ctx.load_labware('opentrons_96_filtertiprack_20ul', slot)
+            for slot in ['8', '10']
+        ]
+    else:
+        tips300 = [
+            ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
+            for slot in ['10']
+        ]
+
+    ##################################
+    # Tip bin near the plates, an empty tip rack
+    tip_bin = {'rack': None, 'used': [], 'full': False, 'saved': 0}
+    if TIP_DISPOSAL_SLOT is not None:
+        tip_bin['rack'] = ctx.load_labware('opentrons_96_tiprack_300ul', TIP_DISPOSAL_SLOT, 'tip bin')
 
     ################################################################################
-    
-    # setup up sample sources and destinations
-    pcr_wells = qpcr_plate.wells()[pcr_plate_well_offset:NUM_SAMPLES+pcr_plate_well_offset]
 
     # pipettes
     p20  = ctx.load_instrument('p20_single_gen2', mount='right', tip_racks=tips20)
-    m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks = tips300) # Load multi pipette
+    if HYBRID_MODE:
+        m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks = tips20_multi) # Complete columns and archive
+        archive_pip = m20
+        archive_max_volume = m20.max_volume - Samples.air_gap_vol_bottom - Samples.disposal_volume
+    else:
+        m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks = tips300) # Load multi pipette
+        archive_pip = m300
+        archive_max_volume = Samples.max_volume_allowed
+
+    # setup up sample sources and destinations
+    labware = {'5': source_plate, '1': archive_plate1, '2': archive_plate2, '4': qpcr_plate}
+    lineage_names = {'5': 'elution', '1': 'archive 1', '2': 'archive 2', '4': 'pcr'} # Names of the plates in the well map
+    pcr_index, pcr_layout_wells, layout_errors = compile_layout(labware, PCR_LAYOUT, NUM_SAMPLES, p20)
+    archive_index, archive_layout_wells, archive_layout_errors = compile_layout(labware, ARCHIVE_LAYOUT, num_cols, archive_pip)
+    layout_errors += archive_layout_errors + check_layouts([(PCR_LAYOUT['name'], pcr_layout_wells),
+        (ARCHIVE_LAYOUT['name'], archive_layout_wells)])
+    if layout_errors:
+        for error in layout_errors:
+            ctx.comment('ERROR: ' + error)
+        raise Exception('La distribución de las placas no es válida')
+
+    pcr_plan = plan_transfers([source for source, dest, pip in pcr_index], [dest for source, dest, pip in pcr_index],
+        source_plate.columns() + qpcr_plate.columns(), multi = m20 if HYBRID_MODE else None)
 
     # used tip counter and set maximum tips available
     tip_track = {
-        'counts': { p20: 0 , m300: 0},
+        'counts': { p20: 0 , archive_pip: 0},
         'maxes': { 
             p20: 96 * len(p20.tip_racks),
-            m300: 96 * len(m300.tip_racks)
+            archive_pip: 96 * len(archive_pip.tip_racks)
         },
-        'num_refills' : {m300 : 0}
+        'num_refills' : {archive_pip : 0}
     }
 
     ##########
@@ -458,6 +601,38 @@ def run(ctx: protocol_api.ProtocolContext):
             pip.pick_up_tip()
     ##########
 
+    def bin_position(pip):
+        # Next free position of the tip bin for all the channels of the pipette, None if it is full
+        rack = tip_bin['rack']
+        if pip.channels == 1:
+            # Single tips fill the bin from the end, leaving whole columns for the multichannel
+            candidates = [[well] for well in reversed(rack.wells())]
+        else:
+            candidates = rack.columns()
+        for wells in candidates:
+            if not any(well in tip_bin['used'] for well in wells):
+                return wells
+        return None
+
+    def drop_tip(pip):
+        '''
+        Drop the tip in the tip bin next to the plates, or in the fixed trash if there is no bin
+        or it is full. The travel saved is the round trip to the trash minus the one to the bin
+        '''
+        wells = bin_position(pip) if tip_bin['rack'] is not None else None
+        if wells is None:
+            if tip_bin['rack'] is not None and not tip_bin['full']:
+                tip_bin['full'] = True
+                ctx.comment('La papelera de puntas del slot ' + TIP_DISPOSAL_SLOT + ' está llena, se usa la papelera fija')
+            pip.drop_tip(home_after = False)
+            return
+        current = ctx.location_cache.point if ctx.location_cache else wells[0].top().point
+        trash = ctx.fixed_trash.wells()[0].top().point
+        target = wells[0].top().point
+        tip_bin['saved'] += 2 * (math.hypot(trash.x - current.x, trash.y - current.y) - math.hypot(target.x - current.x, target.y - current.y))
+        tip_bin['used'] += wells
+        pip.drop_tip(wells[0], home_after = False)
+
     log_parameters()
     start_run()
     ############################################################################
@@ -467,21 +642,22 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute'] == True:
         start = log_step_start()
 
-        for source, dest in zip(source_sample_wells, pcr_wells):
-            pick_up(p20)
-            move_vol_multichannel(p20, reagent = Samples, source = source, dest = dest,
+        for pip, source, dest in pcr_plan:
+            pick_up(pip)
+            move_vol_multichannel(pip, reagent = Samples, source = source, dest = dest,
                     vol = VOLUME_PCR_SAMPLE, air_gap_vol = air_gap_sample, x_offset = x_offset,
                     pickup_height = 0.2, disp_height = pcr_disp_height, v_offset = pcr_disp_height, rinse = False,
                     blow_out = True, touch_tip = dispense_touch_tip)
+            record_transfer(source, dest, pip)
 
             if dispense_touch_tip == False :
-                p20.aspirate(air_gap_vol)
+                pip.aspirate(air_gap_vol)
 
             if recycle_tip :
-                p20.return_tip()
+                pip.return_tip()
             else: 
-                p20.drop_tip(home_after = False)                
-                tip_track['counts'][p20]+=1
+                drop_tip(pip)                
+                tip_track['counts'][pip] += pip.channels
 
         end = log_step_end(start)
 
@@ -502,17 +678,19 @@ def run(ctx: protocol_api.ProtocolContext):
     if STEPS[STEP]['Execute']==True:
         start = log_step_start()
 
-        elution_trips = math.ceil(VOLUME_ARCHIVE_SAMPLE / Samples.max_volume_allowed)
+        elution_trips = math.ceil(VOLUME_ARCHIVE_SAMPLE / archive_max_volume)
         elution_volume = VOLUME_ARCHIVE_SAMPLE / elution_trips
+        if HYBRID_MODE:
+            ctx.comment('Modo híbrido: ' + str(elution_trips) + ' viajes por columna con la p20 multicanal hasta el archivo')
         elution_vol = []
         for i in range(elution_trips):
             elution_vol.append(elution_volume + Samples.disposal_volume)
         x_offset_rs = 2
-        for i in range(num_cols):
+        for i, (source, dest, archive_pip) in enumerate(archive_index):
             x_offset_source = 0
             x_offset_dest   = 0
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+            if not archive_pip.hw_pipette['has_tip']:
+                pick_up(archive_pip)
             for transfer_vol in elution_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1
@@ -520,19 +698,21 @@ def run(ctx: protocol_api.ProtocolContext):
                 ctx.comment('La altura de recogida es ' + str(pickup_height) )
 
                 move_vol_multi(
-                        m300, reagent = Samples, source = source_samples[i][0],
-                        dest = sample_archive_cols[i][0], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                        archive_pip, reagent = Samples, source = source,
+                        dest = dest, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                         pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 0, blow_out = True, touch_tip = dispense_touch_tip,
                         drop_height = 3)
 
                 if dispense_touch_tip == False :
-                    m300.aspirate(air_gap_vol)
+                    archive_pip.aspirate(air_gap_vol)
+
+            record_transfer(source, dest, archive_pip)
 
             if recycle_tip == True:
-                m300.return_tip()
+                archive_pip.return_tip()
             else:
-                m300.drop_tip(home_after = False)
-                tip_track['counts'][m300] += 8
+                drop_tip(archive_pip)
+                tip_track['counts'][archive_pip] += 8
 
         log_step_end(start)
 
@@ -541,4 +721,11 @@ def run(ctx: protocol_api.ProtocolContext):
         ########
     ############################################################################
         
+    # Export the well map to a tsv file
+    if not ctx.is_simulating():
+        with open(map_path, 'w') as f:
+            f.write('source\tsource_well\tdest\tdest_well\n')
+            for row in well_map:
+                f.write('\t'.join(row) + '\n')
+
     finish_run()
\ No newline at end of file
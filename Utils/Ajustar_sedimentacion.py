@@ -0,0 +1,125 @@
+'''
+Ajuste del modelo de sedimentación de las bolas magnéticas de la estación B.
+
+El protocolo B-Extraccion_total.py calcula el tiempo de cada incubación con el imán ON a partir
+del bloque "settling" del kit, en lugar de esperar siempre el tiempo fijo. El modelo es una
+regresión logística de la probabilidad de que el pocillo esté claro:
+
+    logit(P(claro)) = intercept + log_time * ln(segundos) + log_height * ln(altura del líquido)
+                      + mag_height * altura del imán
+
+Este script la ajusta con las observaciones de los operadores, un CSV con una fila por pocillo
+revisado:
+
+    bola,labware,altura_iman,volumen,segundos,claro
+    Generico,nest_96_wellplate_2ml_deep,7,610,240,0
+    Generico,nest_96_wellplate_2ml_deep,7,200,120,1
+
+donde volumen es el líquido del pocillo en uL y claro es 1 si las bolas ya estaban en el imán.
+Conviene observar varios tiempos por volumen y, si se quiere cambiar mag_height, varias alturas.
+Muestra el bloque "settling" a copiar en el perfil del kit y el tiempo seguro previsto para
+cada volumen observado.
+
+Ningún kit de Protocols/Kits trae todavía el bloque "settling", porque no hay observaciones:
+hasta que se ajuste y se copie en el perfil, el kit usa sus tiempos de incubación fijos.
+
+Uso:
+    python Utils/Ajustar_sedimentacion.py observaciones.csv --bola Generico
+    python Utils/Ajustar_sedimentacion.py observaciones.csv --bola Magmax --confianza 0.99 --altura-iman 7
+'''
+import argparse
+import csv
+import json
+import math
+
+import numpy as np
+
+# Sección de los pocillos de cada labware que se puede poner en el imán, en mm2
+AREAS = {
+    'nest_96_wellplate_2ml_deep': 8.2 * 8.2,
+}
+COEFICIENTES                = ['intercept', 'log_time', 'log_height', 'mag_height']
+REGULARIZACION              = 0.01  # Penalización L2 de los coeficientes, para separaciones perfectas y una sola altura de imán
+ITERACIONES                 = 100
+TIEMPO_MINIMO               = 60    # Tiempo mínimo de incubación, en segundos
+
+
+def leer_observaciones(path, bola):
+    # Filas del CSV de la bola indicada, agrupadas por labware
+    observations = {}
+    with open(path, newline = '') as f:
+        for row in csv.DictReader(f):
+            if row['bola'] != bola:
+                continue
+            if row['labware'] not in AREAS:
+                raise Exception('Labware sin sección conocida: ' + row['labware'])
+            observations.setdefault(row['labware'], []).append((float(row['altura_iman']), float(row['volumen']),
+                float(row['segundos']), int(row['claro'])))
+    return observations
+
+
+def variables(labware, mag_heights, volumes, seconds):
+    # Matriz de diseño con las columnas de COEFICIENTES
+    heights = np.maximum(volumes, 1) / AREAS[labware]
+    return np.column_stack([np.ones(len(seconds)), np.log(seconds), np.log(heights), mag_heights])
+
+
+def ajustar(X, y):
+    '''
+    Regresión logística por mínimos cuadrados reponderados (IRLS), con una penalización L2
+    pequeña en todos los coeficientes menos el término independiente.
+    '''
+    penalty = REGULARIZACION * np.eye(X.shape[1])
+    penalty[0, 0] = 0
+    beta = np.zeros(X.shape[1])
+    for _ in range(ITERACIONES):
+        p = 1 / (1 + np.exp(-X @ beta))
+        w = np.maximum(p * (1 - p), 1e-9)
+        step = np.linalg.solve(X.T @ (X * w[:, None]) + penalty, X.T @ (y - p) - penalty @ beta)
+        beta += step
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    return beta
+
+
+def tiempo_seguro(beta, labware, mag_height, volume, confidence):
+    # Igual que settling_time en B-Extraccion_total.py, sin el límite del tiempo fijo del kit
+    logit = math.log(confidence / (1 - confidence))
+    height = max(volume, 1) / AREAS[labware]
+    seconds = math.exp((logit - beta[0] - beta[2] * math.log(height) - beta[3] * mag_height) / beta[1])
+    return max(TIEMPO_MINIMO, math.ceil(seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Ajusta el modelo de sedimentación de un kit con las observaciones de los operadores')
+    parser.add_argument('observaciones', help = 'CSV con las columnas bola, labware, altura_iman, volumen, segundos, claro')
+    parser.add_argument('--bola', required = True, help = 'Tipo de bola a ajustar, p.ej. el nombre del kit')
+    parser.add_argument('--confianza', type = float, default = 0.95, help = 'Probabilidad de pocillo claro exigida')
+    parser.add_argument('--altura-iman', type = float, default = 7, help = 'mag_height del protocolo, para los tiempos previstos')
+    args = parser.parse_args()
+
+    observations = leer_observaciones(args.observaciones, args.bola)
+    if not observations:
+        raise Exception('No hay observaciones de la bola ' + args.bola)
+    for labware, rows in observations.items():
+        mag_heights, volumes, seconds, clear = [np.array(column) for column in zip(*rows)]
+        if clear.min() == clear.max():
+            raise Exception('Hacen falta pocillos claros y no claros de ' + labware + ' para ajustar el modelo')
+        beta = ajustar(variables(labware, mag_heights, volumes, seconds), clear)
+        if beta[1] <= 0:
+            raise Exception('El ajuste no mejora con el tiempo (log_time = ' + str(round(beta[1], 3)) + '): revisa las observaciones')
+
+        print(labware + ': ' + str(len(rows)) + ' observaciones, ' + str(int(clear.sum())) + ' claras')
+        block = {
+            'bead': args.bola,
+            'labware': labware,
+            'confidence': args.confianza,
+            'min_wait_time': TIEMPO_MINIMO,
+            'coefficients': {name: round(float(value), 4) for name, value in zip(COEFICIENTES, beta)}
+        }
+        print('"settling": ' + json.dumps(block, indent = 4))
+        for volume in sorted(set(volumes)):
+            print('  ' + str(round(volume)) + ' uL: ' + str(tiempo_seguro(beta, labware, args.altura_iman, volume, args.confianza)) + ' segundos')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Decodificación del pooling en matriz de la estación A (POOLING = 'matriz').
+
+A-Dispensacion_y_lisado_muestras.py deja junto a su mapa de pocillos una tabla de decodificación
+(Station_A_pool_map.txt) con el pool de fila y el pool de columna del deepwell de cada tubo.
+Con los pocillos positivos de la PCR, lista los tubos cuyos dos pools son positivos, que son
+los que hay que analizar de forma individual. Avisa de los pools positivos sin ningún tubo
+candidato, p.ej. un pool de fila positivo sin ningún pool de columna positivo en su bloque.
+
+Uso:
+    python Utils/Decodificar_pools.py Station_A_pool_map.txt --positivos A1 G2
+'''
+import argparse
+import csv
+
+
+def leer_tabla(path):
+    # Filas (tubo, pool de fila, pool de columna) de la tabla de decodificación
+    with open(path, newline = '') as f:
+        return [(row['source'] + ':' + row['source_well'], row['row_pool'], row['column_pool'])
+            for row in csv.DictReader(f, delimiter = '\t')]
+
+
+def decodificar(table, positives):
+    '''
+    Devuelve los tubos candidatos a positivo y los pools positivos que no explica ningún candidato
+    '''
+    candidates = [tube for tube, row_pool, column_pool in table if row_pool in positives and column_pool in positives]
+    explained = set()
+    for tube, row_pool, column_pool in table:
+        if tube in candidates:
+            explained.update([row_pool, column_pool])
+    return candidates, sorted(set(positives) - explained)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Lista los tubos a repetir de forma individual tras un pooling en matriz')
+    parser.add_argument('tabla', help = 'Tabla de decodificación Station_A_pool_map.txt')
+    parser.add_argument('--positivos', nargs = '+', required = True, help = 'Pocillos del deepwell con resultado positivo')
+    args = parser.parse_args()
+
+    candidates, unexplained = decodificar(leer_tabla(args.tabla), set(args.positivos))
+    print('Tubos candidatos a positivo: ' + str(len(candidates)))
+    for tube in candidates:
+        print('  ' + tube)
+    if unexplained:
+        print('Pools positivos sin ningún tubo candidato, conviene repetirlos: ' + ', '.join(unexplained))
+
+if __name__ == '__main__':
+    main()
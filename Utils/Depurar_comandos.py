@@ -0,0 +1,120 @@
+'''
+Depurador de la secuencia de comandos de los protocolos.
+
+Simula cada protocolo con el paquete opentrons (ver Importar_diseno.py) y pasa una ventana
+sobre la lista de comandos registrados que elimina los que no hacen nada útil:
+ - Aspiraciones y dispensaciones de volumen cero, p.ej. la del air gap superior de un reactivo
+   que no lo usa al coger una punta reciclada.
+ - Movimientos a un pocillo seguidos de otro comando en el mismo pocillo (los comentarios
+   intermedios no cuentan), como move_to(top) antes de un air gap, o a la posición en la que
+   ya está la pipeta.
+ - Air gaps repetidos sin ninguna aspiración, dispensación o cambio de punta entre ellos.
+Por cada protocolo indica los comandos eliminados de cada tipo y el tiempo estimado que
+suponen, para corregirlos en el protocolo.
+
+Los protocolos con módulos necesitan un fichero de configuración del robot simulado que los
+conecte, p.ej. {"attached_modules": {"magdeck": [{"serial_number": "mag1", "model": "magneticModuleV2", "calls": []}]}}
+
+Uso:
+    python Utils/Depurar_comandos.py Protocols/B-*.py --hardware robot_simulado.json
+    python Utils/Depurar_comandos.py Protocols/C-Multi-Alicuotado_desde_placa.py --detalle 20
+'''
+import argparse
+import os
+
+from Importar_diseno import simular_protocolo
+
+REGLAS = {
+    'volumen_cero': 'Aspiraciones y dispensaciones de volumen cero',
+    'movimiento': 'Movimientos redundantes',
+    'air_gap': 'Air gaps repetidos',
+}
+# Comandos que cambian el contenido de la punta, entre los que un air gap sí es necesario
+COMANDOS_LIQUIDO = ('Aspirating', 'Dispensing', 'Blowing out', 'Picking up tip', 'Dropping tip', 'Returning tip')
+TIEMPO_PARADA               = 0.5   # Segundos de una parada de más dentro del mismo pocillo
+TIEMPO_AIR_GAP              = 1     # Segundos de un air gap, subir y aspirar
+
+
+def command_well(entry):
+    # Pocillo en el que se ejecuta el comando, o None si no tiene posición
+    location = entry['payload'].get('location')
+    return getattr(location, 'labware', location)
+
+def command_point(entry):
+    return getattr(entry['payload'].get('location'), 'point', None)
+
+def is_comment(entry):
+    # Los comandos de la pipeta y de los módulos registran su instrumento o empiezan por verbos conocidos;
+    # el resto del registro son ctx.comment
+    payload = entry['payload']
+    return 'instrument' not in payload and not payload['text'].startswith(('Air gap', 'Delaying', 'Pausing', 'Homing',
+        'Engaging', 'Disengaging', 'Setting', 'Waiting', 'Deactivating'))
+
+
+def depurar(runlog):
+    '''
+    Devuelve la lista de comandos sin los redundantes y un dict con los eliminados por regla,
+    como listas de (índice en el registro, texto).
+    '''
+    removed = {rule: [] for rule in REGLAS}
+    commands = [(i, entry) for i, entry in enumerate(runlog) if not is_comment(entry)]
+    kept = []
+    point = None # Posición y pocillo de la pipeta tras el último comando conservado
+    well = None
+    air_gap = False # Hay un air gap en la punta y no se ha movido líquido después
+    for k, (i, entry) in enumerate(commands):
+        payload = entry['payload']
+        text = payload['text']
+        if text.startswith(('Aspirating', 'Dispensing')) and payload.get('volume') == 0:
+            removed['volumen_cero'].append((i, text))
+            continue
+        if text.startswith('Moving to'):
+            # El air gap sube desde el pocillo en el que ya está la pipeta y el resto de comandos se mueven
+            # por sí mismos a su pocillo
+            following = commands[k + 1][1] if k + 1 < len(commands) else None
+            if following is None:
+                same_well = False
+            elif following['payload']['text'] == 'Air gap':
+                same_well = command_well(entry) == well
+            else:
+                same_well = command_well(following) == command_well(entry) and command_point(following) is not None
+            if command_point(entry) == point or same_well:
+                removed['movimiento'].append((i, text))
+                continue
+        if text == 'Air gap':
+            if air_gap:
+                removed['air_gap'].append((i, text))
+                continue
+            air_gap = True
+        elif text.startswith(COMANDOS_LIQUIDO):
+            air_gap = False
+        if command_point(entry) is not None:
+            point = command_point(entry)
+            well = command_well(entry)
+        kept.append(entry)
+    return kept, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Lista los comandos redundantes de los protocolos simulados')
+    parser.add_argument('protocolos', nargs = '+', help = 'Protocolos de Python a revisar')
+    parser.add_argument('--hardware', help = 'Configuración del robot simulado, con los módulos conectados')
+    parser.add_argument('--detalle', type = int, default = 0, help = 'Número de comandos eliminados a listar por regla')
+    args = parser.parse_args()
+
+    for path in args.protocolos:
+        runlog = simular_protocolo(path, args.hardware)
+        if runlog is None:
+            raise Exception('No se puede simular ' + path + ': el paquete opentrons no está instalado')
+        kept, removed = depurar(runlog)
+        commands = len([entry for entry in runlog if not is_comment(entry)])
+        seconds = len(removed['movimiento']) * TIEMPO_PARADA + len(removed['air_gap']) * TIEMPO_AIR_GAP
+        print(os.path.basename(path) + ': ' + str(commands) + ' comandos, ' + str(commands - len(kept)) +
+            ' redundantes, unos ' + str(round(seconds)) + ' segundos')
+        for rule, description in REGLAS.items():
+            print('  ' + description + ': ' + str(len(removed[rule])))
+            for i, text in removed[rule][:args.detalle]:
+                print('    ' + str(i) + ': ' + text)
+
+if __name__ == '__main__':
+    main()
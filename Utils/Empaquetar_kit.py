@@ -0,0 +1,51 @@
+'''
+Empaquetado de un kit en el protocolo de la estación B.
+
+Protocols/B-Extraccion_total.py lee el perfil del kit de Protocols/Kits o de
+/var/lib/jupyter/notebooks/Kits en el robot. La app de Opentrons y opentrons_simulate solo
+reciben el fichero del protocolo, sin la carpeta Kits, así que no pueden analizarlo. Este script
+genera una copia del protocolo con KIT y el perfil del kit (KIT_PROFILE) escritos dentro, lista
+para subir a la app. Hay que volver a generarla cada vez que cambie el perfil o el protocolo.
+
+Uso:
+    python Utils/Empaquetar_kit.py Magmax
+    python Utils/Empaquetar_kit.py Generico -o B-Extraccion_total_Generico.py
+'''
+import argparse
+import json
+import os
+import pprint
+import re
+
+CARPETA_PROTOCOLOS          = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Protocols')
+PROTOCOLO                   = os.path.join(CARPETA_PROTOCOLOS, 'B-Extraccion_total.py')
+CARPETA_KITS                = os.path.join(CARPETA_PROTOCOLOS, 'Kits')
+
+
+def empaquetar(source, kit, profile):
+    # Sustituye el valor de KIT y de KIT_PROFILE, manteniendo el resto del protocolo
+    source, found_kit = re.subn(r"^(KIT\s*=\s*)'[^']*'", lambda m: m.group(1) + repr(kit), source, count = 1, flags = re.M)
+    source, found_profile = re.subn(r'^KIT_PROFILE = None$', lambda m: 'KIT_PROFILE = ' + pprint.pformat(profile, width = 120, sort_dicts = False),
+        source, count = 1, flags = re.M)
+    if not found_kit or not found_profile:
+        raise Exception('El protocolo no tiene las variables KIT y KIT_PROFILE = None')
+    return source
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Genera el protocolo de la estación B con el perfil del kit dentro')
+    parser.add_argument('kit', help = 'Nombre del kit, p.ej. Generico o Magmax')
+    parser.add_argument('-o', '--salida', help = 'Protocolo generado, por defecto B-Extraccion_total_<kit>.py')
+    args = parser.parse_args()
+
+    with open(os.path.join(CARPETA_KITS, args.kit + '.json'), encoding = 'utf-8') as f:
+        profile = json.load(f)
+    with open(PROTOCOLO, encoding = 'utf-8') as f:
+        source = f.read()
+    output = args.salida or 'B-Extraccion_total_' + args.kit + '.py'
+    with open(output, 'w', encoding = 'utf-8') as f:
+        f.write(empaquetar(source, args.kit, profile))
+    print('Protocolo con el kit ' + args.kit + ' empaquetado: ' + output)
+
+if __name__ == '__main__':
+    main()
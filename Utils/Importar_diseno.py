@@ -0,0 +1,365 @@
+'''
+Importador de diseños de Protocol Designer (Docs/Designs/Protocols/*.json, schemaVersion 3).
+
+Convierte los comandos del diseño en transferencias (una aspiración y sus dispensaciones),
+las optimiza y genera un protocolo de Python ejecutable en el robot:
+ - Las transferencias consecutivas desde el mismo pocillo de origen con la misma pipeta se
+   unen en una multidispensación mientras quepan en la punta.
+ - Los cambios de punta entre transferencias desde el mismo pocillo de origen se eliminan,
+   siempre que la punta solo haya tocado ese líquido: ninguna dispensación de la transferencia
+   anterior ha entrado en un pocillo que ya tenía líquido.
+Solo se leen los comandos que Protocol Designer ha generado al exportar. Un diseño sin
+comandos, p.ej. con un paso de transferencia sin pocillos de origen, se rechaza indicando sus
+pasos pendientes. El resultado es un protocolo independiente con los comandos en secuencia,
+no un protocolo con pasos (STEPS) como los de Protocols/.
+De los diseños de Docs/Designs/Protocols solo C-Placa tiene comandos, y en él el optimizador no
+une nada: las transferencias consecutivas salen de pocillos distintos (24 transferencias
+y 7.5 min antes y después de optimizar).
+Además estima la duración del diseño original, del protocolo generado y, si se indica con
+--comparar, del protocolo escrito a mano en Protocols/ (simulado con el paquete opentrons).
+
+Uso:
+    python Utils/Importar_diseno.py Docs/Designs/Protocols/C-Placa.json -o C-Placa.py \
+        --comparar Protocols/C-Multi-Alicuotado_desde_placa.py
+'''
+import argparse
+import json
+import os
+import re
+import sys
+
+# Tiempos aproximados de cada acción del robot, en segundos
+TIEMPO_MOVIMIENTO           = 2.5   # Desplazamiento entre dos pocillos de distinto labware
+TIEMPO_MOVIMIENTO_CERCANO   = 1     # Desplazamiento dentro del mismo labware
+TIEMPO_COGER_PUNTA          = 4
+TIEMPO_SOLTAR_PUNTA         = 3
+TIEMPO_BLOW_OUT             = 1
+TIEMPO_TOUCH_TIP            = 2
+TIEMPO_HOME                 = 8
+
+# Volumen que se aspira de más en una multidispensación y se devuelve al origen
+VOLUMEN_DESCARTE            = 1
+# Volumen útil de cada pipeta en una multidispensación
+CAPACIDAD_PIPETA            = {'p20': 18, 'p300': 180, 'p1000': 900}
+
+COMANDOS_SOPORTADOS = ['pickUpTip', 'aspirate', 'dispense', 'dropTip', 'blowout', 'touchTip', 'airGap', 'delay']
+
+
+def cargar_diseno(path):
+    '''
+    Lee el diseño y devuelve el labware, las pipetas y la lista de transferencias.
+    Cada transferencia es un dict con la pipeta, la punta que se coge antes (o None si usa la
+    anterior), si se suelta la punta al final, la aspiración y las acciones que la siguen.
+    '''
+    with open(path, encoding = 'utf-8') as f:
+        diseno = json.load(f)
+    if diseno.get('schemaVersion') != 3:
+        raise Exception('Versión de esquema no soportada: ' + str(diseno.get('schemaVersion')))
+
+    labware = {}
+    for labware_id, lw in diseno['labware'].items():
+        namespace, load_name, version = lw['definitionId'].split('/')
+        labware[labware_id] = {'slot': lw['slot'], 'load_name': load_name, 'namespace': namespace,
+            'label': lw['displayName']}
+
+    pipettes = {}
+    for pipette_id, pip in diseno['pipettes'].items():
+        pipettes[pipette_id] = {'name': pip['name'], 'mount': pip['mount'], 'tipracks': []}
+
+    if not diseno['commands']:
+        raise Exception('El diseño no tiene comandos, complétalo y expórtalo de nuevo en Protocol Designer. '
+            + pasos_pendientes(diseno))
+
+    # Liquid in every well, to know if a dispense goes into liquid
+    liquid = {}
+    for labware_id, wells in diseno['designerApplication']['data'].get('ingredLocations', {}).items():
+        for well, ingredients in wells.items():
+            liquid[(labware_id, well)] = sum(ingredient['volume'] for ingredient in ingredients.values())
+
+    transfers = []
+    tip = None
+    current = None
+    for command in diseno['commands']:
+        name = command['command']
+        params = command['params']
+        if name not in COMANDOS_SOPORTADOS:
+            raise Exception('Comando no soportado: ' + name)
+        if name == 'pickUpTip':
+            tip = (params['labware'], params['well'])
+            if params['labware'] not in pipettes[params['pipette']]['tipracks']:
+                pipettes[params['pipette']]['tipracks'].append(params['labware'])
+        elif name == 'aspirate':
+            current = {'pipette': params['pipette'], 'tip': tip, 'drop_tip': False,
+                'aspirate': params, 'actions': [], 'touches_liquid': False}
+            transfers.append(current)
+            tip = None
+            well = (params['labware'], params['well'])
+            liquid[well] = liquid.get(well, 0) - params['volume']
+        elif name == 'dropTip':
+            if current is not None:
+                current['drop_tip'] = True
+        elif current is not None:
+            current['actions'].append(command)
+            if name in ('dispense', 'airGap', 'blowout'):
+                # Every location of the commands is measured from the bottom of the well
+                well = (params['labware'], params['well'])
+                if liquid.get(well, 0) > 0:
+                    current['touches_liquid'] = True
+                if name == 'dispense':
+                    liquid[well] = liquid.get(well, 0) + params['volume']
+        elif name != 'delay':
+            raise Exception('Comando ' + name + ' antes de la primera aspiración')
+    return {'name': diseno['metadata'].get('protocolName', ''), 'labware': labware,
+        'pipettes': pipettes, 'transfers': transfers}
+
+def pasos_pendientes(diseno):
+    # Description of the steps of the design that Protocol Designer has not turned into commands
+    data = diseno.get('designerApplication', {}).get('data', {})
+    steps = [data['savedStepForms'][step_id] for step_id in data.get('orderedStepIds', [])]
+    if not steps:
+        return 'No tiene ningún paso.'
+    pending = []
+    for step in steps:
+        text = step.get('stepName', '') + ' (' + step['stepType'] + ')'
+        if step['stepType'] == 'moveLiquid' and not step.get('aspirate_wells'):
+            text += ' sin pocillos de origen'
+        elif step['stepType'] == 'moveLiquid' and not step.get('dispense_wells'):
+            text += ' sin pocillos de destino'
+        pending.append(text)
+    return 'Pasos: ' + ', '.join(pending) + '.'
+
+def pipette_capacity(pipette):
+    return CAPACIDAD_PIPETA[pipette['name'].split('_')[0]]
+
+def is_simple(transfer):
+    # Only plain transfers (a single dispense of the whole aspirated volume) can be merged
+    actions = transfer['actions']
+    return (len(actions) == 1 and actions[0]['command'] == 'dispense'
+        and actions[0]['params']['volume'] == transfer['aspirate']['volume'])
+
+def same_source(a, b):
+    return (a['pipette'] == b['pipette'] and a['aspirate']['labware'] == b['aspirate']['labware']
+        and a['aspirate']['well'] == b['aspirate']['well'])
+
+def optimizar(design):
+    '''
+    Une las transferencias consecutivas desde el mismo origen en multidispensaciones y elimina
+    los cambios de punta entre ellas, si la punta no ha entrado en el líquido de ningún destino.
+    Devuelve la nueva lista de transferencias.
+    '''
+    optimized = []
+    for transfer in design['transfers']:
+        last = optimized[-1] if optimized else None
+        # The tip can only go back to the source if it has not touched other liquids
+        if last is not None and same_source(last, transfer) and not last['touches_liquid']:
+            capacity = pipette_capacity(design['pipettes'][transfer['pipette']])
+            if (is_simple(transfer) and last.get('multi', is_simple(last))
+                    and last['aspirate']['volume'] + transfer['aspirate']['volume'] + VOLUMEN_DESCARTE <= capacity):
+                if 'multi' not in last:
+                    last['multi'] = True
+                last['aspirate'] = dict(last['aspirate'], volume = last['aspirate']['volume'] + transfer['aspirate']['volume'])
+                last['actions'] = last['actions'] + transfer['actions']
+                last['drop_tip'] = transfer['drop_tip']
+                last['touches_liquid'] = transfer['touches_liquid']
+                continue
+            # Same liquid, the tip can be kept
+            last = dict(last, drop_tip = False)
+            optimized[-1] = last
+            transfer = dict(transfer, tip = None)
+        optimized.append(dict(transfer))
+    return optimized
+
+def estimar_duracion(transfers):
+    '''
+    Duración estimada en segundos de las transferencias, según los tiempos de cada acción.
+    '''
+    seconds = 0
+    position = None
+    def move(labware):
+        nonlocal position
+        t = TIEMPO_MOVIMIENTO if labware != position else TIEMPO_MOVIMIENTO_CERCANO
+        position = labware
+        return t
+    for transfer in transfers:
+        if transfer['tip'] is not None:
+            seconds += move(transfer['tip'][0]) + TIEMPO_COGER_PUNTA
+        asp = transfer['aspirate']
+        volume = asp['volume'] + (VOLUMEN_DESCARTE if transfer.get('multi') else 0)
+        seconds += move(asp['labware']) + volume / asp['flowRate']
+        for action in transfer['actions']:
+            params = action['params']
+            if action['command'] in ('dispense', 'airGap'):
+                seconds += move(params['labware']) + params['volume'] / params['flowRate']
+            elif action['command'] == 'blowout':
+                seconds += move(params['labware']) + TIEMPO_BLOW_OUT
+            elif action['command'] == 'touchTip':
+                seconds += TIEMPO_TOUCH_TIP
+            elif action['command'] == 'delay' and params.get('wait') is not True:
+                seconds += params.get('wait', 0)
+        if transfer.get('multi'):
+            seconds += move(asp['labware']) + TIEMPO_BLOW_OUT
+        if transfer['drop_tip']:
+            seconds += move('trash') + TIEMPO_SOLTAR_PUNTA
+    return seconds
+
+def simular_protocolo(path, hardware = None):
+    '''
+    Lista de comandos de un protocolo de Python, simulado con el paquete opentrons. hardware es
+    el fichero de configuración del robot simulado, con los módulos conectados.
+    Devuelve None si el paquete no está instalado.
+    '''
+    try:
+        from opentrons.simulate import simulate
+    except ImportError:
+        return None
+    # Definiciones de labware propias del repositorio (CustomLabware)
+    custom_labware = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CustomLabware')
+    options = {} if hardware is None else {'hardware_simulator_file_path': hardware}
+    with open(path, encoding = 'utf-8') as f:
+        runlog, _bundle = simulate(f, file_name = os.path.basename(path), custom_labware_paths = [custom_labware], **options)
+    return runlog
+
+def estimar_duracion_protocolo(path, hardware = None):
+    '''
+    Duración estimada en segundos de un protocolo de Python, simulado con el paquete opentrons.
+    Devuelve None si el paquete no está instalado.
+    '''
+    runlog = simular_protocolo(path, hardware)
+    if runlog is None:
+        return None
+    seconds = 0
+    position = None
+    for entry in runlog:
+        text = entry['payload']['text']
+        labware = re.search(r' of (.*)$', text.split(' at ')[0])
+        if labware is not None:
+            t = TIEMPO_MOVIMIENTO if labware.group(1) != position else TIEMPO_MOVIMIENTO_CERCANO
+            position = labware.group(1)
+            seconds += t
+        rate = re.search(r'^(Aspirating|Dispensing) ([\d.]+) uL .* at ([\d.]+) uL/sec', text)
+        if rate is not None:
+            seconds += float(rate.group(2)) / float(rate.group(3))
+        elif text.startswith('Picking up tip'):
+            seconds += TIEMPO_COGER_PUNTA
+        elif text.startswith('Dropping tip'):
+            seconds += TIEMPO_SOLTAR_PUNTA
+        elif text.startswith('Blowing out'):
+            seconds += TIEMPO_BLOW_OUT
+        elif text.startswith('Touching tip'):
+            seconds += TIEMPO_TOUCH_TIP
+        elif text.startswith('Homing'):
+            seconds += TIEMPO_HOME
+        else:
+            delay = re.search(r'^Delaying for (\d+) minutes and ([\d.]+) seconds', text)
+            if delay is not None:
+                seconds += int(delay.group(1)) * 60 + float(delay.group(2))
+    return seconds
+
+def location(design, params):
+    # The generated protocol keys the labware by slot
+    return ("labware['" + design['labware'][params['labware']]['slot'] + "']['" + params['well'] + "'].bottom("
+        + str(params.get('offsetFromBottomMm', 1)) + ')')
+
+def generar_protocolo(design, transfers, source_path):
+    '''
+    Devuelve el código de un protocolo de Python (API 2.5) que ejecuta las transferencias.
+    '''
+    lines = []
+    add = lines.append
+    add('from opentrons import protocol_api')
+    add('')
+    add('# Generado con Utils/Importar_diseno.py desde ' + os.path.basename(source_path))
+    add('metadata = {')
+    add("    'protocolName': " + repr(design['name']) + ',')
+    add("    'source': 'Hospital Universitario Central de Asturias',")
+    add("    'apiLevel': '2.5',")
+    add("    'description': " + repr('Importado de Protocol Designer: ' + os.path.basename(source_path)))
+    add('    }')
+    add('')
+    add('def run(ctx: protocol_api.ProtocolContext):')
+    add('    labware = {}')
+    for labware_id, lw in design['labware'].items():
+        if lw['load_name'] == 'opentrons_1_trash_1100ml_fixed':
+            continue
+        add("    labware['" + lw['slot'] + "'] = ctx.load_labware('" + lw['load_name'] + "', '" + lw['slot']
+            + "', " + repr(lw['label']) + ')')
+    add('')
+    add('    pipettes = {}')
+    for pipette_id, pip in design['pipettes'].items():
+        tipracks = ', '.join("labware['" + design['labware'][t]['slot'] + "']" for t in pip['tipracks'])
+        add("    pipettes['" + pip['mount'] + "'] = ctx.load_instrument('" + pip['name'] + "', '" + pip['mount']
+            + "', tip_racks = [" + tipracks + '])')
+    if not transfers:
+        add('')
+        add("    ctx.comment('El diseño no tiene pasos')")
+    for transfer in transfers:
+        pip = "pipettes['" + design['pipettes'][transfer['pipette']]['mount'] + "']"
+        asp = transfer['aspirate']
+        add('')
+        if transfer['tip'] is not None:
+            add('    ' + pip + ".pick_up_tip(labware['" + design['labware'][transfer['tip'][0]]['slot'] + "']['" + transfer['tip'][1] + "'])")
+        add('    ' + pip + '.flow_rate.aspirate = ' + str(asp['flowRate']))
+        volume = asp['volume'] + (VOLUMEN_DESCARTE if transfer.get('multi') else 0)
+        add('    ' + pip + '.aspirate(' + str(volume) + ', ' + location(design, asp) + ')')
+        for action in transfer['actions']:
+            params = action['params']
+            if action['command'] == 'dispense':
+                add('    ' + pip + '.flow_rate.dispense = ' + str(params['flowRate']))
+                add('    ' + pip + '.dispense(' + str(params['volume']) + ', ' + location(design, params) + ')')
+            elif action['command'] == 'airGap':
+                add('    ' + pip + '.aspirate(' + str(params['volume']) + ', ' + location(design, params) + ')')
+            elif action['command'] == 'blowout':
+                add('    ' + pip + '.flow_rate.blow_out = ' + str(params['flowRate']))
+                add('    ' + pip + '.blow_out(' + location(design, params) + ')')
+            elif action['command'] == 'touchTip':
+                add('    ' + pip + '.touch_tip(' + location(design, params) + ')')
+            elif action['command'] == 'delay':
+                if params.get('wait') is True:
+                    add('    ctx.pause(' + repr(params.get('message', '')) + ')')
+                else:
+                    add('    ctx.delay(seconds = ' + str(params.get('wait', 0)) + ')')
+        if transfer.get('multi'):
+            # The disposal volume goes back to the source, over the liquid
+            add('    ' + pip + ".blow_out(labware['" + design['labware'][asp['labware']]['slot'] + "']['" + asp['well'] + "'].top())")
+        if transfer['drop_tip']:
+            add('    ' + pip + '.drop_tip()')
+    return '\n'.join(lines) + '\n'
+
+def minutes(seconds):
+    return str(round(seconds / 60, 1)) + ' min'
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Importa un diseño de Protocol Designer y genera un protocolo optimizado')
+    parser.add_argument('diseno', help = 'Fichero JSON exportado de Protocol Designer')
+    parser.add_argument('-o', '--salida', help = 'Fichero del protocolo generado')
+    parser.add_argument('--comparar', help = 'Protocolo escrito a mano con el que comparar la duración')
+    args = parser.parse_args()
+
+    try:
+        design = cargar_diseno(args.diseno)
+    except Exception as e:
+        sys.exit('No se puede importar ' + args.diseno + ': ' + str(e))
+    transfers = optimizar(design)
+    original = estimar_duracion(design['transfers'])
+    optimized = estimar_duracion(transfers)
+
+    print('Diseño: ' + design['name'])
+    print('Transferencias: ' + str(len(design['transfers'])) + ' en el diseño, ' + str(len(transfers)) + ' tras optimizar')
+    print('Puntas: ' + str(len([t for t in design['transfers'] if t['tip'] is not None])) + ' en el diseño, '
+        + str(len([t for t in transfers if t['tip'] is not None])) + ' tras optimizar')
+    print('Duración estimada del diseño: ' + minutes(original))
+    print('Duración estimada del protocolo generado: ' + minutes(optimized))
+    if args.comparar:
+        handwritten = estimar_duracion_protocolo(args.comparar)
+        if handwritten is None:
+            print('No se puede simular ' + args.comparar + ': el paquete opentrons no está instalado')
+        else:
+            print('Duración estimada de ' + os.path.basename(args.comparar) + ': ' + minutes(handwritten))
+
+    if args.salida:
+        with open(args.salida, 'w', encoding = 'utf-8') as f:
+            f.write(generar_protocolo(design, transfers, args.diseno))
+        print('Protocolo generado: ' + args.salida)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+'''
+Optimizador de la distribución del deck a partir de los comandos del protocolo.
+
+Simula el protocolo con el paquete opentrons (ver Importar_diseno.py), cuenta los
+desplazamientos de la pipeta entre cada par de slots y busca la asignación de slots que
+minimiza el tiempo total de desplazamiento, con las restricciones del OT-2:
+ - Los módulos (magnético, temperatura) solo van en los slots 1, 3, 4, 6, 7, 9 y 10, y el
+   labware cargado sobre un módulo se mueve con él.
+ - La papelera fija sigue en el slot 12.
+ - Los slots indicados con --fijar no se mueven.
+La altura del labware no cambia con la distribución: los movimientos entre dos labware suben a
+la altura del labware más alto del deck, esté donde esté.
+
+Muestra el mapa de slots propuesto para todo lo que carga el protocolo, también el labware que la
+pipeta no toca (p.ej. las cajas de puntas que sobran con pocas muestras), para cambiar sus
+load_labware y load_module, y el tiempo de desplazamiento previsto frente al actual.
+
+Uso:
+    python Utils/Optimizar_deck.py Protocols/B-Placa-Extraccion_total_Generico.py --hardware robot_simulado.json
+    python Utils/Optimizar_deck.py Protocols/C-Multi-Alicuotado_desde_placa.py --fijar 4 5
+'''
+import argparse
+import random
+import re
+
+import numpy as np
+
+from Importar_diseno import simular_protocolo
+from Verificar_labware import SLOT_ANCHO, SLOT_ALTO, VELOCIDAD_MAXIMA
+
+SLOTS                       = [str(s) for s in range(1, 13)]
+SLOTS_MODULO                = ['1', '3', '4', '6', '7', '9', '10']
+SLOT_PAPELERA               = '12'
+REINICIOS                   = 20    # Búsquedas locales desde distribuciones aleatorias, además de la actual
+SEMILLA                     = 0
+
+
+def slot_xy(slot):
+    slot = int(slot) - 1
+    return np.array([(slot % 3) * SLOT_ANCHO, (slot // 3) * SLOT_ALTO])
+
+def tiempos_entre_slots():
+    # Matriz 12 x 12 de segundos entre los centros de los slots, con el eje más lento
+    xy = np.array([slot_xy(s) for s in SLOTS])
+    distancia = np.abs(xy[:, None, :] - xy[None, :, :])
+    return np.max(distancia / VELOCIDAD_MAXIMA[:2], axis = 2)
+
+
+def simular_deck(path, hardware = None):
+    '''
+    Simula el protocolo y devuelve sus comandos y, por slot, el nombre de lo que se ha cargado en
+    él y si está sobre un módulo. El deck sale del contexto del protocolo simulado, así que
+    incluye el labware y los módulos que la pipeta no llega a tocar.
+    Devuelve None, None si el paquete opentrons no está instalado.
+    '''
+    try:
+        import opentrons.simulate
+    except ImportError:
+        return None, None
+    # opentrons.simulate no devuelve el contexto del protocolo: se guarda al crearlo
+    contexts = []
+    create_context = opentrons.simulate._create_live_context_non_pe
+    def keep_context(*args, **kwargs):
+        contexts.append(create_context(*args, **kwargs))
+        return contexts[-1]
+    opentrons.simulate._create_live_context_non_pe = keep_context
+    try:
+        runlog = simular_protocolo(path, hardware)
+    finally:
+        opentrons.simulate._create_live_context_non_pe = create_context
+    if not contexts:
+        raise Exception('No se puede leer el deck de ' + path + ': solo se admiten protocolos con apiLevel anterior a 2.14')
+
+    ctx = contexts[0]
+    contents = {}
+    for slot, module in ctx.loaded_modules.items():
+        contents[str(slot)] = (re.search(r' at (.*?) on \d+', str(module)).group(1), True)
+    for slot, labware in ctx.loaded_labwares.items():
+        contents[str(slot)] = (str(labware).split(' on ')[0], str(slot) in contents)
+    return runlog, contents
+
+def recorrido(runlog):
+    # Secuencia de slots visitados por la pipeta
+    visits = []
+    for entry in runlog:
+        if 'location' not in entry['payload']:
+            continue
+        found = re.search(r' of (.*) on (\d+)\b', entry['payload']['text'])
+        if found is not None:
+            visits.append(found.group(2))
+    return visits
+
+def matriz_transiciones(visits):
+    # Número de desplazamientos entre cada par de slots, sin contar los que se quedan en el mismo slot
+    counts = np.zeros((len(SLOTS), len(SLOTS)))
+    for a, b in zip(visits, visits[1:]):
+        if a != b:
+            counts[SLOTS.index(a), SLOTS.index(b)] += 1
+    return counts
+
+
+def coste(assignment, counts, times):
+    # assignment[i] es el índice del slot propuesto para lo que hoy está en el slot SLOTS[i]
+    return float(np.sum(counts * times[np.ix_(assignment, assignment)]))
+
+def optimizar(counts, contents, fixed):
+    '''
+    Busca con búsqueda local (intercambios de dos slots) desde la distribución actual y desde
+    distribuciones aleatorias. Devuelve la mejor asignación, como lista de índices de slot.
+    '''
+    times = tiempos_entre_slots()
+    on_module = [contents.get(s, ('', False))[1] for s in SLOTS]
+    pinned = [s in fixed or s == SLOT_PAPELERA for s in SLOTS]
+
+    def valid(assignment):
+        return all(SLOTS[assignment[i]] in SLOTS_MODULO for i in range(len(SLOTS)) if on_module[i])
+
+    def local_search(assignment):
+        best = coste(assignment, counts, times)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(SLOTS)):
+                for j in range(i + 1, len(SLOTS)):
+                    if pinned[i] or pinned[j]:
+                        continue
+                    candidate = list(assignment)
+                    candidate[i], candidate[j] = candidate[j], candidate[i]
+                    if not valid(candidate):
+                        continue
+                    cost = coste(candidate, counts, times)
+                    if cost < best - 1e-9:
+                        assignment, best, improved = candidate, cost, True
+        return assignment, best
+
+    rng = random.Random(SEMILLA)
+    best_assignment, best_cost = local_search(list(range(len(SLOTS))))
+    movable = [i for i in range(len(SLOTS)) if not pinned[i]]
+    for _ in range(REINICIOS):
+        assignment = list(range(len(SLOTS)))
+        shuffled = rng.sample(movable, len(movable))
+        for i, j in zip(movable, shuffled):
+            assignment[i] = j
+        if not valid(assignment):
+            continue
+        assignment, cost = local_search(assignment)
+        if cost < best_cost - 1e-9:
+            best_assignment, best_cost = assignment, cost
+    return best_assignment, best_cost
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Propone la distribución del deck que minimiza los desplazamientos del protocolo')
+    parser.add_argument('protocolo', help = 'Protocolo de Python a simular')
+    parser.add_argument('--hardware', help = 'Configuración del robot simulado, con los módulos conectados (ver Depurar_comandos.py)')
+    parser.add_argument('--fijar', nargs = '*', default = [], help = 'Slots que no se pueden mover')
+    args = parser.parse_args()
+
+    runlog, contents = simular_deck(args.protocolo, args.hardware)
+    if runlog is None:
+        raise Exception('No se puede simular ' + args.protocolo + ': el paquete opentrons no está instalado')
+    visits = recorrido(runlog)
+    counts = matriz_transiciones(visits)
+    times = tiempos_entre_slots()
+    current = coste(list(range(len(SLOTS))), counts, times)
+    assignment, proposed = optimizar(counts, contents, args.fijar)
+
+    print('Desplazamientos entre slots: ' + str(int(counts.sum())))
+    for i, slot in enumerate(SLOTS):
+        if slot not in contents:
+            continue
+        name, on_module = contents[slot]
+        new_slot = SLOTS[assignment[i]]
+        change = 'slot ' + slot + ' -> ' + new_slot if new_slot != slot else 'slot ' + slot + ' (sin cambios)'
+        print('  ' + change + ': ' + name + (' (sobre módulo)' if on_module else ''))
+    print('Tiempo de desplazamiento actual: ' + str(round(current)) + ' segundos')
+    print('Tiempo de desplazamiento previsto: ' + str(round(proposed)) + ' segundos, ' + str(round(current - proposed)) + ' segundos menos')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+Planificador de la flota de robots de las estaciones A, B y C.
+
+Reparte las muestras del día en lotes y los encadena por las tres estaciones: mientras el lote k
+está en C, el k+1 está en B y el k+2 en A. Cada lote entra en el primer robot libre de su
+estación en cuanto sale de la estación anterior. Indica la estación cuello de botella y las
+muestras por hora, tanto en régimen permanente como para la carga del día.
+
+La duración de cada estación se estima simulando su protocolo con el paquete opentrons (ver
+Importar_diseno.py) o se indica en minutos con --duraciones. No necesita ningún robot.
+
+Uso:
+    python Utils/Planificar_flota.py 450 --robots A=1 B=2 C=1 \
+        --protocolos A=Protocols/A-Dispensacion_y_lisado_muestras.py \
+        B=Protocols/B-Placa-Extraccion_total_Generico.py C=Protocols/C-Multi-Alicuotado_desde_placa.py
+    python Utils/Planificar_flota.py 450 --robots A=1 B=2 C=1 --duraciones A=35 B=95 C=20
+'''
+import argparse
+import math
+
+from Importar_diseno import estimar_duracion_protocolo, minutes
+
+ESTACIONES                  = ['A', 'B', 'C']
+MUESTRAS_POR_LOTE           = 90    # Máximo de muestras de la estación A, el resto de la placa son controles
+TIEMPO_CARGA                = 10    # Minutos para descargar y cargar un robot entre dos lotes
+
+
+def parse_station_values(values, kind):
+    # Convierte una lista ['A=1', 'B=2'] en un dict {'A': kind('1'), 'B': kind('2')}
+    result = {}
+    for value in values or []:
+        station, _, v = value.partition('=')
+        if station not in ESTACIONES or v == '':
+            raise Exception('Valor no válido: ' + value + ' (se espera estación=valor, con estación A, B o C)')
+        result[station] = kind(v)
+    return result
+
+
+def duraciones_estaciones(protocolos, duraciones, hardware = None):
+    '''
+    Duración en segundos de un lote en cada estación. Las duraciones indicadas tienen prioridad
+    sobre las simuladas.
+    '''
+    result = {}
+    for station in ESTACIONES:
+        if station in duraciones:
+            result[station] = duraciones[station] * 60
+        elif station in protocolos:
+            seconds = estimar_duracion_protocolo(protocolos[station], hardware)
+            if seconds is None:
+                raise Exception('No se puede simular ' + protocolos[station] + ': el paquete opentrons no está instalado')
+            result[station] = seconds
+        else:
+            raise Exception('Falta el protocolo o la duración de la estación ' + station)
+    return result
+
+
+def planificar(num_samples, robots, durations, batch_size = MUESTRAS_POR_LOTE, load_time = TIEMPO_CARGA * 60):
+    '''
+    Devuelve la lista de lotes. Cada lote es un dict con el número de muestras y, por estación,
+    el robot asignado y los instantes de inicio y fin en segundos desde el inicio del día.
+    '''
+    free = {station: [0] * robots[station] for station in ESTACIONES}
+    batches = []
+    for k in range(math.ceil(num_samples / batch_size)):
+        batch = {'samples': min(batch_size, num_samples - k * batch_size), 'stations': {}}
+        ready = 0
+        for station in ESTACIONES:
+            robot = min(range(robots[station]), key = lambda r: free[station][r])
+            start = max(ready, free[station][robot])
+            end = start + durations[station]
+            free[station][robot] = end + load_time
+            batch['stations'][station] = {'robot': robot + 1, 'start': start, 'end': end}
+            ready = end + load_time
+        batches.append(batch)
+    return batches
+
+
+def cuello_de_botella(robots, durations, load_time = TIEMPO_CARGA * 60):
+    # Tiempo entre dos lotes que salen de cada estación en régimen permanente
+    cycles = {station: (durations[station] + load_time) / robots[station] for station in ESTACIONES}
+    return max(ESTACIONES, key = lambda station: cycles[station]), cycles
+
+
+def hour(seconds):
+    return '%d:%02d' % (seconds // 3600, seconds % 3600 // 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Planifica los lotes de muestras entre los robots de las estaciones A, B y C')
+    parser.add_argument('muestras', type = int, help = 'Número de muestras del día')
+    parser.add_argument('--robots', nargs = '+', default = ['A=1', 'B=1', 'C=1'], help = 'Robots por estación, p.ej. A=1 B=2 C=1')
+    parser.add_argument('--protocolos', nargs = '+', help = 'Protocolo de cada estación, p.ej. B=Protocols/B-Placa-Extraccion_total_Generico.py')
+    parser.add_argument('--duraciones', nargs = '+', help = 'Duración de un lote en minutos, p.ej. B=95')
+    parser.add_argument('--hardware', help = 'Configuración del robot simulado, con los módulos conectados (ver Depurar_comandos.py)')
+    parser.add_argument('--lote', type = int, default = MUESTRAS_POR_LOTE, help = 'Muestras por lote')
+    parser.add_argument('--carga', type = float, default = TIEMPO_CARGA, help = 'Minutos para descargar y cargar un robot')
+    args = parser.parse_args()
+
+    if args.muestras <= 0:
+        parser.error('el número de muestras debe ser positivo')
+    if args.lote <= 0:
+        parser.error('las muestras por lote deben ser positivas')
+    robots = {station: 1 for station in ESTACIONES}
+    robots.update(parse_station_values(args.robots, int))
+    for station in ESTACIONES:
+        if robots[station] < 1:
+            parser.error('la estación ' + station + ' necesita al menos un robot')
+    durations = duraciones_estaciones(parse_station_values(args.protocolos, str), parse_station_values(args.duraciones, float), args.hardware)
+    load_time = args.carga * 60
+
+    batches = planificar(args.muestras, robots, durations, args.lote, load_time)
+    for station in ESTACIONES:
+        print('Estación ' + station + ': ' + str(robots[station]) + ' robot(s), ' + minutes(durations[station]) + ' por lote')
+    print()
+    for k, batch in enumerate(batches):
+        print('Lote ' + str(k + 1) + ' (' + str(batch['samples']) + ' muestras): ' + ', '.join(
+            station + str(b['robot']) + ' ' + hour(b['start']) + '-' + hour(b['end']) for station, b in batch['stations'].items()))
+
+    bottleneck, cycles = cuello_de_botella(robots, durations, load_time)
+    makespan = batches[-1]['stations']['C']['end']
+    print()
+    print('Cuello de botella: estación ' + bottleneck + ', un lote cada ' + minutes(cycles[bottleneck]))
+    print('Muestras por hora en régimen permanente: ' + str(round(args.lote * 3600 / cycles[bottleneck], 1)))
+    print('Duración total: ' + hour(makespan) + ', ' + str(round(args.muestras * 3600 / makespan, 1)) + ' muestras por hora')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Trazabilidad de las muestras entre las estaciones A, B y C.
+
+Cada protocolo deja junto a su registro de tiempos un mapa de pocillos (Station_*_well_map.txt)
+con el pocillo de origen y de destino de cada muestra. Este script los guarda en una base de
+datos SQLite local, encadenando los mapas de un mismo lote: el destino de una estación es el
+origen de la siguiente (deepwell en A y B, elution en B y C). Dado cualquier tubo o pocillo,
+devuelve el recorrido completo de la muestra con dos consultas indexadas, sin buscar a mano en
+hojas como Utils/DistribucionRackTipoA.xlsx.
+
+Los mapas de un lote se pueden importar a medida que terminan las estaciones, en orden A, B, C.
+Importar de nuevo un mapa no duplica las posiciones.
+
+Uso:
+    python Utils/Trazabilidad.py importar --lote 2020-11-03-1 Station_A_well_map.txt \
+        Station_B_Extraccion_total_well_map.txt Station_C_well_map.txt
+    python Utils/Trazabilidad.py buscar 'pcr:B3'
+    python Utils/Trazabilidad.py buscar --lote 2020-11-03-1 'rack 1:A5'
+'''
+import argparse
+import csv
+import sqlite3
+
+BASE_DE_DATOS               = 'trazabilidad.db'
+
+ESQUEMA = '''
+CREATE TABLE IF NOT EXISTS posiciones (
+    lote TEXT NOT NULL,
+    muestra INTEGER NOT NULL,
+    orden INTEGER NOT NULL,
+    labware TEXT NOT NULL,
+    pocillo TEXT NOT NULL,
+    UNIQUE (lote, muestra, labware, pocillo)
+);
+CREATE INDEX IF NOT EXISTS posiciones_pocillo ON posiciones (labware, pocillo, lote);
+CREATE INDEX IF NOT EXISTS posiciones_muestra ON posiciones (lote, muestra, orden);
+'''
+
+
+def conectar(path):
+    db = sqlite3.connect(path)
+    db.executescript(ESQUEMA)
+    return db
+
+
+def leer_mapa(path):
+    # Filas (origen, pocillo de origen, destino, pocillo de destino) del mapa de una estación
+    with open(path, newline = '') as f:
+        return [(row['source'], row['source_well'], row['dest'], row['dest_well'])
+            for row in csv.DictReader(f, delimiter = '\t')]
+
+
+def muestras_en(db, labware, pocillo, lote = None):
+    if lote is None:
+        return db.execute('SELECT DISTINCT lote, muestra, orden FROM posiciones WHERE labware = ? AND pocillo = ?',
+            (labware, pocillo)).fetchall()
+    return db.execute('SELECT DISTINCT lote, muestra, orden FROM posiciones WHERE labware = ? AND pocillo = ? AND lote = ?',
+        (labware, pocillo, lote)).fetchall()
+
+
+def importar(db, lote, paths):
+    '''
+    Añade los mapas al lote. Cada destino hereda las muestras de su origen; un origen que no está en
+    el lote (los tubos de A) es una muestra nueva. Devuelve el número de posiciones añadidas.
+    '''
+    added = db.total_changes
+    next_sample = db.execute('SELECT COALESCE(MAX(muestra), 0) + 1 FROM posiciones WHERE lote = ?', (lote,)).fetchone()[0]
+    for path in paths:
+        for source, source_well, dest, dest_well in leer_mapa(path):
+            samples = muestras_en(db, source, source_well, lote)
+            if not samples:
+                db.execute('INSERT INTO posiciones VALUES (?, ?, 0, ?, ?)', (lote, next_sample, source, source_well))
+                samples = [(lote, next_sample, 0)]
+                next_sample += 1
+            for _lote, sample, orden in samples:
+                db.execute('INSERT OR IGNORE INTO posiciones VALUES (?, ?, ?, ?, ?)', (lote, sample, orden + 1, dest, dest_well))
+    db.commit()
+    return db.total_changes - added
+
+
+def linaje(db, labware, pocillo, lote = None):
+    '''
+    Devuelve, para cada muestra que ha pasado por el pocillo, su lote, su número y sus posiciones
+    agrupadas por etapa: [[(labware, pocillo), ...], ...]
+    '''
+    result = []
+    for sample_lote, sample, _orden in muestras_en(db, labware, pocillo, lote):
+        stages = []
+        for orden, lw, well in db.execute('SELECT orden, labware, pocillo FROM posiciones WHERE lote = ? AND muestra = ? ORDER BY orden',
+                (sample_lote, sample)):
+            if len(stages) <= orden:
+                stages.append([])
+            stages[orden].append((lw, well))
+        result.append((sample_lote, sample, stages))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Trazabilidad de las muestras entre las estaciones A, B y C')
+    parser.add_argument('--base', default = BASE_DE_DATOS, help = 'Fichero de la base de datos SQLite')
+    commands = parser.add_subparsers(dest = 'comando', required = True)
+    parser_importar = commands.add_parser('importar', help = 'Importa los mapas de pocillos de un lote')
+    parser_importar.add_argument('--lote', required = True, help = 'Identificador del lote')
+    parser_importar.add_argument('mapas', nargs = '+', help = 'Mapas de pocillos, en orden A, B, C')
+    parser_buscar = commands.add_parser('buscar', help = 'Muestra el recorrido de las muestras de un tubo o pocillo')
+    parser_buscar.add_argument('--lote', help = 'Identificador del lote, por defecto todos')
+    parser_buscar.add_argument('posicion', help = 'labware:pocillo, p.ej. pcr:B3 o "rack 1:A5"')
+    args = parser.parse_args()
+
+    db = conectar(args.base)
+    if args.comando == 'importar':
+        print('Posiciones añadidas al lote ' + args.lote + ': ' + str(importar(db, args.lote, args.mapas)))
+    else:
+        labware, _, pocillo = args.posicion.rpartition(':')
+        found = linaje(db, labware, pocillo, args.lote)
+        if not found:
+            print('No hay muestras en ' + args.posicion)
+        for sample_lote, sample, stages in found:
+            print('Lote ' + sample_lote + ', muestra ' + str(sample) + ': ' + ' -> '.join(
+                ', '.join(lw + ' ' + well for lw, well in stage) for stage in stages))
+
+if __name__ == '__main__':
+    main()
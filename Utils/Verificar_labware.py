@@ -0,0 +1,133 @@
+'''
+Planificación y revisión de la comprobación de labware por lotes (CustomLabware/Test/test_*.py
+con CHECK_MODE = 'batch').
+
+Sin robot, calcula las coordenadas esperadas de todos los pocillos del labware a partir de su
+definición como una operación vectorial, planifica el recorrido continuo por los pocillos de la
+muestra y estima su duración frente a la comprobación de bordes con pausas.
+El robot no mide la posición de la punta, solo la lleva a la posición esperada. Al terminar el
+recorrido deja el fichero de comprobación (labware_check_<labware>.csv) con una columna
+centered que el operador rellena con 1 si la punta estaba centrada en esa posición y 0 si no.
+Con ese fichero lista los pocillos marcados con 0, para ponerlos en DEVIATION_WELLS en la
+siguiente ejecución, y las posiciones que el operador no ha revisado.
+
+Uso:
+    python Utils/Verificar_labware.py CustomLabware/rochemagnapure_96_wellplate_400ul.json
+    python Utils/Verificar_labware.py CustomLabware/rochemagnapure_96_wellplate_400ul.json \
+        --pocillos A1 H1 E7 H12 A12 --comprobacion labware_check_rochemagnapure_96_wellplate_400ul.csv
+'''
+import argparse
+import csv
+import json
+
+import numpy as np
+
+# Origen de cada slot del OT-2 respecto al slot 1, en mm
+SLOT_ANCHO                  = 132.5
+SLOT_ALTO                   = 90.5
+
+# Velocidades máximas de los ejes X, Y, Z en mm/s
+VELOCIDAD_MAXIMA            = np.array([600, 400, 125])
+ALTURA_FONDO                = 1     # Altura sobre el fondo del pocillo que se visita, en mm
+TIEMPO_PAUSA                = 15    # Tiempo medio que el operador tarda en reanudar tras una pausa, en segundos
+
+
+def coordenadas_esperadas(definition, slot):
+    '''
+    Devuelve los nombres de los pocillos y dos arrays (N, 3) con las coordenadas de deck de la
+    parte superior y de la visita al fondo de cada pocillo.
+    '''
+    nombres = [name for column in definition['ordering'] for name in column]
+    slot = int(slot) - 1
+    origen = np.array([(slot % 3) * SLOT_ANCHO, (slot // 3) * SLOT_ALTO, 0])
+    offset = definition['cornerOffsetFromSlot']
+    origen = origen + np.array([offset['x'], offset['y'], offset['z']])
+
+    pocillos = np.array([[definition['wells'][n][k] for k in ('x', 'y', 'z', 'depth')] for n in nombres], dtype = float)
+    fondo = origen + pocillos[:, :3] + np.array([0, 0, ALTURA_FONDO])
+    top = origen + pocillos[:, :3] + np.outer(pocillos[:, 3], [0, 0, 1])
+    return nombres, top, fondo
+
+
+def muestra_pocillos(definition):
+    # Esquinas y centro del labware, en un recorrido continuo por las columnas
+    ordering = definition['ordering']
+    cols = len(ordering)
+    rows = len(ordering[0])
+    picks = [(0, 0), (0, rows - 1), (cols // 2, rows // 2), (cols - 1, rows - 1), (cols - 1, 0)]
+    muestra = []
+    for c, r in picks:
+        if ordering[c][r] not in muestra:
+            muestra.append(ordering[c][r])
+    return muestra
+
+
+def duracion_recorrido(puntos, rate):
+    # Cada tramo dura lo que tarda el eje más lento en recorrerlo
+    tramos = np.abs(np.diff(puntos, axis = 0))
+    return float(np.sum(np.max(tramos / (VELOCIDAD_MAXIMA * rate), axis = 1)))
+
+
+def planificar(definition, slot, pocillos, rate, espera):
+    '''
+    Devuelve el recorrido (parte superior y fondo de cada pocillo de la muestra, en orden) y su
+    duración en segundos, incluida la espera sobre cada posición.
+    '''
+    nombres, top, fondo = coordenadas_esperadas(definition, slot)
+    indices = [nombres.index(p) for p in pocillos]
+    recorrido = np.empty((2 * len(indices), 3))
+    recorrido[0::2] = top[indices]
+    recorrido[1::2] = fondo[indices]
+    return recorrido, duracion_recorrido(recorrido, rate) + espera * len(recorrido)
+
+
+def revision_operador(path):
+    # Devuelve las posiciones que el operador ha marcado como no centradas y las que no ha revisado
+    with open(path, newline = '') as f:
+        filas = list(csv.DictReader(f))
+    no_centradas = [fila['position'] for fila in filas if fila['centered'].strip() == '0']
+    sin_revisar = [fila['position'] for fila in filas if fila['centered'].strip() not in ('0', '1')]
+    return no_centradas, sin_revisar
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Planifica y revisa la comprobación de labware por lotes')
+    parser.add_argument('definicion', help = 'Definición JSON del labware')
+    parser.add_argument('--slot', default = '2', help = 'Slot del labware (TEST_LABWARE_SLOT)')
+    parser.add_argument('--pocillos', nargs = '*', help = 'Pocillos de la muestra (CHECK_WELLS), por defecto esquinas y centro')
+    parser.add_argument('--rate', type = float, default = 0.5, help = 'Fracción de la velocidad por defecto (BATCH_RATE)')
+    parser.add_argument('--espera', type = float, default = 1, help = 'Segundos sobre cada posición (CHECK_DWELL)')
+    parser.add_argument('--comprobacion', help = 'Fichero de comprobación revisado por el operador')
+    args = parser.parse_args()
+
+    with open(args.definicion, encoding = 'utf-8') as f:
+        definition = json.load(f)
+
+    nombres, top, fondo = coordenadas_esperadas(definition, args.slot)
+    print('Pocillos: %d, x %.2f-%.2f, y %.2f-%.2f, z superior %.2f-%.2f' % (len(nombres),
+        top[:, 0].min(), top[:, 0].max(), top[:, 1].min(), top[:, 1].max(), top[:, 2].min(), top[:, 2].max()))
+
+    pocillos = args.pocillos or muestra_pocillos(definition)
+    recorrido, duracion = planificar(definition, args.slot, pocillos, args.rate, args.espera)
+    print('Recorrido por lotes: ' + ' '.join(pocillos))
+    # Para al colocar el labware y al final, cuando el operador marca las posiciones no centradas
+    print('  %d posiciones, %.0f s, 2 pausas' % (len(recorrido), duracion + 2 * TIEMPO_PAUSA))
+    # La comprobación de bordes para en las 3 cruces, al colocar el labware y en la parte superior,
+    # los 4 bordes y el fondo de A1 y del último pocillo
+    pausas_bordes = 3 + 1 + 2 * 6
+    print('Comprobación de bordes: %d pausas, unos %.0f s' % (pausas_bordes, pausas_bordes * TIEMPO_PAUSA))
+
+    if args.comprobacion:
+        no_centradas, sin_revisar = revision_operador(args.comprobacion)
+        print('Posiciones no centradas: ' + (', '.join(no_centradas) or 'ninguna'))
+        if sin_revisar:
+            print('Posiciones sin revisar: ' + ', '.join(sin_revisar))
+        marcados = []
+        for p in no_centradas:
+            if not p.startswith('cross') and p.split(' ')[0] not in marcados:
+                marcados.append(p.split(' ')[0])
+        print('DEVIATION_WELLS = ' + repr(marcados))
+
+
+if __name__ == '__main__':
+    main()